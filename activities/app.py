@@ -1,10 +1,26 @@
-from flask import Flask, jsonify
+from flask import Flask, Response
 from flask import request as flask_request
 from flask_restful import Resource, Api, reqparse
 
 import requests
+import base64
 import datetime
+import json
+import os
+import random
+import threading
+import time
+
 import psycopg2
+import psycopg2.extras
+import psycopg2.sql
+
+from common.cache import LRUCache
+from common.db import Pool
+from archive import Archive
+from feed_cache import FeedCache
+from live import Broker
+from trending import Trending
 
 app = Flask('activities')
 api = Api(app)
@@ -12,158 +28,963 @@ api = Api(app)
 # Microservice URLs.
 friends_microservice_url = "http://friends:5000"
 
-conn = None
+# Number of friend lists that are kept to revalidate with their ETag, and for how many seconds.
+FRIENDS_CACHE_SIZE = 10000
+FRIENDS_CACHE_TTL = 600
+# Number of feed pages that are cached, and for how many seconds at most (they are invalidated by new activities).
+FEED_CACHE_SIZE = 10000
+FEED_CACHE_TTL = 60
+# Maximum number of users whose friends are retrieved in a single batch request to the Friends microservice.
+FRIENDS_BATCH_SIZE = 1000
+
+# 'pull' builds every feed when it is read, 'push' copies every new activity into the materialized timelines of the
+# users whose feed shows it, such that reading a feed is a single range scan.
+FEED_MODE = os.environ.get('FEED_MODE', 'pull')
+# Number of most recent activities kept in the timeline of every user in push mode.
+FEED_TIMELINE_LENGTH = int(os.environ.get('FEED_TIMELINE_LENGTH', 1000))
+# Timelines that receive an activity are trimmed back to their length once every this many pushes (on average), such
+# that a push doesn't have to count the entries of every timeline.
+FEED_TRIM_INTERVAL = 50
+
+# The activities table is partitioned by month. The partitions for this many coming months are created on startup,
+# and again every PARTITION_INTERVAL seconds.
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_INTERVAL = 24 * 60 * 60
+
+# Activities older than this many days are archived per month, once the whole month is older, every RETENTION_INTERVAL
+# seconds: they are counted in the daily rollups and moved to the compressed archive files in ARCHIVE_DIR.
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', 365))
+RETENTION_INTERVAL = 24 * 60 * 60
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '/var/lib/activities/archive')
+# Idempotency keys are deleted this many days after they were used, which is far longer than an outbox retries.
+ACTIVITY_KEY_TTL_DAYS = int(os.environ.get('ACTIVITY_KEY_TTL_DAYS', 7))
+
+# Maximum number of activities that can be created in a single batch request.
+MAX_ACTIVITIES_BATCH = 10000
+# Number of rows sent per INSERT statement of a batch.
+INSERT_PAGE_SIZE = 1000
+
+# The fields that are required for every type of activity, the other fields of an activity are NULL.
+ACTIVITY_FIELDS = {
+    'create_playlist': ('username', 'playlist_id'),
+    'add_song': ('username', 'song_artist', 'song_title', 'playlist_id'),
+    'make_friend': ('username', 'username_friend'),
+    'share_playlist': ('username', 'username_friend', 'playlist_id'),
+}
+
+# Default and maximum number of activities per page of a feed.
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+# Maximum number of new activities queued for a watcher of a live feed before it has to reload the feed.
+STREAM_QUEUE_SIZE = 100
+# Number of seconds between heartbeats on an idle stream, such that proxies don't close it.
+STREAM_HEARTBEAT = 15
+# Default and maximum number of seconds a long poll waits for new activities.
+DEFAULT_POLL_TIMEOUT = 25
+MAX_POLL_TIMEOUT = 60
+
+# Number of songs and users in the top of every trending window, and the number of seconds between updates of the tops.
+TRENDING_SIZE = 10
+TRENDING_REFRESH = 10
+
+# All activities, in a single format.
+ACTIVITIES_QUERY = """
+    SELECT activity_type, username, username_friend, song_artist, song_title, playlist_id, activity_timestamp, id
+    FROM activities
+    WHERE {where}
+    ORDER BY activity_timestamp {sort_order}, activity_type {sort_order}, id {sort_order}
+    LIMIT $1"""
+
+# The activities of the friends ($1) of a user ($2).
+# It doesn't matter if user A or user B added each other as friend, both are seen as an activity, by separate users.
+# The same goes for sharing playlists. Each half of the union is a range scan on the index on username or on
+# username_friend, the second half skips the activities that the first half already returned.
+FRIEND_ACTIVITIES_QUERY = """
+    WITH friend_activities AS (
+        SELECT activity_type, username, username_friend, song_artist, song_title, playlist_id, activity_timestamp, id
+        FROM activities
+        WHERE username = ANY($1::VARCHAR[]) AND (username_friend IS NULL OR username_friend != $2)
+        UNION ALL
+        SELECT activity_type, username, username_friend, song_artist, song_title, playlist_id, activity_timestamp, id
+        FROM activities
+        WHERE username_friend = ANY($1::VARCHAR[]) AND username != $2 AND username != ALL($1::VARCHAR[]))
+    SELECT *
+    FROM friend_activities
+    WHERE {where}
+    ORDER BY activity_timestamp {sort_order}, activity_type {sort_order}, id {sort_order}
+    LIMIT $3"""
+
+# Materialized timeline of a user ($1), in the same format as the activities.
+FEED_QUERY = """
+    SELECT activity_type, username, username_friend, song_artist, song_title, playlist_id, activity_timestamp, activity_id
+    FROM feed_entries
+    WHERE owner = $1 AND {where}
+    ORDER BY activity_timestamp {sort_order}, activity_type {sort_order}, activity_id {sort_order}
+    LIMIT $2"""
+
+# Removes all but the most recent $2 entries of the timelines of the given users ($1), through the index on
+# (owner, activity_timestamp DESC).
+FEED_TRIM_QUERY = """
+    DELETE FROM feed_entries AS entries
+    USING (SELECT owner, (SELECT activity_timestamp
+                          FROM feed_entries
+                          WHERE feed_entries.owner = owners.owner
+                          ORDER BY activity_timestamp DESC
+                          OFFSET $2 LIMIT 1) AS horizon
+           FROM unnest($1::VARCHAR[]) AS owners (owner)) AS horizons
+    WHERE entries.owner = horizons.owner AND entries.activity_timestamp <= horizons.horizon"""
+
+
+def keyset_statements(name: str, query: str, key: str, first: int):
+    """
+    Generates the statements of a feed query, which is paginated on the key (activity_timestamp, activity_type, id).
+
+    The sort order can't be a parameter, so there is a statement for the first page in each order, and one for the
+    page before (older) and after (newer) a cursor, whose key is given as parameters $first, $first+1 and $first+2.
+
+    :param name: prefix of the names of the statements.
+    :param query: the query, with a {where} and {sort_order} placeholder.
+    :param key: the columns of the key in the query.
+    """
+    bound = f'({key}) {{}} (${first}::TIMESTAMP, ${first + 1}::VARCHAR, ${first + 2}::BIGINT)'
+    return {
+        f'{name}_asc': query.format(where='TRUE', sort_order='ASC'),
+        f'{name}_desc': query.format(where='TRUE', sort_order='DESC'),
+        f'{name}_before': query.format(where=bound.format('<'), sort_order='DESC'),
+        f'{name}_after': query.format(where=bound.format('>'), sort_order='ASC'),
+    }
+
+
+# Registry of the SQL statements of this service, prepared once on every pooled connection.
+STATEMENTS = {
+    **keyset_statements('activities', ACTIVITIES_QUERY, 'activity_timestamp, activity_type, id', 2),
+    **keyset_statements('friend_activities', FRIEND_ACTIVITIES_QUERY, 'activity_timestamp, activity_type, id', 4),
+    **keyset_statements('feed', FEED_QUERY, 'activity_timestamp, activity_type, activity_id', 3),
+    # Copies a new activity into the timelines of its followers ($1).
+    'feed_push': "INSERT INTO feed_entries (owner, activity_type, username, username_friend, song_artist, song_title, "
+                 "playlist_id, activity_timestamp, activity_id) "
+                 "SELECT owner, $2::VARCHAR, $3::VARCHAR, $4::VARCHAR, $5::VARCHAR, $6::VARCHAR, $7::INTEGER, "
+                 "$8::TIMESTAMP, $9::BIGINT FROM unnest($1::VARCHAR[]) AS owner",
+    'feed_trim': FEED_TRIM_QUERY,
+    'feed_clear': "DELETE FROM feed_entries WHERE owner = $1",
+    # Fills the timeline of a user ($2) with the most recent activities of their friends ($1), as in pull mode.
+    'feed_rebuild': "INSERT INTO feed_entries (owner, activity_type, username, username_friend, song_artist, "
+                    "song_title, playlist_id, activity_timestamp, activity_id) "
+                    "SELECT $2::VARCHAR, activities.* "
+                    f"FROM ({FRIEND_ACTIVITIES_QUERY.format(where='TRUE', sort_order='DESC')}) AS activities",
+    # Number of songs added since $1 and of activities per user since $1, per minute, to rebuild the trending counts.
+    'trending_songs': "SELECT song_artist, song_title, date_trunc('minute', activity_timestamp), COUNT(*) "
+                      "FROM activities WHERE activity_type = 'add_song' AND activity_timestamp >= $1::TIMESTAMP "
+                      "GROUP BY 1, 2, 3",
+    'trending_users': "SELECT username, date_trunc('minute', activity_timestamp), COUNT(*) "
+                      "FROM activities WHERE activity_timestamp >= $1::TIMESTAMP GROUP BY 1, 2",
+    # Counts the activities of a month ($1 up to $2) per user, day and type, in addition to the counts so far.
+    'rollup_activities': "INSERT INTO activity_rollups (username, day, activity_type, count) "
+                         "SELECT username, activity_timestamp::DATE, activity_type, COUNT(*) FROM activities "
+                         "WHERE activity_timestamp >= $1::TIMESTAMP AND activity_timestamp < $2::TIMESTAMP "
+                         "GROUP BY 1, 2, 3 "
+                         "ON CONFLICT (username, day, activity_type) "
+                         "DO UPDATE SET count = activity_rollups.count + EXCLUDED.count",
+    'insert_activity': "INSERT INTO activities (activity_type, username, username_friend, song_artist, song_title, "
+                       "playlist_id, activity_timestamp) VALUES ($1, $2, $3, $4, $5, $6, $7) "
+                       "RETURNING id, activity_timestamp",
+}
 
-while conn is None:
+# Connections are only opened when they are first used, such that the module can be imported without a database.
+pool = Pool(dbname="activities", host="activities_persistence", minconn=0, statements=STATEMENTS)
+
+
+def create_partitions():
+    """
+    Creates the monthly partitions of the activities table for the current and the coming months, once every
+    PARTITION_INTERVAL seconds, such that new activities never end up in the default partition.
+    """
+    while True:
+        try:
+            with pool.transaction() as cursor:
+                cursor.execute("SELECT create_activity_partitions(NOW()::DATE, "
+                               "(NOW() + make_interval(months => %s))::DATE);", (PARTITION_MONTHS_AHEAD,))
+        except psycopg2.Error:
+            app.logger.exception('Could not create the partitions of the activities table')
+        time.sleep(PARTITION_INTERVAL)
+
+
+# Activities that are older than the retention horizon.
+archive = Archive(ARCHIVE_DIR)
+
+
+def archive_month(month: datetime.date):
+    """
+    Moves the activities of a month from the activities table to the archive, and counts them in the daily rollups.
+
+    The partition of the month and the default partition are locked against writes while the month is archived, and
+    the partition is dropped rather than emptied, such that the table doesn't have to be vacuumed afterwards. Archiving
+    a month again (e.g. after an activity of that month was created) adds its new activities to its archive file.
+
+    :param month: first day of the month.
+    :return: number of activities that were archived.
+    """
+    start = datetime.datetime.combine(month, datetime.time())
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    partition = f'activities_{month:%Y_%m}'
+    with pool.transaction() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (partition,))
+        partitioned = cursor.fetchone()[0]
+        for table in [partition, 'activities_default'] if partitioned else ['activities_default']:
+            cursor.execute(psycopg2.sql.SQL("LOCK TABLE {} IN EXCLUSIVE MODE;").format(psycopg2.sql.Identifier(table)))
+        cursor.execute("SELECT activity_type, username, username_friend, song_artist, song_title, playlist_id, "
+                       "activity_timestamp, id FROM activities "
+                       "WHERE activity_timestamp >= %s AND activity_timestamp < %s;", (start, end))
+        rows = cursor.fetchall()
+        # The archive file is written first: if the transaction fails, archiving the month again replaces the rows.
+        archive.write(month, rows)
+        pool.execute(cursor, 'rollup_activities', (start, end))
+        if partitioned:
+            cursor.execute(psycopg2.sql.SQL("DROP TABLE {};").format(psycopg2.sql.Identifier(partition)))
+        # The activities that are left are those of the month in the default partition.
+        cursor.execute("DELETE FROM activities WHERE activity_timestamp >= %s AND activity_timestamp < %s;",
+                       (start, end))
+    return len(rows)
+
+
+def archive_activities():
+    """
+    Archives every month that is entirely older than the retention horizon and still has activities.
+
+    :return: number of activities that were archived.
+    """
+    horizon = datetime.date.today() - datetime.timedelta(days=ACTIVITY_RETENTION_DAYS)
+    archived = 0
+    while True:
+        with pool.transaction() as cursor:
+            cursor.execute("SELECT date_trunc('month', MIN(activity_timestamp))::DATE FROM activities;")
+            month = cursor.fetchone()[0]
+        if month is None or month >= horizon.replace(day=1):
+            return archived
+        archived += archive_month(month)
+
+
+def expire_activity_keys():
+    """
+    Deletes the idempotency keys that are older than ACTIVITY_KEY_TTL_DAYS.
+
+    :return: number of keys that were deleted.
+    """
+    with pool.transaction() as cursor:
+        cursor.execute("DELETE FROM activity_keys WHERE created_at < NOW() - make_interval(days => %s);",
+                       (ACTIVITY_KEY_TTL_DAYS,))
+        return cursor.rowcount
+
+
+def apply_retention():
+    """
+    Archives the activities that are older than the retention horizon, and deletes the expired idempotency keys, once
+    every RETENTION_INTERVAL seconds.
+    """
+    while True:
+        try:
+            expire_activity_keys()
+            archive_activities()
+        except (psycopg2.Error, OSError):
+            app.logger.exception('Could not archive the old activities')
+        time.sleep(RETENTION_INTERVAL)
+
+
+# Username -> (ETag, friends) of the last friend list retrieved from the Friends microservice.
+friends_cache = LRUCache(FRIENDS_CACHE_SIZE, FRIENDS_CACHE_TTL)
+# Pages of the feeds of users, invalidated when an activity that they show is created.
+feed_cache = FeedCache(FEED_CACHE_SIZE, FEED_CACHE_TTL)
+# Watchers of live feeds, which receive every new activity that their feed shows.
+broker = Broker(STREAM_QUEUE_SIZE)
+# Most added songs and most active users over the last hour, day and week.
+trending = Trending(TRENDING_SIZE)
+
+
+def load_trending():
+    """
+    Rebuilds the trending counts from the activities of the longest window, before any new activity is counted.
+    """
+    since = datetime.datetime.now() - datetime.timedelta(seconds=max(window for window, _ in Trending.WINDOWS.values()))
+    with pool.transaction() as cursor:
+        pool.execute(cursor, 'trending_songs', (since,))
+        for song_artist, song_title, minute, count in cursor.fetchall():
+            trending.add_count('songs', (song_artist, song_title), minute, count)
+        pool.execute(cursor, 'trending_users', (since,))
+        for username, minute, count in cursor.fetchall():
+            trending.add_count('users', username, minute, count)
+    trending.refresh()
+
+
+def refresh_trending():
+    """
+    Slides the trending windows and ranks their tops once every TRENDING_REFRESH seconds.
+    """
+    while True:
+        time.sleep(TRENDING_REFRESH)
+        trending.refresh()
+
+
+def start_background_jobs():
+    """
+    Starts the background jobs of the service: the creation of partitions, the retention job, and the ranking of the
+    trending tops once their counts were rebuilt. Called once by the entrypoint, such that importing the module (e.g.
+    for the CLI commands) doesn't need a database.
+    """
+    threading.Thread(target=create_partitions, name='create-partitions', daemon=True).start()
+    threading.Thread(target=apply_retention, name='apply-retention', daemon=True).start()
     try:
-        conn = psycopg2.connect(dbname="activities", user="postgres", password="postgres",
-                                host="activities_persistence")
-        print("DB connection succesful")
-    except psycopg2.OperationalError:
-        import time
+        load_trending()
+    except psycopg2.Error:
+        app.logger.exception('Could not rebuild the trending songs and users')
+    threading.Thread(target=refresh_trending, name='refresh-trending', daemon=True).start()
+
+
+def get_friends(username: str, authorization: str = None):
+    """
+    Retrieves the friends of a user from the Friends microservice, revalidating a previously retrieved friend list
+    with its ETag, such that an unchanged friend list is not sent again.
+
+    :param username: the username of the user.
+    :param authorization: Authorization header of the request to forward, if any.
+    :return: list of usernames of the friends, None if the user does not exist.
+    """
+    headers = {'Authorization': authorization} if authorization else {}
+    cached = friends_cache.get(username)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    response = requests.get(f'{friends_microservice_url}/friends/{username}', headers=headers)
+    if response.status_code == 304:
+        return cached[1]
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    friends = [friend['username'] for friend in response.json()['friends']]
+    if 'ETag' in response.headers:
+        friends_cache.put(username, (response.headers['ETag'], friends))
+    return friends
 
-        time.sleep(1)
-        print("Retrying DB connection")
+
+def get_friends_many(usernames):
+    """
+    Retrieves the friends of many users from the Friends microservice, with a single request per batch.
+
+    :param usernames: list of usernames.
+    :return: dictionary of username -> list of usernames of the friends, None if the user does not exist.
+    """
+    friends = {}
+    for start in range(0, len(usernames), FRIENDS_BATCH_SIZE):
+        response = requests.post(f'{friends_microservice_url}/friends/batch',
+                                 json={'usernames': usernames[start:start + FRIENDS_BATCH_SIZE]})
+        response.raise_for_status()
+        friends.update(response.json()['friends'])
+    return friends
+
+
+def feed_owners(friends: dict, username: str, username_friend: str = None):
+    """
+    Determines the users whose feed shows an activity of a user, optionally involving a friend (e.g. make_friend). Such
+    an activity is shown to the friends of both users, except to the users themselves.
+
+    :param friends: dictionary of username -> list of usernames of the friends (None if the user does not exist), for
+                    at least the users of the activity.
+    :return: set of usernames.
+    """
+    owners = set(friends.get(username) or ())
+    if username_friend is not None:
+        owners |= set(friends.get(username_friend) or ())
+    return owners - {username, username_friend}
+
+
+def followers(username: str, username_friend: str = None):
+    """
+    Retrieves the users whose feed shows an activity of a user, optionally involving a friend.
+
+    :return: list of usernames.
+    """
+    if username_friend is None:
+        friends = {username: get_friends(username)}
+    else:
+        friends = get_friends_many([username, username_friend])
+    return list(feed_owners(friends, username, username_friend))
+
+
+def push_activity(cursor, owners, activity_type: str, activity_id: int, username: str, username_friend: str = None,
+                  song_artist: str = None, song_title: str = None, playlist_id: int = None, timestamp=None):
+    """
+    Copies a new activity into the timelines of the users whose feed shows it, in the transaction that stores it.
+
+    :param cursor: cursor of the transaction of the activity.
+    :param owners: list of usernames of the users whose feed shows the activity, see followers().
+    """
+    if not owners:
+        return
+    pool.execute(cursor, 'feed_push', (owners, activity_type, username, username_friend, song_artist, song_title,
+                                       playlist_id, timestamp, activity_id))
+    if random.random() < 1 / FEED_TRIM_INTERVAL:
+        pool.execute(cursor, 'feed_trim', (owners, FEED_TIMELINE_LENGTH))
+
+
+def activities_created(activities, owners=()):
+    """
+    Updates the feeds after activities were created: new friends see the activities of each other, the cached feeds
+    that show any of the activities are invalidated, and the activities are delivered to the watchers of live feeds.
+    The activities are also counted for the trending songs and users.
+
+    :param activities: list of activity rows, in the format of the feed queries.
+    :param owners: usernames of the users whose timeline received the activities (in push mode).
+    """
+    friendships = sorted({user for activity in activities if activity[0] == 'make_friend' for user in activity[1:3]})
+    if friendships and FEED_MODE == 'push':
+        # The feeds of both users now show the activities of their new friend. The activities are stored already, so
+        # if that fails the feeds are still updated below, and `flask backfill-feeds` catches up the timelines.
+        try:
+            rebuild_timelines(friendships)
+        except (requests.RequestException, psycopg2.Error):
+            app.logger.exception('Could not rebuild the timelines of %s', ', '.join(friendships))
+    feed_cache.invalidate(set(owners) | set(friendships))
+    feed_cache.invalidate_watchers({activity[1] for activity in activities}
+                                   | {activity[2] for activity in activities if activity[2]})
+    broker.publish(activities)
+    trending.add(activities)
+
+
+def create_activity(activity_type: str, username: str, username_friend: str = None, song_artist: str = None,
+                    song_title: str = None, playlist_id: int = None, timestamp=None):
+    """
+    Stores a new activity, copies it into the timelines of the users whose feed shows it in push mode, and invalidates
+    their cached feeds.
+
+    In push mode, the followers are retrieved before the activity is stored, and the activity is copied into their
+    timelines in the same transaction. If the Friends microservice is unavailable nothing is stored, such that the
+    activity can be created again (e.g. by the outbox of the sender) rather than being left out of the timelines.
+
+    :param timestamp: the timestamp of the activity, now if not given.
+    :return: the id of the activity.
+    """
+    timestamp = timestamp or datetime.datetime.now()
+    owners = followers(username, username_friend) if FEED_MODE == 'push' else []
+    with pool.transaction() as cursor:
+        pool.execute(cursor, 'insert_activity', (activity_type, username, username_friend, song_artist, song_title,
+                                                 playlist_id, timestamp))
+        activity_id, timestamp = cursor.fetchone()
+        push_activity(cursor, owners, activity_type, activity_id, username, username_friend, song_artist, song_title,
+                      playlist_id, timestamp)
+    activities_created([(activity_type, username, username_friend, song_artist, song_title, playlist_id, timestamp,
+                         activity_id)], owners)
+    return activity_id
+
+
+def create_activities(activities, keys=None):
+    """
+    Stores many new activities in a single transaction, with one INSERT per INSERT_PAGE_SIZE activities, and copies
+    them into the timelines of the users whose feed shows them in push mode, with a single request for the friends of
+    all users involved. As in create_activity(), the friends are retrieved before anything is stored, and the timelines
+    are filled in the same transaction.
+
+    :param activities: list of (activity_type, username, username_friend, song_artist, song_title, playlist_id,
+                       timestamp) tuples.
+    :param keys: list with the idempotency key (or None) of every activity. Activities with a key that was seen before
+                 are skipped.
+    :return: list of the ids of the activities that were created.
+    """
+    friends = None
+    if FEED_MODE == 'push' and activities:
+        users = {activity[1] for activity in activities} | {activity[2] for activity in activities if activity[2]}
+        friends = get_friends_many(sorted(users))
+
+    owners = set()
+    with pool.transaction() as cursor:
+        if keys and any(keys):
+            new_keys = {row[0] for row in psycopg2.extras.execute_values(
+                cursor, "INSERT INTO activity_keys (idempotency_key) VALUES %s ON CONFLICT DO NOTHING "
+                        "RETURNING idempotency_key", [(key,) for key in set(keys) if key],
+                page_size=INSERT_PAGE_SIZE, fetch=True)}
+            # Only the first activity with a new key is created.
+            created = []
+            for activity, key in zip(activities, keys):
+                if key is None or key in new_keys:
+                    new_keys.discard(key)
+                    created.append(activity)
+            activities = created
+        ids = psycopg2.extras.execute_values(
+            cursor, "INSERT INTO activities (activity_type, username, username_friend, song_artist, song_title, "
+                    "playlist_id, activity_timestamp) VALUES %s RETURNING id, activity_timestamp", activities,
+            page_size=INSERT_PAGE_SIZE, fetch=True) if activities else []
+
+        if friends is not None:
+            entries = []
+            for (activity_id, timestamp), activity in zip(ids, activities):
+                activity_owners = feed_owners(friends, activity[1], activity[2])
+                entries.extend((owner, *activity[:6], timestamp, activity_id) for owner in activity_owners)
+                owners |= activity_owners
+            if entries:
+                psycopg2.extras.execute_values(
+                    cursor, "INSERT INTO feed_entries (owner, activity_type, username, username_friend, song_artist, "
+                            "song_title, playlist_id, activity_timestamp, activity_id) VALUES %s", entries,
+                    page_size=INSERT_PAGE_SIZE)
+                pool.execute(cursor, 'feed_trim', (sorted(owners), FEED_TIMELINE_LENGTH))
+    activities_created([(*activity[:6], timestamp, activity_id)
+                        for (activity_id, timestamp), activity in zip(ids, activities)], owners)
+    return [row[0] for row in ids]
+
+
+def parse_activity(data, timestamp):
+    """
+    Validates an activity of a batch.
+
+    :param data: dictionary with the activity_type and the fields of the activity, and optionally its timestamp and
+                 idempotency_key.
+    :param timestamp: the timestamp of the activity if it doesn't have one.
+    :return: tuple of the activity, as (activity_type, username, username_friend, song_artist, song_title, playlist_id,
+             timestamp), and its idempotency key (None if it has none).
+    :raises ValueError: if the activity is malformed.
+    """
+    if not isinstance(data, dict) or data.get('activity_type') not in ACTIVITY_FIELDS:
+        raise ValueError(f'activity_type must be one of {", ".join(ACTIVITY_FIELDS)}')
+    fields = dict.fromkeys(('username', 'username_friend', 'song_artist', 'song_title', 'playlist_id'))
+    for field in ACTIVITY_FIELDS[data['activity_type']]:
+        value = data.get(field)
+        if field == 'playlist_id':
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError('playlist_id must be an integer')
+        elif not isinstance(value, str):
+            raise ValueError(f'Missing {field}')
+        fields[field] = value
+    if data.get('timestamp') is not None and not isinstance(data['timestamp'], str):
+        raise ValueError('timestamp must be a string')
+    key = data.get('idempotency_key')
+    if key is not None and not (isinstance(key, str) and 0 < len(key) <= 255):
+        raise ValueError('idempotency_key must be a string of at most 255 characters')
+    return (data['activity_type'], *fields.values(), data.get('timestamp') or timestamp), key
+
+
+def rebuild_timelines(usernames):
+    """
+    Rebuilds the timelines of users from the activities, e.g. after their friends changed.
+
+    :param usernames: list of usernames.
+    :return: number of timelines that were rebuilt.
+    """
+    rebuilt = 0
+    for username, friends in get_friends_many(usernames).items():
+        if friends is None:
+            continue
+        with pool.transaction() as cursor:
+            pool.execute(cursor, 'feed_clear', (username,))
+            pool.execute(cursor, 'feed_rebuild', (friends, username, FEED_TIMELINE_LENGTH))
+        rebuilt += 1
+    return rebuilt
+
+
+@app.cli.command('backfill-feeds')
+def backfill_feeds():
+    """
+    Rebuilds the timeline of every user whose feed shows at least one activity, e.g. before switching to push mode.
+
+    Usage: python3 -m flask backfill-feeds
+    """
+    with pool.transaction() as cursor:
+        cursor.execute("SELECT username FROM activities "
+                       "UNION SELECT username_friend FROM activities WHERE username_friend IS NOT NULL;")
+        actors = [row[0] for row in cursor.fetchall()]
+
+    # Only the friends of users with activities have something in their feed.
+    owners = set()
+    for friends in get_friends_many(actors).values():
+        owners.update(friends or ())
+    owners = sorted(owners)
+    rebuilt = sum(rebuild_timelines(owners[start:start + FRIENDS_BATCH_SIZE])
+                  for start in range(0, len(owners), FRIENDS_BATCH_SIZE))
+    print(f'Rebuilt the timelines of {rebuilt} users')
+
+
+def activity_key(row):
+    """
+    :return: the key (activity_timestamp, activity_type, id) of an activity row, on which feeds are sorted.
+    """
+    return row[6], row[0], row[7]
+
+
+@app.cli.command('archive-activities')
+def archive_activities_command():
+    """
+    Archives the activities that are older than the retention horizon right away.
+
+    Usage: python3 -m flask archive-activities
+    """
+    print(f'Archived {archive_activities()} activities')
+
+
+def encode_cursor(row):
+    """
+    :return: the opaque cursor of an activity row, encoding its key (activity_timestamp, activity_type, id).
+    """
+    key = json.dumps([row[6].isoformat(), row[0], row[7]])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    :return: the key (activity_timestamp, activity_type, id) encoded in a cursor.
+    :raises ValueError: if the cursor is invalid.
+    """
+    try:
+        timestamp, activity_type, activity_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(timestamp), str(activity_type), int(activity_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def parse_page(args):
+    """
+    Parses the paging query parameters of a feed.
+
+    :param args: the query parameters of the request.
+    :return: tuple (n, sort, statement suffix, key of the cursor or () for the first page).
+    :raises ValueError: if a query parameter is invalid.
+    """
+    n = args.get('n', type=int)
+    if 'n' in args and (n is None or n < 1):
+        raise ValueError('n must be a positive integer')
+    n = min(n or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+    # If the sort order is invalid set default to 'desc'.
+    sort = args.get('sort', type=str, default='desc')
+    if sort not in ['asc', 'desc']:
+        sort = 'desc'
+
+    if 'before' in args and 'after' in args:
+        raise ValueError('Only one of before and after can be given')
+    for direction in ('before', 'after'):
+        if direction in args:
+            return n, sort, direction, decode_cursor(args[direction])
+    return n, sort, sort, ()
+
+
+def format_activity(row):
+    """
+    :return: dictionary with the fields of an activity row, as returned by the API.
+    """
+    return {
+        'activity_type': row[0],
+        'username': row[1],
+        'username_friend': row[2],
+        'song_artist': row[3],
+        'song_title': row[4],
+        'playlist_id': row[5],
+        'timestamp': row[6].strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def make_page(rows, n: int, sort: str, direction: str):
+    """
+    Formats a page of activity rows, in the requested sort order.
+
+    :param rows: the rows in the order of the query, i.e. away from the cursor.
+    :return: dictionary with the activities, and the cursor to continue in the direction of the request (None if this
+             was the last page): to pass as before for a 'before' or first 'desc' page, as after for an 'after' or
+             first 'asc' page.
+    """
+    # Only hand out a cursor if the page was full, otherwise this was the last page. The last row of the query is the
+    # one furthest from the cursor, whatever the sort order of the page is.
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == n else None
+    # Pages before a cursor are retrieved newest first, pages after a cursor oldest first.
+    if {'before': 'desc', 'after': 'asc'}.get(direction, sort) != sort:
+        rows = rows[::-1]
+    return {'activities': [format_activity(row) for row in rows], 'next': next_cursor}
+
+
+def feed_rows(username: str, friends, n: int, direction: str, key=()):
+    """
+    Retrieves a page of the feed of a user, from their timeline in push mode or from the activities of their friends
+    in pull mode.
+
+    :param friends: list of usernames of the friends of the user, only used in pull mode.
+    :param direction: 'asc' or 'desc' for the first page, 'before' or 'after' for the page next to the key.
+    :param key: the key of the cursor, () for the first page.
+    :return: list of activity rows.
+    """
+    with pool.transaction() as cursor:
+        if FEED_MODE == 'push':
+            pool.execute(cursor, f'feed_{direction}', (username, n, *key))
+        else:
+            pool.execute(cursor, f'friend_activities_{direction}', (friends, username, n, *key))
+        return cursor.fetchall()
 
 
 class Activities(Resource):
     """
     Resource for retrieving the last N activities.
 
-    GET /activities/?n=<n>&sort=<sort_order>
+    GET /activities/?n=<n>&sort=<sort_order>&before=<cursor>&after=<cursor>
     Retrieves the last activities, sorted by time.
 
     Query parameters:
-    - n: The number of activities to retrieve, default is 10.
+    - n: The number of activities to retrieve, default is 10 (at most 100).
     - sort: The sort order (either 'asc' or 'desc'), default is 'desc'.
+    - before (optional): Cursor of an activity, to retrieve the activities that are older than it.
+    - after (optional): Cursor of an activity, to retrieve the activities that are newer than it.
 
     Response:
-    - 200 OK: The activities were retrieved successfully.
+    - 200 OK: The activities were retrieved successfully, with the cursor to continue in the same direction as 'next'
+      (to pass as before after a 'before' or first 'desc' page, as after after an 'after' or first 'asc' page), null
+      if there are no more activities.
+    - 400 Bad Request: n or the cursor was invalid.
     """
 
     def get(self):
         # Parse the request data.
-        n = flask_request.args.get('n', type=int, default=10)
-        sort = flask_request.args.get('sort', type=str, default='desc')
-
-        # If the sort order is invalid set default to 'desc'.
-        if sort not in ['asc', 'desc']:
-            sort = 'desc'
-
-
-        cursor = conn.cursor()
-        # Retrieve the last N activities.
-        cursor.execute("""
-            WITH combined_activities AS (
-                SELECT 'create_playlist' AS activity_type, username, NULL as username_friend, NULL AS song_artist, NULL AS song_title, playlist_id, activity_timestamp
-                FROM activity_create_playlist
-                UNION ALL
-                SELECT 'add_song' AS activity_type, username, NULL as username_friend, song_artist, song_title, playlist_id, activity_timestamp
-                FROM activity_add_song
-                UNION ALL
-                SELECT 'make_friend' AS activity_type, username, username_friend, NULL AS song_artist, NULL AS song_title, NULL AS playlist_id, activity_timestamp
-                FROM activity_make_friend
-                UNION ALL
-                SELECT 'share_playlist' AS activity_type, username, username_friend, NULL AS song_artist, NULL AS song_title, playlist_id, activity_timestamp
-                FROM activity_share_playlist)
-            SELECT *
-            FROM combined_activities
-            ORDER BY activity_timestamp {sort_order}
-            LIMIT {limit};""".format(sort_order=sort.upper(), limit=n))
-
-        activities = [
-            {
-                'activity_type': row[0],
-                'username': row[1],
-                'username_friend': row[2],
-                'song_artist': row[3],
-                'song_title': row[4],
-                'playlist_id': row[5],
-                'timestamp': row[6].strftime('%Y-%m-%d %H:%M:%S'),
-            }
-            for row in cursor.fetchall()
-        ]
-        return {'activities': activities}, 200
+        try:
+            n, sort, direction, key = parse_page(flask_request.args)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        with pool.transaction() as cursor:
+            # Retrieve the last N activities.
+            pool.execute(cursor, f'activities_{direction}', (n, *key))
+            rows = cursor.fetchall()
+
+        return make_page(rows, n, sort, direction), 200
 
 
 class ActivitiesFriends(Resource):
     """
     Resource for retrieving the last N activities of a user's friends.
 
-    GET /activities/<username>?n=<n>&sort=<sort_order>
+    GET /activities/<username>?n=<n>&sort=<sort_order>&before=<cursor>&after=<cursor>
     Retrieves the last N activities of the specified user's friends, sorted by time.
 
+    In push mode, the activities are read from the materialized timeline of the user, which only holds their
+    FEED_TIMELINE_LENGTH most recent activities.
+
+    Pages are cached until an activity that they show is created, or for FEED_CACHE_TTL seconds at most.
+
     Request data:
     - username: The username of the user whose friends' activities to retrieve.
 
     Query parameters:
-    - n: The number of activities to retrieve, default is 10.
+    - n: The number of activities to retrieve, default is 10 (at most 100).
     - sort: The sort order (either 'asc' or 'desc'), default is 'desc'.
+    - before (optional): Cursor of an activity, to retrieve the activities that are older than it.
+    - after (optional): Cursor of an activity, to retrieve the activities that are newer than it.
 
     Response:
-    - 200 OK: The activities were retrieved successfully.
+    - 200 OK: The activities were retrieved successfully, with the cursor to continue in the same direction as 'next'
+      (to pass as before after a 'before' or first 'desc' page, as after after an 'after' or first 'asc' page), null
+      if there are no more activities.
+    - 400 Bad Request: n or the cursor was invalid.
     - 404 Not Found: The specified user does not exist.
     """
 
     def get(self, username: str):
         # Parse the request data.
-        n = flask_request.args.get('n', type=int, default=10)
-        sort = flask_request.args.get('sort', type=str, default='desc')
+        try:
+            n, sort, direction, key = parse_page(flask_request.args)
+        except ValueError as e:
+            return {'message': str(e)}, 400
 
-        # If the sort order is invalid set default to 'desc'.
-        if sort not in ['asc', 'desc']:
-            sort = 'desc'
+        # The key is taken before the feed is queried, such that an activity that is created meanwhile invalidates it.
+        cache_key = feed_cache.key(username, n, sort, direction, key)
+        page = feed_cache.get(cache_key)
+        if page is not None:
+            return page, 200
 
-        # Retrieve friends of user. We don't check if the user exists since
-        # the Friends microservice will do that before returning the friends.
-        response = requests.get(f'{friends_microservice_url}/friends/{username}')
-        if response.status_code == 404:
-            return {'message': 'User does not exist.'}, 404
+        friends = None
+        if FEED_MODE == 'push':
+            # Retrieve the last N activities of the timeline of the user.
+            rows = feed_rows(username, None, n, direction, key)
+            # Users with activities in their timeline certainly exist, otherwise let the Friends microservice check.
+            if not rows and get_friends(username, flask_request.headers.get('Authorization')) is None:
+                return {'message': 'User does not exist.'}, 404
         else:
-            friends = [friend['username'] for friend in response.json()['friends']]
-
-        cursor = conn.cursor()
-        # Retrieve the last N activities of the user's friends.
-        # It doesn't matter if user A or user B added each other as friend, both are seen as an activity, by separate users.
-        # The same goes for sharing playlists.
-        cursor.execute("""
-                    WITH combined_activities AS (
-                        SELECT 'create_playlist' AS activity_type, username, NULL as username_friend, NULL AS song_artist, NULL AS song_title, playlist_id, activity_timestamp
-                        FROM activity_create_playlist
-                        WHERE username IN %s
-                        UNION ALL
-                        SELECT 'add_song' AS activity_type, username, NULL as username_friend, song_artist, song_title, playlist_id, activity_timestamp
-                        FROM activity_add_song
-                        WHERE username IN %s
-                        UNION ALL
-                        SELECT 'make_friend' AS activity_type, username, username_friend, NULL AS song_artist, NULL AS song_title, NULL AS playlist_id, activity_timestamp
-                        FROM activity_make_friend
-                        WHERE (username IN %s AND username_friend != %s) OR (username_friend IN %s AND username != %s)
-                        UNION ALL
-                        SELECT 'share_playlist' AS activity_type, username, username_friend, NULL AS song_artist, NULL AS song_title, playlist_id, activity_timestamp
-                        FROM activity_share_playlist
-                        WHERE (username IN %s AND username_friend != %s) OR (username_friend IN %s AND username != %s))
-                    SELECT *
-                    FROM combined_activities
-                    ORDER BY activity_timestamp {sort_order}
-                    LIMIT {limit};""".format(sort_order=sort.upper(), limit=n),
-                       (tuple(friends), tuple(friends), tuple(friends), username, tuple(friends), username,
-                        tuple(friends), username, tuple(friends), username))
-
-
-        activities = [
-            {
-                'activity_type': row[0],
-                'username': row[1],
-                'username_friend': row[2],
-                'song_artist': row[3],
-                'song_title': row[4],
-                'playlist_id': row[5],
-                'timestamp': row[6].strftime('%Y-%m-%d %H:%M:%S'),
-            }
-            for row in cursor.fetchall()
-        ]
-        return {'activities': activities}, 200
+            # Retrieve friends of user. We don't check if the user exists since
+            # the Friends microservice will do that before returning the friends.
+            # The session token of the user (if any) is forwarded, such that the Friends microservice can skip the
+            # check.
+            friends = get_friends(username, flask_request.headers.get('Authorization'))
+            if friends is None:
+                return {'message': 'User does not exist.'}, 404
+
+            # Retrieve the last N activities of the user's friends.
+            rows = feed_rows(username, friends, n, direction, key)
+
+        page = make_page(rows, n, sort, direction)
+        feed_cache.put(cache_key, page, friends)
+        return page, 200
+
+
+def stream_events(subscription, friends, key):
+    """
+    Generates the server-sent events of a live feed: first the activities after the key (if any) that the watcher
+    missed, then every new activity of the subscription, oldest first.
+
+    Every activity is an 'activity' event with its cursor as id, such that a client that reconnects continues after the
+    last activity it received. When more activities were missed than fit in a page or in the queue of the subscription,
+    a 'reset' event (which also clears the id) tells the client to reload the feed instead.
+    """
+    try:
+        yield 'retry: 3000\n\n'
+        replayed = set()
+        if key:
+            rows = feed_rows(subscription.username, friends, MAX_PAGE_SIZE, 'after', key)
+            if len(rows) == MAX_PAGE_SIZE:
+                yield 'id\nevent: reset\ndata: {}\n\n'
+            else:
+                for row in rows:
+                    yield f'id: {encode_cursor(row)}\nevent: activity\ndata: {json.dumps(format_activity(row))}\n\n'
+                # Activities that were created during the query are also in the queue of the subscription.
+                replayed = {row[7] for row in rows}
+
+        while True:
+            rows, overflowed = subscription.get(STREAM_HEARTBEAT)
+            if overflowed:
+                yield 'id\nevent: reset\ndata: {}\n\n'
+            elif not rows:
+                yield ': heartbeat\n\n'
+            for row in sorted(rows, key=activity_key):
+                if row[7] not in replayed:
+                    yield f'id: {encode_cursor(row)}\nevent: activity\ndata: {json.dumps(format_activity(row))}\n\n'
+    finally:
+        # The client disconnected (or the server is shutting down).
+        broker.unsubscribe(subscription)
+
+
+class ActivitiesStream(Resource):
+    """
+    Resource for following the feed of a user live.
+
+    GET /activities/<username>/stream
+    Keeps the connection open and pushes the new activities of the user's friends as server-sent events.
+
+    An idle watcher costs a subscription in memory and a heartbeat every STREAM_HEARTBEAT seconds, instead of a feed
+    query per poll. Every open stream holds a thread of the (threaded) server.
+
+    Request data:
+    - username: The username of the user whose friends' activities to follow.
+
+    Headers:
+    - Last-Event-ID (optional): Cursor of the last activity received, to first receive the activities that were missed.
+
+    Response:
+    - 200 OK: A text/event-stream of 'activity' events, with the activity as data and its cursor as id, and 'reset'
+      events when the client missed too many activities and should reload the feed.
+    - 400 Bad Request: The Last-Event-ID was invalid.
+    - 404 Not Found: The specified user does not exist.
+    """
+
+    def get(self, username: str):
+        key = ()
+        if flask_request.headers.get('Last-Event-ID'):
+            try:
+                key = decode_cursor(flask_request.headers['Last-Event-ID'])
+            except ValueError as e:
+                return {'message': str(e)}, 400
+
+        friends = get_friends(username, flask_request.headers.get('Authorization'))
+        if friends is None:
+            return {'message': 'User does not exist.'}, 404
+
+        # Subscribe before the missed activities are queried, such that no activity falls in between.
+        subscription = broker.subscribe(username, friends)
+        return Response(stream_events(subscription, friends, key), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+class ActivitiesPoll(Resource):
+    """
+    Resource for long polling the feed of a user, for clients that can't use server-sent events.
+
+    GET /activities/<username>/poll?since=<cursor>&timeout=<timeout>
+    Retrieves the activities of the user's friends that are newer than the cursor, oldest first, and waits for new
+    ones if there are none yet.
+
+    Request data:
+    - username: The username of the user whose friends' activities to retrieve.
+
+    Query parameters:
+    - since (optional): Cursor of the last activity received, to retrieve the activities after it. Without it, only
+      activities that are created while waiting are returned.
+    - timeout (optional): The number of seconds to wait for new activities, default is 25 (at most 60).
+
+    Response:
+    - 200 OK: The activities were retrieved successfully (an empty list if none were created before the timeout), with
+      the cursor to pass as since in the next poll as 'next'.
+    - 400 Bad Request: The cursor or timeout was invalid.
+    - 404 Not Found: The specified user does not exist.
+    """
+
+    def get(self, username: str):
+        # Parse the request data.
+        timeout = flask_request.args.get('timeout', type=float)
+        if 'timeout' in flask_request.args and (timeout is None or timeout < 0):
+            return {'message': 'timeout must be a non-negative number'}, 400
+        timeout = min(DEFAULT_POLL_TIMEOUT if timeout is None else timeout, MAX_POLL_TIMEOUT)
+        since = flask_request.args.get('since')
+        try:
+            key = decode_cursor(since) if since else ()
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        friends = get_friends(username, flask_request.headers.get('Authorization'))
+        if friends is None:
+            return {'message': 'User does not exist.'}, 404
+
+        # Subscribe before the activities are queried, such that no activity falls in between.
+        subscription = broker.subscribe(username, friends)
+        try:
+            rows = feed_rows(username, friends, MAX_PAGE_SIZE, 'after', key) if key else []
+            if not rows:
+                rows, overflowed = subscription.get(timeout)
+                rows = sorted((row for row in rows if not key or activity_key(row) > key), key=activity_key)
+                if overflowed and key:
+                    # Activities were dropped while waiting, retrieve them again.
+                    rows = feed_rows(username, friends, MAX_PAGE_SIZE, 'after', key)
+        finally:
+            broker.unsubscribe(subscription)
+
+        return {'activities': [format_activity(row) for row in rows],
+                'next': encode_cursor(rows[-1]) if rows else since}, 200
+
+
+class ActivitiesHistory(Resource):
+    """
+    Resource for retrieving the archived activities of a user.
+
+    GET /activities/<username>/history?n=<n>&before=<cursor>
+    Retrieves the activities that the specified user performed and that were archived, because they are older than the
+    retention horizon, newest first.
+
+    Request data:
+    - username: The username of the user whose archived activities to retrieve.
+
+    Query parameters:
+    - n: The number of activities to retrieve, default is 10 (at most 100).
+    - before (optional): Cursor of an activity, to retrieve the activities that are older than it.
+
+    Response:
+    - 200 OK: The activities were retrieved successfully, with the cursor to pass as before to continue as 'next', null
+      if there are no more activities.
+    - 400 Bad Request: n or the cursor was invalid.
+    - 404 Not Found: The specified user does not exist.
+    """
+
+    def get(self, username: str):
+        # Parse the request data.
+        try:
+            n, sort, direction, key = parse_page(flask_request.args)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        if direction not in ('desc', 'before'):
+            return {'message': 'The history can only be retrieved newest first'}, 400
+
+        if get_friends(username, flask_request.headers.get('Authorization')) is None:
+            return {'message': 'User does not exist.'}, 404
+
+        rows = archive.history(username, n, key or None)
+        return make_page(rows, n, 'desc', 'desc'), 200
 
 
 class ActivityCreatePlaylist(Resource):
@@ -190,13 +1011,8 @@ class ActivityCreatePlaylist(Resource):
         args = parser.parse_args()
 
         # We don't check if the user or playlist exists since this is already done by the one who sends the request.
-        cursor = conn.cursor()
-        # Create the activity.
-        cursor.execute("""
-            INSERT INTO activity_create_playlist (username, playlist_id, activity_timestamp)
-            VALUES (%s, %s, %s)""",
-                       (args['username'], args['playlist_id'], args['timestamp'] or datetime.datetime.now()))
-        conn.commit()
+        create_activity('create_playlist', args['username'], playlist_id=args['playlist_id'],
+                        timestamp=args['timestamp'])
 
         return {'message': 'Activity created successfully.'}, 201
 
@@ -229,14 +1045,8 @@ class ActivityAddSong(Resource):
         args = parser.parse_args()
 
         # We don't check if the user or song exists since this is already done by the one who sends the request.
-        cursor = conn.cursor()
-        # Create the activity.
-        cursor.execute("""
-            INSERT INTO activity_add_song (username, song_artist, song_title, playlist_id, activity_timestamp)
-            VALUES (%s, %s, %s, %s, %s)""",
-                       (args['username'], args['song_artist'], args['song_title'], args['playlist_id'],
-                        args['timestamp'] or datetime.datetime.now()))
-        conn.commit()
+        create_activity('add_song', args['username'], song_artist=args['song_artist'], song_title=args['song_title'],
+                        playlist_id=args['playlist_id'], timestamp=args['timestamp'])
 
         return {'message': 'Activity created successfully.'}, 201
 
@@ -265,13 +1075,7 @@ class ActivityMakeFriend(Resource):
         args = parser.parse_args()
 
         # We don't check if the user or friend exists since this is already done by the one who sends the request.
-        cursor = conn.cursor()
-        # Create the activity.
-        cursor.execute("""
-            INSERT INTO activity_make_friend (username, username_friend, activity_timestamp)
-            VALUES (%s, %s, %s)""",
-                       (args['username'], args['username_friend'], args['timestamp'] or datetime.datetime.now()))
-        conn.commit()
+        create_activity('make_friend', args['username'], args['username_friend'], timestamp=args['timestamp'])
 
         return {'message': 'Activity created successfully.'}, 201
 
@@ -302,23 +1106,126 @@ class ActivitySharePlaylist(Resource):
         args = parser.parse_args()
 
         # We don't check if the user, friend or playlist_id exists since this is already done by the one who sends the request.
-        cursor = conn.cursor()
-        # Create the activity.
-        cursor.execute("""
-            INSERT INTO activity_share_playlist (username, username_friend, playlist_id, activity_timestamp)
-            VALUES (%s, %s, %s, %s)""",
-                       (args['username'], args['username_friend'], args['playlist_id'],
-                        args['timestamp'] or datetime.datetime.now()))
-        conn.commit()
+        create_activity('share_playlist', args['username'], args['username_friend'], playlist_id=args['playlist_id'],
+                        timestamp=args['timestamp'])
 
         return {'message': 'Activity created successfully.'}, 201
 
 
+class ActivitiesBatch(Resource):
+    """
+    POST /activities/batch
+    Creates many activities of any type at once, in a single transaction.
+
+    Request data:
+    - activities: A list of at most 10000 activities, each with an activity_type ('create_playlist', 'add_song',
+      'make_friend' or 'share_playlist'), the fields of the endpoint of that type, and optionally a timestamp and an
+      idempotency_key. An activity with an idempotency key that was used before is not created again.
+
+    Response:
+    - 201 Created: The activities were created successfully, as {'created': number of activities, 'duplicates':
+      number of activities skipped because of their idempotency key}.
+    - 400 Bad Request: The activities were missing, exceeded the batch size, or one of them was invalid. In that case,
+      none of the activities were created.
+    """
+
+    def post(self):
+        # Parse the request data.
+        data = flask_request.get_json(silent=True) or {}
+        activities = data.get('activities')
+        if not isinstance(activities, list):
+            return {'message': 'Missing request data: activities'}, 400
+        if len(activities) > MAX_ACTIVITIES_BATCH:
+            return {'message': f'At most {MAX_ACTIVITIES_BATCH} activities can be created at once'}, 400
+
+        # Validate every activity before anything is inserted.
+        now = datetime.datetime.now()
+        rows, keys = [], []
+        for index, activity in enumerate(activities):
+            try:
+                row, key = parse_activity(activity, now)
+            except ValueError as e:
+                return {'message': f'Invalid activity {index}: {e}'}, 400
+            rows.append(row)
+            keys.append(key)
+
+        # We don't check if the users, songs or playlists exist since this is already done by the one who sends the
+        # request.
+        try:
+            created = create_activities(rows, keys)
+        except psycopg2.DataError:
+            # E.g. a timestamp that can't be parsed, or a value that is too long.
+            return {'message': 'Invalid activity data'}, 400
+        return {'message': 'Activities created successfully.', 'created': len(created),
+                'duplicates': len(rows) - len(created)}, 201
+
+
+class TrendingActivities(Resource):
+    """
+    Resource for retrieving the most added songs and most active users.
+
+    GET /activities/trending?window=<window>
+    Retrieves the 10 most added songs and the 10 users with the most activities over the last hour, day and week, as
+    of at most TRENDING_REFRESH seconds ago.
+
+    Query parameters:
+    - window (optional): '1h', '24h' or '7d', to only retrieve the top of that window.
+
+    Response:
+    - 200 OK: The top songs and users of every window were retrieved successfully, with the time they were ranked.
+    - 400 Bad Request: The window was invalid.
+    """
+
+    def get(self):
+        snapshot = trending.snapshot()
+        window = flask_request.args.get('window')
+        if window is None:
+            return snapshot, 200
+        if window not in snapshot['windows']:
+            return {'message': f'window must be one of {", ".join(Trending.WINDOWS)}'}, 400
+        return {'windows': {window: snapshot['windows'][window]}, 'updated': snapshot['updated']}, 200
+
+
+class FeedCacheStats(Resource):
+    """
+    GET /activities/cache/stats
+    Retrieves the number of hits, misses and invalidations of the feed cache, its hit ratio and number of cached pages,
+    and the number of live feed subscriptions and of published and delivered activities.
+    """
+
+    def get(self):
+        return {**feed_cache.metrics(), 'live': broker.metrics()}, 200
+
+
+class DatabaseMetrics(Resource):
+    """
+    GET /activities/db/metrics
+    Retrieves the size and usage counters of the database connection pool, and the number of calls and latency of
+    every prepared statement (most total time first).
+    """
+
+    def get(self):
+        return {**pool.metrics(), 'statements': pool.statement_metrics()}, 200
+
+
 # Add the resources to the API.
 api.add_resource(Activities, '/activities')
 api.add_resource(ActivitiesFriends, '/activities/<username>')
+api.add_resource(ActivitiesStream, '/activities/<username>/stream')
+api.add_resource(ActivitiesPoll, '/activities/<username>/poll')
+api.add_resource(ActivitiesHistory, '/activities/<username>/history')
 # Resources for adding a new activity.
 api.add_resource(ActivityCreatePlaylist, '/activities/create-playlist')
 api.add_resource(ActivityAddSong, '/activities/add-song')
 api.add_resource(ActivityMakeFriend, '/activities/make-friend')
 api.add_resource(ActivitySharePlaylist, '/activities/share-playlist')
+api.add_resource(ActivitiesBatch, '/activities/batch')
+api.add_resource(TrendingActivities, '/activities/trending')
+api.add_resource(FeedCacheStats, '/activities/cache/stats')
+api.add_resource(DatabaseMetrics, '/activities/db/metrics')
+
+
+if __name__ == '__main__':
+    start_background_jobs()
+    # The reloader would run the module, and so the background jobs, in a second process.
+    app.run(host='0.0.0.0', use_reloader=False)
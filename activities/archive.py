@@ -0,0 +1,199 @@
+import bisect
+import datetime
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+# The columns of an archived activity, in the format of the feed queries.
+COLUMNS = ('activity_type', 'username', 'username_friend', 'song_artist', 'song_title', 'playlist_id',
+           'activity_timestamp', 'id')
+MAGIC = b'ACTARCH1'
+FOOTER = struct.Struct('<Q')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def activity_key(row):
+    return row[6], row[0], row[7]
+
+
+def encode_timestamps(timestamps):
+    # Microseconds since the epoch, as deltas: the activities of a user are stored in order, so the deltas are small.
+    micros = [(timestamp - EPOCH) // datetime.timedelta(microseconds=1) for timestamp in timestamps]
+    return [micros[0]] + [b - a for a, b in zip(micros, micros[1:])] if micros else []
+
+
+def decode_timestamps(deltas):
+    timestamps, micros = [], 0
+    for delta in deltas:
+        micros += delta
+        timestamps.append(EPOCH + datetime.timedelta(microseconds=micros))
+    return timestamps
+
+
+def write_archive_file(path: str, rows, group_size: int):
+    """
+    Writes activities to a columnar archive file, replacing it atomically.
+
+    The activities are sorted by user and time, and stored in row groups of `group_size` activities. Every column of
+    a group is a separately compressed block, such that a read only decompresses the columns of the groups of a single
+    user. The header with the offsets of the blocks and the username range of every group is at the end of the file,
+    followed by its length and the magic bytes.
+    """
+    rows = sorted(rows, key=lambda row: (row[1], *activity_key(row)))
+    groups = []
+    with open(path + '.tmp', 'wb') as file:
+        file.write(MAGIC)
+        for start in range(0, len(rows), group_size):
+            group = rows[start:start + group_size]
+            columns = {}
+            for index, name in enumerate(COLUMNS):
+                values = [row[index] for row in group]
+                if name == 'activity_timestamp':
+                    values = encode_timestamps(values)
+                block = zlib.compress(json.dumps(values, separators=(',', ':')).encode())
+                columns[name] = (file.tell(), len(block))
+                file.write(block)
+            groups.append({'rows': len(group), 'first': group[0][1], 'last': group[-1][1], 'columns': columns})
+        header = json.dumps({'rows': len(rows), 'groups': groups}).encode()
+        file.write(header)
+        file.write(FOOTER.pack(len(header)))
+        file.write(MAGIC)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class ArchiveFile:
+    """
+    Read-only, memory-mapped columnar archive file (see write_archive_file), of which only the blocks that are read
+    are paged in.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(self._map) - len(MAGIC)
+        if self._map[:len(MAGIC)] != MAGIC or self._map[end:] != MAGIC:
+            raise ValueError(f'{path} is not an activity archive')
+        (length,) = FOOTER.unpack(self._map[end - FOOTER.size:end])
+        header = json.loads(self._map[end - FOOTER.size - length:end - FOOTER.size])
+        self.rows = header['rows']
+        self._groups = header['groups']
+        self._lasts = [group['last'] for group in self._groups]
+
+    def __len__(self):
+        return self.rows
+
+    def _read_group(self, group):
+        columns = []
+        for name in COLUMNS:
+            offset, length = group['columns'][name]
+            values = json.loads(zlib.decompress(self._map[offset:offset + length]))
+            columns.append(decode_timestamps(values) if name == 'activity_timestamp' else values)
+        return list(zip(*columns))
+
+    def read_all(self):
+        """
+        :return: list of all archived activity rows, sorted by user and time.
+        """
+        return [row for group in self._groups for row in self._read_group(group)]
+
+    def history(self, username: str):
+        """
+        :return: list of the archived activity rows of a user, oldest first.
+        """
+        rows = []
+        # The groups are sorted by user, so the activities of a user are in consecutive groups.
+        for group in self._groups[bisect.bisect_left(self._lasts, username):]:
+            if group['first'] > username:
+                break
+            rows.extend(row for row in self._read_group(group) if row[1] == username)
+        return rows
+
+
+class Archive:
+    """
+    Cold archive of activities on local disk, with a columnar file per month (activities-YYYY-MM.col).
+
+    Files are opened (memory-mapped) on first use and kept open, until they are replaced by a new version.
+    """
+
+    FILENAME = re.compile(r'activities-(\d{4})-(\d{2})\.col')
+
+    def __init__(self, directory: str, group_size: int = 4096):
+        """
+        :param directory: directory of the archive files, which is created when the first month is archived.
+        :param group_size: number of activities per row group in a file.
+        """
+        self.directory = directory
+        self.group_size = group_size
+        self._files = {}  # Path -> ((inode, mtime) of the file when it was opened, ArchiveFile).
+        self._lock = threading.Lock()
+
+    def path(self, month: datetime.date):
+        return os.path.join(self.directory, f'activities-{month:%Y-%m}.col')
+
+    def months(self):
+        """
+        :return: list of the first days of the archived months, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        months = [self.FILENAME.fullmatch(name) for name in os.listdir(self.directory)]
+        return sorted(datetime.date(int(match[1]), int(match[2]), 1) for match in months if match)
+
+    def open(self, month: datetime.date):
+        """
+        :return: the archive file of a month, None if the month is not archived.
+        """
+        path = self.path(month)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is None or cached[0] != version:
+                # The previous version is unmapped once the readers that still use it are done.
+                cached = self._files[path] = (version, ArchiveFile(path))
+            return cached[1]
+
+    def write(self, month: datetime.date, rows):
+        """
+        Archives activities of a month, in addition to the activities of the month that were archived before.
+
+        :param rows: list of activity rows, in the format of the feed queries.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        existing = self.open(month)
+        if existing is not None:
+            # Activities that were archived before are replaced by the new version of the row.
+            ids = {row[7] for row in rows}
+            rows = [row for row in existing.read_all() if row[7] not in ids] + list(rows)
+        write_archive_file(self.path(month), rows, self.group_size)
+
+    def history(self, username: str, n: int, before=None):
+        """
+        Retrieves the archived activities of a user, newest first.
+
+        :param n: maximum number of activities.
+        :param before: key (activity_timestamp, activity_type, id) to only retrieve older activities, if given.
+        :return: list of activity rows.
+        """
+        rows = []
+        for month in reversed(self.months()):
+            if before is not None and month > before[0].date():
+                continue
+            file = self.open(month)
+            if file is None:
+                continue
+            rows.extend(row for row in reversed(file.history(username))
+                        if before is None or activity_key(row) < before)
+            if len(rows) >= n:
+                break
+        return rows[:n]
@@ -0,0 +1,133 @@
+import itertools
+import threading
+
+from common.cache import LRUCache
+
+
+class FeedCache:
+    """
+    Bounded cache of feed pages, per user and query (n, sort, cursor).
+
+    Every user has a generation that is part of the keys of their pages. Invalidating the feed of a user bumps it,
+    which makes all their cached pages unreachable at once; those are evicted by the LRU order later on. A page is
+    keyed on the generation from before it was queried, such that a page that raced with an invalidation is never
+    served afterwards.
+
+    Pages built from the friends of a user register the user as a watcher of each friend, such that the feeds that
+    show an activity of a user can be invalidated without asking the Friends microservice who their friends are.
+
+    All state is bounded by the number of cached pages: the generations are kept in an LRU cache of their own, and the
+    watchers of a user are unregistered when the last of their pages is evicted.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        :param maxsize: maximum number of cached pages.
+        :param ttl: number of seconds a page is cached, which bounds how stale a page can be when an invalidation is
+                    missed, e.g. because another process received the activity.
+        """
+        self._pages = LRUCache(maxsize, ttl, on_evict=self._evicted)
+        # Reentrant, since putting a page may evict another one, whose callback runs in the same thread.
+        self._lock = threading.RLock()
+        # Username -> generation of their feed. Generations are never reused, so a user whose generation was evicted
+        # gets a new one, which none of their cached pages has.
+        self._generations = LRUCache(maxsize, ttl)
+        self._counter = itertools.count()
+        self._cached = {}  # Username -> (set of the keys of their cached pages, set of the friends they watch).
+        self._watchers = {}  # Username -> set of usernames with a cached feed that shows their activities.
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    def key(self, username: str, *params):
+        """
+        :return: the key of a page of the feed of a user, which has to be taken before the page is queried.
+        """
+        with self._lock:
+            generation = self._generations.get(username)
+            if generation is None:
+                generation = next(self._counter)
+                self._generations.put(username, generation)
+            return username, generation, params
+
+    def get(self, key):
+        """
+        :return: the cached page, or None if it is not cached.
+        """
+        return self._pages.get(key)
+
+    def put(self, key, page, friends=None):
+        """
+        Caches a page of the feed of a user, unless their feed was invalidated since the key was taken.
+
+        :param friends: the friends whose activities the page was built from, if known.
+        """
+        username, generation, _ = key
+        with self._lock:
+            if self._generations.get(username) != generation:
+                return
+            # The generation is kept for at least as long as the page.
+            self._generations.put(username, generation)
+            keys, watching = self._cached.setdefault(username, (set(), set()))
+            keys.add(key)
+            for friend in friends or ():
+                watching.add(friend)
+                self._watchers.setdefault(friend, set()).add(username)
+            self._pages.put(key, page)
+
+    def _evicted(self, key, page):
+        """
+        Unregisters a page that left the cache, and the user as a watcher once none of their pages are left.
+        """
+        username = key[0]
+        with self._lock:
+            cached = self._cached.get(username)
+            if cached is None:
+                return
+            keys, watching = cached
+            keys.discard(key)
+            if keys:
+                return
+            del self._cached[username]
+            for friend in watching:
+                watchers = self._watchers.get(friend)
+                if watchers is not None:
+                    watchers.discard(username)
+                    if not watchers:
+                        del self._watchers[friend]
+
+    def invalidate(self, usernames):
+        """
+        Invalidates every cached page of the feeds of the given users.
+        """
+        with self._lock:
+            for username in usernames:
+                # Users without a generation have no reachable pages, and get a new generation on their next key.
+                if self._generations.get(username) is not None:
+                    self._generations.put(username, next(self._counter))
+                self.invalidations += 1
+
+    def invalidate_watchers(self, usernames):
+        """
+        Invalidates the cached feeds that show the activities of the given users.
+        """
+        with self._lock:
+            watchers = set()
+            for username in usernames:
+                watchers |= self._watchers.pop(username, set())
+        self.invalidate(watchers)
+
+    def metrics(self):
+        """
+        :return: dictionary with the number of hits, misses, invalidations and cached pages, and the hit ratio.
+        """
+        hits, misses = self._pages.hits, self._pages.misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            'invalidations': self.invalidations,
+            'size': len(self._pages),
+            'users': len(self._cached),
+        }
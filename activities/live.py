@@ -0,0 +1,129 @@
+import collections
+import threading
+
+
+class Subscription:
+    """
+    Bounded queue of the new activities for a single watcher of a feed.
+
+    When the watcher falls behind by more than `maxsize` activities, the oldest ones are dropped and the subscription
+    is marked as overflowed, such that the watcher can catch up from the database instead.
+    """
+
+    def __init__(self, username: str, friends, maxsize: int):
+        self.username = username
+        self.friends = set(friends)
+        self.overflowed = False
+        self._queue = collections.deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+
+    def put(self, row):
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.overflowed = True
+            self._queue.append(row)
+            self._cond.notify()
+
+    def get(self, timeout: float):
+        """
+        Waits for new activities.
+
+        :param timeout: maximum number of seconds to wait.
+        :return: tuple of the list of the activity rows that were queued (empty if none arrived within the timeout),
+                 and whether activities were dropped since the previous call.
+        """
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(timeout)
+            rows, overflowed = list(self._queue), self.overflowed
+            self._queue.clear()
+            self.overflowed = False
+            return rows, overflowed
+
+
+class Broker:
+    """
+    In-process publish/subscribe of new activities to the watchers of feeds.
+
+    Every subscription is indexed on the friends of its watcher, such that publishing an activity only touches the
+    subscriptions that show it, and an idle watcher costs nothing but its entry in the index. An activity of a user,
+    optionally involving a friend (e.g. make_friend), is delivered to the watchers that are friends with either user,
+    except to the users themselves.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        """
+        :param queue_size: maximum number of undelivered activities per subscription.
+        """
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # Username -> set of subscriptions that watch their activities.
+        self._watchers = {}  # Username -> set of subscriptions to their own feed.
+        self.published = 0
+        self.delivered = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._watchers.values())
+
+    def subscribe(self, username: str, friends):
+        """
+        Subscribes to the activities shown in the feed of a user.
+
+        :param friends: the usernames of the friends of the user.
+        :return: the subscription, which has to be passed to unsubscribe() once the watcher is gone.
+        """
+        subscription = Subscription(username, friends, self.queue_size)
+        with self._lock:
+            self._watchers.setdefault(username, set()).add(subscription)
+            for friend in subscription.friends:
+                self._subscriptions.setdefault(friend, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._discard(self._watchers, subscription.username, subscription)
+            for friend in subscription.friends:
+                self._discard(self._subscriptions, friend, subscription)
+
+    @staticmethod
+    def _discard(index, username, subscription):
+        subscriptions = index.get(username)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[username]
+
+    def publish(self, rows):
+        """
+        Delivers new activities to the subscriptions that show them.
+
+        :param rows: list of activity rows, which start with (activity_type, username, username_friend).
+        """
+        with self._lock:
+            for row in rows:
+                activity_type, username, username_friend = row[:3]
+                users = {username, username_friend} - {None}
+                subscriptions = set()
+                for user in users:
+                    subscriptions |= self._subscriptions.get(user, set())
+                self.published += 1
+                for subscription in subscriptions:
+                    if subscription.username not in users:
+                        subscription.put(row)
+                        self.delivered += 1
+
+                # The watchers of the new friends now see the activities of each other.
+                if activity_type == 'make_friend':
+                    for user, friend in ((username, username_friend), (username_friend, username)):
+                        for subscription in self._watchers.get(user, ()):
+                            subscription.friends.add(friend)
+                            self._subscriptions.setdefault(friend, set()).add(subscription)
+
+    def metrics(self):
+        """
+        :return: dictionary with the number of subscriptions, and of published and delivered activities.
+        """
+        subscriptions = len(self)
+        with self._lock:
+            return {'subscriptions': subscriptions, 'published': self.published, 'delivered': self.delivered}
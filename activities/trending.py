@@ -0,0 +1,141 @@
+import collections
+import datetime
+import heapq
+import operator
+import threading
+import time
+
+
+class SlidingCounter:
+    """
+    Exact counts of keys over a sliding window of time, kept in fixed buckets.
+
+    The window slides per bucket: a count is forgotten once its bucket is older than the window, so the totals cover
+    between `window` and `window` plus one bucket of time.
+    """
+
+    def __init__(self, window: float, buckets: int):
+        """
+        :param window: length of the window in seconds.
+        :param buckets: number of buckets the window is divided in.
+        """
+        self.bucket_size = window / buckets
+        self.buckets = buckets
+        self._buckets = {}  # Index of the bucket -> Counter of the keys in it.
+        self._totals = collections.Counter()
+
+    def __len__(self):
+        return len(self._totals)
+
+    def add(self, key, timestamp: float, now: float, count: int = 1):
+        """
+        Counts a key at a time, unless it is already outside of the window.
+
+        :param timestamp: the time of the occurrence, in seconds since the epoch. Times in the future count as now.
+        :param now: the current time, in seconds since the epoch.
+        """
+        current = int(now // self.bucket_size)
+        index = min(int(timestamp // self.bucket_size), current)
+        if index < current - self.buckets:
+            return
+        self._buckets.setdefault(index, collections.Counter())[key] += count
+        self._totals[key] += count
+
+    def expire(self, now: float):
+        """
+        Forgets the buckets that ended more than a window ago.
+        """
+        horizon = int(now // self.bucket_size) - self.buckets
+        for index in [index for index in self._buckets if index < horizon]:
+            for key, count in self._buckets.pop(index).items():
+                total = self._totals[key] - count
+                if total:
+                    self._totals[key] = total
+                else:
+                    del self._totals[key]
+
+    def top(self, k: int):
+        """
+        :return: list of the (key, count) of the k most counted keys, most counted first.
+        """
+        return heapq.nlargest(k, self._totals.items(), key=operator.itemgetter(1))
+
+
+class Trending:
+    """
+    Most added songs and most active users over sliding windows of the last hour, day and week.
+
+    Activities are counted as they are created. A background thread periodically expires the counts and ranks the top
+    of every window into a snapshot, such that reading the trending songs and users is constant time, at the cost of
+    being up to one refresh interval behind.
+    """
+
+    # Name of the window -> (length in seconds, number of buckets).
+    WINDOWS = {
+        '1h': (60 * 60, 60),
+        '24h': (24 * 60 * 60, 96),
+        '7d': (7 * 24 * 60 * 60, 168),
+    }
+
+    def __init__(self, size: int = 10):
+        """
+        :param size: number of songs and users in the top of every window.
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._counters = {window: {'songs': SlidingCounter(*self.WINDOWS[window]),
+                                   'users': SlidingCounter(*self.WINDOWS[window])}
+                          for window in self.WINDOWS}
+        self._snapshot = {'windows': {window: {'songs': [], 'users': []} for window in self.WINDOWS}, 'updated': None}
+
+    def add(self, rows):
+        """
+        Counts new activities: every activity for its user, and every add_song activity for its song.
+
+        :param rows: list of activity rows, in the format of the feed queries.
+        """
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                timestamp = row[6].timestamp()
+                for counters in self._counters.values():
+                    counters['users'].add(row[1], timestamp, now)
+                    if row[0] == 'add_song':
+                        counters['songs'].add((row[3], row[4]), timestamp, now)
+
+    def add_count(self, kind: str, key, timestamp: datetime.datetime, count: int):
+        """
+        Counts a number of occurrences of a song or user at once, e.g. when the counts are rebuilt from the database.
+
+        :param kind: 'songs' or 'users'.
+        :param key: (song_artist, song_title) of a song, or the username of a user.
+        """
+        now = time.time()
+        with self._lock:
+            for counters in self._counters.values():
+                counters[kind].add(key, timestamp.timestamp(), now, count)
+
+    def refresh(self):
+        """
+        Slides the windows to the current time and ranks the top songs and users of every window into the snapshot.
+        """
+        now = time.time()
+        windows = {}
+        with self._lock:
+            for window, counters in self._counters.items():
+                for counter in counters.values():
+                    counter.expire(now)
+                windows[window] = {
+                    'songs': [{'song_artist': artist, 'song_title': title, 'count': count}
+                              for (artist, title), count in counters['songs'].top(self.size)],
+                    'users': [{'username': username, 'count': count}
+                              for username, count in counters['users'].top(self.size)],
+                }
+        self._snapshot = {'windows': windows,
+                          'updated': datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')}
+
+    def snapshot(self):
+        """
+        :return: dictionary with the top songs and users of every window, as of the last refresh.
+        """
+        return self._snapshot
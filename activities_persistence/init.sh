@@ -7,35 +7,99 @@ EOSQL
 
 # Connect to the new database and create the tables.
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "activities" <<-EOSQL
-    CREATE TABLE IF NOT EXISTS activity_create_playlist (
-      id SERIAL PRIMARY KEY,
+    -- Every activity in a single table, partitioned by month, such that a feed only has to look at the most recent
+    -- partitions. The columns that don't apply to the type of an activity are NULL.
+    CREATE TABLE IF NOT EXISTS activities (
+      id BIGINT GENERATED ALWAYS AS IDENTITY,
+      activity_type VARCHAR(32) NOT NULL
+        CHECK (activity_type IN ('create_playlist', 'add_song', 'make_friend', 'share_playlist')),
       username VARCHAR(255) NOT NULL,
-      playlist_id INTEGER NOT NULL,
-      activity_timestamp TIMESTAMP DEFAULT NOW()
-    );
+      username_friend VARCHAR(255),
+      song_artist VARCHAR(255),
+      song_title VARCHAR(255),
+      playlist_id INTEGER,
+      activity_timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
+      PRIMARY KEY (id, activity_timestamp)
+    ) PARTITION BY RANGE (activity_timestamp);
 
-    CREATE TABLE IF NOT EXISTS activity_add_song (
-      id SERIAL PRIMARY KEY,
-      username VARCHAR(255) NOT NULL,
-      song_artist VARCHAR(255) NOT NULL,
-      song_title VARCHAR(255) NOT NULL,
-      playlist_id INTEGER NOT NULL,
-      activity_timestamp TIMESTAMP DEFAULT NOW()
+    -- Activities of a month without a partition (e.g. with a timestamp far in the past) end up here.
+    CREATE TABLE IF NOT EXISTS activities_default PARTITION OF activities DEFAULT;
+
+    -- Feeds are paginated on (activity_timestamp, activity_type, id).
+    CREATE INDEX IF NOT EXISTS activities_timestamp ON activities (activity_timestamp, activity_type, id);
+    CREATE INDEX IF NOT EXISTS activities_username_timestamp
+      ON activities (username, activity_timestamp DESC, activity_type DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS activities_username_friend_timestamp
+      ON activities (username_friend, activity_timestamp DESC, activity_type DESC, id DESC)
+      WHERE username_friend IS NOT NULL;
+
+    -- Creates the monthly partitions from the month of first_month up to and including the month of last_month.
+    -- The Activities service calls it on startup and daily afterwards, for the coming months.
+    CREATE OR REPLACE FUNCTION create_activity_partitions(first_month DATE, last_month DATE) RETURNS VOID AS \$\$
+    DECLARE
+      month DATE := date_trunc('month', first_month);
+      partition_name TEXT;
+      moved BIGINT;
+    BEGIN
+      WHILE month <= last_month LOOP
+        partition_name := 'activities_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+          -- Activities of the month in the default partition (e.g. with a timestamp in the future) would make
+          -- creating the partition fail, so it is created on its own, the activities are moved into it, and it is
+          -- attached afterwards.
+          EXECUTE format('CREATE TABLE %I (LIKE activities INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+          LOCK TABLE activities_default IN EXCLUSIVE MODE;
+          EXECUTE format('WITH moved AS (DELETE FROM activities_default '
+                         'WHERE activity_timestamp >= %L AND activity_timestamp < %L RETURNING *) '
+                         'INSERT INTO %I SELECT * FROM moved',
+                         month, month + INTERVAL '1 month', partition_name);
+          GET DIAGNOSTICS moved = ROW_COUNT;
+          IF moved > 0 THEN
+            RAISE NOTICE 'Moved % activities from the default partition to %', moved, partition_name;
+          END IF;
+          EXECUTE format('ALTER TABLE activities ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                         partition_name, month, month + INTERVAL '1 month');
+        END IF;
+        month := month + INTERVAL '1 month';
+      END LOOP;
+    END
+    \$\$ LANGUAGE plpgsql;
+
+    SELECT create_activity_partitions(NOW()::DATE, (NOW() + INTERVAL '3 months')::DATE);
+
+    -- Idempotency keys of the activities that were created through POST /activities/batch, such that an activity
+    -- that is sent again by an outbox is only created once.
+    CREATE TABLE IF NOT EXISTS activity_keys (
+      idempotency_key VARCHAR(255) PRIMARY KEY,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
     );
+    -- The keys expire after ACTIVITY_KEY_TTL_DAYS, the Activities service deletes them daily.
+    CREATE INDEX IF NOT EXISTS activity_keys_created_at ON activity_keys (created_at);
 
-    CREATE TABLE IF NOT EXISTS activity_make_friend (
-      id SERIAL PRIMARY KEY,
+    -- Number of activities per user, day and type, of the activities that were moved to the archive because they are
+    -- older than the retention horizon.
+    CREATE TABLE IF NOT EXISTS activity_rollups (
       username VARCHAR(255) NOT NULL,
-      username_friend VARCHAR(255) NOT NULL,
-      activity_timestamp TIMESTAMP DEFAULT NOW()
+      day DATE NOT NULL,
+      activity_type VARCHAR(32) NOT NULL,
+      count INTEGER NOT NULL,
+      PRIMARY KEY (username, day, activity_type)
     );
 
-    CREATE TABLE IF NOT EXISTS activity_share_playlist (
-      id SERIAL PRIMARY KEY,
+    -- Materialized feed timelines: every activity copied to the users whose feed shows it (FEED_MODE=push), such that
+    -- a feed is a single range scan on (owner, activity_timestamp DESC).
+    CREATE TABLE IF NOT EXISTS feed_entries (
+      owner VARCHAR(255) NOT NULL,
+      activity_type VARCHAR(32) NOT NULL,
       username VARCHAR(255) NOT NULL,
-      username_friend VARCHAR(255) NOT NULL,
-      playlist_id INTEGER NOT NULL,
-      activity_timestamp TIMESTAMP DEFAULT NOW()
+      username_friend VARCHAR(255),
+      song_artist VARCHAR(255),
+      song_title VARCHAR(255),
+      playlist_id INTEGER,
+      activity_timestamp TIMESTAMP NOT NULL,
+      activity_id BIGINT NOT NULL
     );
+    CREATE INDEX IF NOT EXISTS feed_entries_owner_timestamp
+      ON feed_entries (owner, activity_timestamp DESC, activity_type DESC, activity_id DESC);
 
-EOSQL
\ No newline at end of file
+EOSQL
@@ -0,0 +1,16 @@
+-- Adds the materialized feed timelines to an activities database that was initialised before they existed.
+-- Afterwards, fill them with: docker compose exec activities python3 -m flask backfill-feeds
+-- Run with: psql --username postgres --dbname activities -f 001_feed_entries.sql
+BEGIN;
+CREATE TABLE IF NOT EXISTS feed_entries (
+  owner VARCHAR(255) NOT NULL,
+  activity_type VARCHAR(32) NOT NULL,
+  username VARCHAR(255) NOT NULL,
+  username_friend VARCHAR(255),
+  song_artist VARCHAR(255),
+  song_title VARCHAR(255),
+  playlist_id INTEGER,
+  activity_timestamp TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feed_entries_owner_timestamp ON feed_entries (owner, activity_timestamp DESC);
+COMMIT;
@@ -0,0 +1,16 @@
+-- Adds the indexes used to paginate the feeds on (activity_timestamp, activity_type, id) to an existing activities
+-- database. The materialized timelines now store the id of every activity; they are derived data, so they are emptied
+-- and have to be filled again with: docker compose exec activities python3 -m flask backfill-feeds
+-- Run with: psql --username postgres --dbname activities -f 002_feed_keyset.sql
+BEGIN;
+CREATE INDEX IF NOT EXISTS activity_create_playlist_timestamp ON activity_create_playlist (activity_timestamp, id);
+CREATE INDEX IF NOT EXISTS activity_add_song_timestamp ON activity_add_song (activity_timestamp, id);
+CREATE INDEX IF NOT EXISTS activity_make_friend_timestamp ON activity_make_friend (activity_timestamp, id);
+CREATE INDEX IF NOT EXISTS activity_share_playlist_timestamp ON activity_share_playlist (activity_timestamp, id);
+
+TRUNCATE feed_entries;
+ALTER TABLE feed_entries ADD COLUMN activity_id INTEGER NOT NULL;
+DROP INDEX IF EXISTS feed_entries_owner_timestamp;
+CREATE INDEX feed_entries_owner_timestamp
+  ON feed_entries (owner, activity_timestamp DESC, activity_type DESC, activity_id DESC);
+COMMIT;
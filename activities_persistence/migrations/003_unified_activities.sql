@@ -0,0 +1,87 @@
+-- Moves the activities of the four activity tables (activity_create_playlist, activity_add_song, activity_make_friend
+-- and activity_share_playlist) into the single activities table, partitioned by month, and drops the old tables.
+-- Activities get a new id, so the materialized timelines are emptied and have to be filled again with:
+-- docker compose exec activities python3 -m flask backfill-feeds
+-- Run with: psql --username postgres --dbname activities -f 003_unified_activities.sql
+BEGIN;
+CREATE TABLE activities (
+  id BIGINT GENERATED ALWAYS AS IDENTITY,
+  activity_type VARCHAR(32) NOT NULL
+    CHECK (activity_type IN ('create_playlist', 'add_song', 'make_friend', 'share_playlist')),
+  username VARCHAR(255) NOT NULL,
+  username_friend VARCHAR(255),
+  song_artist VARCHAR(255),
+  song_title VARCHAR(255),
+  playlist_id INTEGER,
+  activity_timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (id, activity_timestamp)
+) PARTITION BY RANGE (activity_timestamp);
+CREATE TABLE activities_default PARTITION OF activities DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_activity_partitions(first_month DATE, last_month DATE) RETURNS VOID AS $$
+DECLARE
+  month DATE := date_trunc('month', first_month);
+  partition_name TEXT;
+  moved BIGINT;
+BEGIN
+  WHILE month <= last_month LOOP
+    partition_name := 'activities_' || to_char(month, 'YYYY_MM');
+    IF to_regclass(partition_name) IS NULL THEN
+      -- Activities of the month in the default partition (e.g. with a timestamp in the future) would make
+      -- creating the partition fail, so it is created on its own, the activities are moved into it, and it is
+      -- attached afterwards.
+      EXECUTE format('CREATE TABLE %I (LIKE activities INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+      LOCK TABLE activities_default IN EXCLUSIVE MODE;
+      EXECUTE format('WITH moved AS (DELETE FROM activities_default '
+                     'WHERE activity_timestamp >= %L AND activity_timestamp < %L RETURNING *) '
+                     'INSERT INTO %I SELECT * FROM moved',
+                     month, month + INTERVAL '1 month', partition_name);
+      GET DIAGNOSTICS moved = ROW_COUNT;
+      IF moved > 0 THEN
+        RAISE NOTICE 'Moved % activities from the default partition to %', moved, partition_name;
+      END IF;
+      EXECUTE format('ALTER TABLE activities ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                     partition_name, month, month + INTERVAL '1 month');
+    END IF;
+    month := month + INTERVAL '1 month';
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+-- Partitions for every month with activities, up to the coming months.
+CREATE TEMPORARY TABLE old_activities ON COMMIT DROP AS
+  SELECT 'create_playlist' AS activity_type, username, NULL::VARCHAR AS username_friend, NULL::VARCHAR AS song_artist,
+         NULL::VARCHAR AS song_title, playlist_id, COALESCE(activity_timestamp, NOW()) AS activity_timestamp, id
+  FROM activity_create_playlist
+  UNION ALL
+  SELECT 'add_song', username, NULL, song_artist, song_title, playlist_id, COALESCE(activity_timestamp, NOW()), id
+  FROM activity_add_song
+  UNION ALL
+  SELECT 'make_friend', username, username_friend, NULL, NULL, NULL, COALESCE(activity_timestamp, NOW()), id
+  FROM activity_make_friend
+  UNION ALL
+  SELECT 'share_playlist', username, username_friend, NULL, NULL, playlist_id, COALESCE(activity_timestamp, NOW()), id
+  FROM activity_share_playlist;
+SELECT create_activity_partitions(LEAST(MIN(activity_timestamp), NOW())::DATE, (NOW() + INTERVAL '3 months')::DATE)
+FROM old_activities;
+
+INSERT INTO activities (activity_type, username, username_friend, song_artist, song_title, playlist_id,
+                        activity_timestamp)
+  SELECT activity_type, username, username_friend, song_artist, song_title, playlist_id, activity_timestamp
+  FROM old_activities
+  ORDER BY activity_timestamp, activity_type, id;
+
+-- Indexes are built once all rows are in.
+CREATE INDEX activities_timestamp ON activities (activity_timestamp, activity_type, id);
+CREATE INDEX activities_username_timestamp
+  ON activities (username, activity_timestamp DESC, activity_type DESC, id DESC);
+CREATE INDEX activities_username_friend_timestamp
+  ON activities (username_friend, activity_timestamp DESC, activity_type DESC, id DESC)
+  WHERE username_friend IS NOT NULL;
+
+DROP TABLE activity_create_playlist, activity_add_song, activity_make_friend, activity_share_playlist;
+
+TRUNCATE feed_entries;
+ALTER TABLE feed_entries ALTER COLUMN activity_id TYPE BIGINT;
+COMMIT;
+ANALYZE activities;
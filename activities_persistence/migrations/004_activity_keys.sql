@@ -0,0 +1,7 @@
+-- Adds the idempotency keys of the activities created through POST /activities/batch, to an activities database that
+-- was initialised before they existed.
+-- Run with: psql --username postgres --dbname activities -f 004_activity_keys.sql
+CREATE TABLE IF NOT EXISTS activity_keys (
+  idempotency_key VARCHAR(255) PRIMARY KEY,
+  created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
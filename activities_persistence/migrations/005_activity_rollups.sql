@@ -0,0 +1,10 @@
+-- Adds the daily rollups of the archived activities, to an activities database that was initialised before they
+-- existed.
+-- Run with: psql --username postgres --dbname activities -f 005_activity_rollups.sql
+CREATE TABLE IF NOT EXISTS activity_rollups (
+  username VARCHAR(255) NOT NULL,
+  day DATE NOT NULL,
+  activity_type VARCHAR(32) NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (username, day, activity_type)
+);
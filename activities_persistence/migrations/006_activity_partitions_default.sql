@@ -0,0 +1,33 @@
+-- Updates create_activity_partitions() in an activities database that was initialised before it moved the activities
+-- of a new month out of the default partition. Before, creating a partition failed as soon as the default partition
+-- held an activity of its month, and no later partitions were created.
+-- Run with: psql --username postgres --dbname activities -f 006_activity_partitions_default.sql
+CREATE OR REPLACE FUNCTION create_activity_partitions(first_month DATE, last_month DATE) RETURNS VOID AS $$
+DECLARE
+  month DATE := date_trunc('month', first_month);
+  partition_name TEXT;
+  moved BIGINT;
+BEGIN
+  WHILE month <= last_month LOOP
+    partition_name := 'activities_' || to_char(month, 'YYYY_MM');
+    IF to_regclass(partition_name) IS NULL THEN
+      -- Activities of the month in the default partition (e.g. with a timestamp in the future) would make
+      -- creating the partition fail, so it is created on its own, the activities are moved into it, and it is
+      -- attached afterwards.
+      EXECUTE format('CREATE TABLE %I (LIKE activities INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+      LOCK TABLE activities_default IN EXCLUSIVE MODE;
+      EXECUTE format('WITH moved AS (DELETE FROM activities_default '
+                     'WHERE activity_timestamp >= %L AND activity_timestamp < %L RETURNING *) '
+                     'INSERT INTO %I SELECT * FROM moved',
+                     month, month + INTERVAL '1 month', partition_name);
+      GET DIAGNOSTICS moved = ROW_COUNT;
+      IF moved > 0 THEN
+        RAISE NOTICE 'Moved % activities from the default partition to %', moved, partition_name;
+      END IF;
+      EXECUTE format('ALTER TABLE activities ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                     partition_name, month, month + INTERVAL '1 month');
+    END IF;
+    month := month + INTERVAL '1 month';
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,4 @@
+-- Indexes the idempotency keys on their age, such that the Activities service can delete the expired keys daily, in an
+-- activities database that was initialised before they expired.
+-- Run with: psql --username postgres --dbname activities -f 007_activity_keys_expiry.sql
+CREATE INDEX IF NOT EXISTS activity_keys_created_at ON activity_keys (created_at);
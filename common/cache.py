@@ -0,0 +1,125 @@
+import collections
+import hashlib
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    """
+    Probabilistic set membership, without false negatives.
+
+    A key that was added is always reported as present, a key that was never added is reported as present with
+    (approximately) the configured false positive rate, as long as no more than `capacity` keys are added.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        # Optimal number of bits and hash functions for the given capacity and false positive rate.
+        self.num_bits = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return all(self._bits[bit >> 3] & (1 << (bit & 7)) for bit in self._positions(key))
+
+    def add(self, key):
+        """
+        Adds a key to the filter.
+
+        :param key: tuple of strings, e.g. (title, artist).
+        """
+        with self._lock:
+            for bit in self._positions(key):
+                self._bits[bit >> 3] |= 1 << (bit & 7)
+            self._count += 1
+
+    def estimated_false_positive_rate(self):
+        """
+        Estimates the current false positive rate, based on the number of keys added so far.
+        """
+        return (1 - math.exp(-self.num_hashes * self._count / self.num_bits)) ** self.num_hashes
+
+    def _positions(self, key):
+        # Double hashing: derive all bit positions from two independent 64-bit halves of a single digest.
+        digest = hashlib.blake2b('\x00'.join(key).encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+class LRUCache:
+    """
+    Thread-safe, bounded least recently used cache, where every entry expires after a fixed time to live.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, on_evict=None):
+        """
+        :param on_evict: function that is called with the key and value of every entry that is removed, because it
+                         expired, made room for a new entry or was invalidated (not when it is replaced). It is called
+                         outside of the lock of the cache, so it may use the cache.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # Key -> (expiry, value), least recently used first.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evicted(self, entries):
+        if self.on_evict is not None:
+            for key, (_, value) in entries:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        """
+        Retrieves a value from the cache.
+
+        :return: the cached value, or default if the key is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+        if entry is not None:
+            self._evicted([(key, entry)])
+        return default
+
+    def put(self, key, value):
+        """
+        Stores a value in the cache, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            evicted = [self._entries.popitem(last=False)] if len(self._entries) > self.maxsize else []
+        self._evicted(evicted)
+
+    def invalidate(self, key):
+        """
+        Removes a key from the cache, if present.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._evicted([(key, entry)])
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._entries.items())
+            self._entries.clear()
+        self._evicted(evicted)
@@ -0,0 +1,266 @@
+import collections
+import contextlib
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within the timeout of the pool.
+    """
+
+
+class Pool:
+    """
+    Thread-safe pool of connections to a single database, shared by the request threads of a service.
+
+    Connections are opened lazily up to `maxconn`, after which a checkout waits for a connection to be returned.
+    Broken connections are discarded and transparently replaced by a new one on the next checkout.
+
+    The hot queries of a service are declared once in a registry of named statements, which is PREPAREd on every
+    connection of the pool, such that Postgres parses and plans them only once per connection.
+
+    Usage:
+        pool = Pool(dbname="songs", host="songs_persistence", statements={
+            'song_exists': "SELECT COUNT(*) FROM songs WHERE title = $1 AND artist = $2;",
+        })
+        with pool.transaction() as cursor:
+            pool.execute(cursor, 'song_exists', (title, artist))
+    """
+
+    def __init__(self, dbname: str, host: str, user: str = "postgres", password: str = "postgres",
+                 minconn: int = 1, maxconn: int = 10, timeout: float = 30.0, ping_after: float = 30.0,
+                 statements: dict = None):
+        """
+        :param dbname, host, user, password: connection parameters of the database.
+        :param minconn: number of connections opened when the pool is created.
+        :param maxconn: maximum number of connections that are open at the same time.
+        :param timeout: maximum number of seconds a checkout waits for (or tries to open) a connection.
+        :param ping_after: connections idle for longer than this many seconds are checked before they are handed out.
+        :param statements: registry of statement name -> SQL, with $1, $2, ... as parameters.
+        """
+        self.dbname = dbname
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._params = dict(dbname=dbname, user=user, password=password, host=host)
+        self._cond = threading.Condition()
+        self._idle = []  # Stack of (connection, time it was returned), most recently used last.
+        self._size = 0  # Number of open (or opening) connections, idle and in use.
+        self._stats = collections.Counter()
+        self._max_wait = 0.0
+        self.statements = statements or {}
+        # Statement name -> [number of calls, cumulative seconds, maximum seconds].
+        self._statement_stats = {name: [0, 0.0, 0.0] for name in self.statements}
+
+        # Open the initial connections, waiting for the database to come up if needed.
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self, deadline: float = None):
+        """
+        Opens a new connection, retrying with exponential backoff while the database is unreachable.
+
+        :param deadline: monotonic time after which to give up, None to keep retrying (e.g. while starting up).
+        """
+        delay = 0.5
+        while True:
+            try:
+                conn = psycopg2.connect(**self._params)
+                try:
+                    self._prepare(conn)
+                except BaseException:
+                    conn.close()
+                    raise
+                with self._cond:
+                    self._stats['connects'] += 1
+                    first = self._stats['connects'] == 1
+                if first:
+                    print("DB connection successful")
+                return conn
+            except psycopg2.OperationalError:
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise
+                print("Retrying DB connection")
+                time.sleep(delay)
+                delay = min(2 * delay, 5.0)
+
+    def _prepare(self, conn):
+        # Prepared statements belong to the session, so they outlive the transaction they were prepared in.
+        with conn.cursor() as cursor:
+            for name, sql in self.statements.items():
+                cursor.execute(f'PREPARE {name} AS {sql}')
+        conn.commit()
+
+    def _alive(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.ping_after:
+            return True
+        # The server may have dropped a connection that was idle for a while, check before handing it out.
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            conn.close()
+            return False
+
+    def getconn(self):
+        """
+        Checks out a connection, waiting for one to be returned if the pool is exhausted.
+
+        Every connection that is checked out must be returned with putconn(), prefer connection() or transaction().
+
+        :raises PoolTimeout: if no connection became available within the timeout.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'No connection to {self.dbname} available after {self.timeout} seconds')
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            self._stats['wait_seconds'] += waited
+            self._max_wait = max(self._max_wait, waited)
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+            else:
+                # Reserve a slot for a new connection, which is opened outside the lock.
+                conn, idle_since = None, None
+                self._size += 1
+
+        if conn is not None and not self._alive(conn, idle_since):
+            with self._cond:
+                self._stats['discarded'] += 1
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect(deadline)
+            except BaseException:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn, discard: bool = False):
+        """
+        Returns a checked out connection to the pool.
+
+        :param conn: the connection to return.
+        :param discard: close the connection instead of reusing it, e.g. because it is broken.
+        """
+        if not discard and not conn.closed:
+            # Never hand out a connection in the middle of a transaction.
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        with self._cond:
+            if discard or conn.closed:
+                self._size -= 1
+                self._stats['discarded'] += 1
+                conn.close()
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the with block, e.g. for server-side cursors or COPY.
+
+        Anything that is not committed when the block ends is rolled back.
+        """
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The connection itself is broken, make sure it is replaced.
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs the with block in a single transaction, which is committed if the block succeeds and rolled back otherwise.
+
+        :return: a cursor on a checked out connection.
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+
+    def execute(self, cursor, name: str, params: tuple = ()):
+        """
+        Executes a prepared statement from the registry and records its latency.
+
+        :param cursor: cursor on a connection of this pool.
+        :param name: name of the statement in the registry.
+        :param params: values for $1, $2, ... of the statement.
+        """
+        start = time.perf_counter()
+        if params:
+            cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cursor.execute(f'EXECUTE {name}')
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            stats = self._statement_stats[name]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def statement_metrics(self):
+        """
+        :return: list with the number of calls and latency of every registered statement, most total time first.
+        """
+        with self._cond:
+            stats = [{
+                'name': name,
+                'calls': calls,
+                'seconds_total': round(seconds, 6),
+                'seconds_avg': round(seconds / calls, 6) if calls else 0.0,
+                'seconds_max': round(maximum, 6),
+            } for name, (calls, seconds, maximum) in self._statement_stats.items()]
+        return sorted(stats, key=lambda stat: stat['seconds_total'], reverse=True)
+
+    def metrics(self):
+        """
+        :return: dictionary with the current size of the pool and counters of its usage.
+        """
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'size': self._size,
+                'max_size': self.maxconn,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'checkouts': checkouts,
+                'wait_seconds_total': round(self._stats['wait_seconds'], 6),
+                'wait_seconds_avg': round(self._stats['wait_seconds'] / checkouts, 6) if checkouts else 0.0,
+                'wait_seconds_max': round(self._max_wait, 6),
+                'timeouts': self._stats['timeouts'],
+                'connects': self._stats['connects'],
+                'discarded': self._stats['discarded'],
+            }
@@ -0,0 +1,179 @@
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+import psycopg2.extras
+import requests
+
+# Statements of the outbox, to add to the registry of the pool of a service that uses it.
+OUTBOX_STATEMENTS = {
+    'outbox_add': "INSERT INTO outbox (payload) VALUES ($1::JSONB)",
+}
+
+# Client errors that are transient, such that the activities are sent again rather than rejected.
+RETRY_STATUS_CODES = (408, 429)
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Transactional outbox for the activities a service publishes to the Activities microservice.
+
+    An activity is written to the outbox table of the service in the same transaction as the change it describes, so
+    it is recorded if and only if that change is committed, and the request doesn't wait for the Activities
+    microservice. A background thread sends the outbox in batches to POST /activities/batch, and deletes the rows once
+    they were accepted. When the Activities microservice is unavailable, it retries with exponential backoff.
+
+    When the Activities microservice rejects a batch (a 4xx response), the batch is split in halves and sent again
+    until the rejected activities are isolated. Those are moved to the outbox_dead table with the response, such that
+    a single malformed activity doesn't block the activities behind it.
+
+    Every activity carries an idempotency key derived from its outbox row, such that an activity that is sent again
+    (e.g. because the response was lost) is only created once.
+
+    Usage:
+        pool = Pool(..., statements={**STATEMENTS, **OUTBOX_STATEMENTS})
+        outbox = Outbox(pool, "http://activities:5000", source="friends")
+        with pool.transaction() as cursor:
+            ...
+            outbox.add(cursor, {'activity_type': 'make_friend', 'username': ..., 'username_friend': ...})
+        outbox.notify()
+    """
+
+    def __init__(self, pool, url: str, source: str, batch_size: int = 500, interval: float = 1.0,
+                 max_backoff: float = 60.0, timeout: float = 10.0):
+        """
+        :param pool: the connection pool of the database with the outbox table.
+        :param url: base url of the Activities microservice.
+        :param source: name of the service, which prefixes the idempotency keys.
+        :param batch_size: maximum number of activities sent per request.
+        :param interval: number of seconds between checks of the outbox when nobody calls notify().
+        :param max_backoff: maximum number of seconds between retries while sending fails.
+        :param timeout: timeout in seconds of a request to the Activities microservice.
+        """
+        self.pool = pool
+        self.url = url
+        self.source = source
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._wakeup = threading.Event()
+        self._stats = collections.Counter()
+        self._lock = threading.Lock()
+        self._last_error = None
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def add(self, cursor, activity: dict):
+        """
+        Adds an activity to the outbox, as part of the transaction of the cursor.
+
+        :param cursor: cursor on a connection of the pool, in the transaction of the change the activity describes.
+        :param activity: the activity, in the format of POST /activities/batch (without timestamp, the time it was
+                         added is used).
+        """
+        self.pool.execute(cursor, 'outbox_add', (json.dumps(activity),))
+
+    def add_many(self, cursor, activities):
+        """
+        Adds many activities to the outbox at once, as part of the transaction of the cursor.
+
+        :param activities: list of activities, as for add().
+        """
+        psycopg2.extras.execute_values(cursor, "INSERT INTO outbox (payload) VALUES %s;",
+                                       [(json.dumps(activity),) for activity in activities],
+                                       page_size=self.batch_size)
+
+    def notify(self):
+        """
+        Wakes up the background thread, such that activities that were just committed are sent right away.
+        """
+        self._wakeup.set()
+
+    def dispatch(self):
+        """
+        Sends the oldest batch of activities in the outbox, and deletes it once the Activities microservice accepted it.
+        Rejected activities are moved to the outbox_dead table instead.
+
+        The rows stay locked until then, such that several processes can drain the same outbox.
+
+        :return: number of activities that were sent or rejected.
+        """
+        with self.pool.transaction() as cursor:
+            cursor.execute("SELECT id, payload, created_at FROM outbox ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED;",
+                           (self.batch_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                return 0
+            rejected = self._send(rows)
+            if rejected:
+                psycopg2.extras.execute_values(
+                    cursor, "INSERT INTO outbox_dead (id, payload, created_at, error) "
+                            "SELECT outbox.id, outbox.payload, outbox.created_at, rejected.error "
+                            "FROM outbox JOIN (VALUES %s) AS rejected (id, error) ON outbox.id = rejected.id",
+                    rejected)
+                logger.error('The Activities microservice rejected %d activities of the outbox', len(rejected))
+            cursor.execute("DELETE FROM outbox WHERE id = ANY(%s);", ([row[0] for row in rows],))
+        with self._lock:
+            self._stats['sent'] += len(rows) - len(rejected)
+            self._stats['rejected'] += len(rejected)
+            self._stats['batches'] += 1
+        return len(rows)
+
+    def _send(self, rows):
+        """
+        Sends outbox rows to the Activities microservice, splitting a rejected batch until the rejected rows are found.
+
+        :param rows: list of (id, payload, created_at) outbox rows.
+        :return: list of (id, error) of the rows that were rejected.
+        :raises requests.RequestException: if the Activities microservice is unavailable or failed.
+        """
+        activities = [{
+            **payload,
+            'timestamp': payload.get('timestamp') or created_at.isoformat(sep=' '),
+            'idempotency_key': f'{self.source}-{outbox_id}',
+        } for outbox_id, payload, created_at in rows]
+        response = requests.post(f'{self.url}/activities/batch', json={'activities': activities},
+                                 timeout=self.timeout)
+        if 400 <= response.status_code < 500 and response.status_code not in RETRY_STATUS_CODES:
+            if len(rows) == 1:
+                return [(rows[0][0], f'{response.status_code}: {response.text[:1000]}')]
+            # The activities that were accepted before are skipped by their idempotency key.
+            middle = len(rows) // 2
+            return self._send(rows[:middle]) + self._send(rows[middle:])
+        response.raise_for_status()
+        return []
+
+    def _run(self):
+        backoff = self.interval
+        while True:
+            try:
+                # Drain the outbox, then wait until there is something new.
+                while self.dispatch() == self.batch_size:
+                    pass
+                backoff = self.interval
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+            except Exception as e:
+                # Any error, not only an outage, is retried: the thread must keep draining the outbox.
+                with self._lock:
+                    self._stats['failures'] += 1
+                    self._last_error = f'{type(e).__name__}: {e}'
+                logger.exception('Could not send the outbox, retrying in %.1f seconds', backoff)
+                # Jitter, such that the producers don't all retry at the same moment after an outage.
+                time.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(2 * backoff, self.max_backoff)
+
+    def metrics(self):
+        """
+        :return: dictionary with the number of activities and batches that were sent, of activities that were rejected,
+                 and of failed attempts with the last error.
+        """
+        with self._lock:
+            return {'sent': self._stats['sent'], 'batches': self._stats['batches'], 'rejected': self._stats['rejected'],
+                    'failures': self._stats['failures'], 'last_error': self._last_error}
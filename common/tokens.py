@@ -0,0 +1,70 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+# Secret shared by all microservices to sign and verify session tokens, like the database credentials this defaults to
+# a development value and should be overridden through the environment.
+SECRET = os.environ.get('SESSION_SECRET', 'spotibook-dev-secret').encode()
+# Number of seconds a session token stays valid.
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 60 * 60))
+
+
+def _encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _decode(data: str):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(payload: str):
+    return _encode(hmac.new(SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+def issue(username: str, ttl: int = SESSION_TTL):
+    """
+    Issues a signed session token for a user that was authenticated by the Users microservice.
+
+    :param username: the username of the authenticated user.
+    :param ttl: number of seconds the token stays valid.
+    :return: the token, as '<payload>.<signature>'.
+    """
+    payload = _encode(json.dumps({'sub': username, 'exp': int(time.time()) + ttl}).encode())
+    return f'{payload}.{_sign(payload)}'
+
+
+def verify(token: str):
+    """
+    Verifies a session token, without contacting any other microservice.
+
+    :param token: the token to verify.
+    :return: the username the token was issued to, or None if the token is malformed, forged or expired.
+    """
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        claims = json.loads(_decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('exp', 0) < time.time():
+        return None
+    return claims.get('sub')
+
+
+def session_user(headers):
+    """
+    Retrieves the user of the session token in the Authorization header of a request, if any.
+
+    A missing or invalid token is not an error, the caller should then fall back to checking the user another way.
+
+    :param headers: the headers of the request.
+    :return: the username of the verified user, None if there is no valid token.
+    """
+    authorization = headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    return verify(authorization[len('Bearer '):])
@@ -0,0 +1,74 @@
+import requests
+
+from common.cache import LRUCache
+
+
+class UsersClient:
+    """
+    Client for checking if users exist in the Users microservice.
+
+    Users are never deleted, so a positive answer stays true and is cached in-process for `ttl` seconds, which saves a
+    request per check for users that were seen recently. Negative answers are never cached, since the user may
+    register at any moment.
+    """
+
+    def __init__(self, url: str = "http://users:5000", ttl: float = 300.0, maxsize: int = 10000,
+                 timeout: float = 5.0, batch_size: int = 1000):
+        """
+        :param url: base url of the Users microservice.
+        :param ttl: number of seconds a positive answer is cached.
+        :param maxsize: maximum number of cached usernames.
+        :param timeout: timeout in seconds of a request to the Users microservice.
+        :param batch_size: maximum number of usernames checked per batch request.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._cache = LRUCache(maxsize, ttl)
+
+    def exists(self, username: str):
+        """
+        Checks if a user exists.
+
+        :param username: the username of the user to check.
+        :return: True if the user exists, False otherwise.
+        """
+        if self._cache.get(username):
+            return True
+        response = requests.get(f'{self.url}/users/exists', params={'username': username}, timeout=self.timeout)
+        response.raise_for_status()
+        exists = response.json()['exists']
+        if exists:
+            self._cache.put(username, True)
+        return exists
+
+    def exists_many(self, usernames):
+        """
+        Checks if many users exist, using one request per batch for the users that are not cached.
+
+        :param usernames: iterable of usernames to check.
+        :return: dictionary of username -> True if the user exists, False otherwise.
+        """
+        result = {}
+        unknown = []
+        for username in dict.fromkeys(usernames):
+            if self._cache.get(username):
+                result[username] = True
+            else:
+                unknown.append(username)
+
+        for start in range(0, len(unknown), self.batch_size):
+            response = requests.post(f'{self.url}/users/exists/batch',
+                                     json={'usernames': unknown[start:start + self.batch_size]}, timeout=self.timeout)
+            response.raise_for_status()
+            for username, exists in response.json()['exists'].items():
+                if exists:
+                    self._cache.put(username, True)
+                result[username] = exists
+        return result
+
+    def cache_stats(self):
+        """
+        :return: dictionary with the number of cache hits, misses and cached usernames.
+        """
+        return {'hits': self._cache.hits, 'misses': self._cache.misses, 'size': len(self._cache)}
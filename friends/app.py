@@ -1,9 +1,12 @@
-from flask import Flask, jsonify
+from flask import Flask
 from flask import request as flask_request
 from flask_restful import Resource, Api, reqparse
 
-import requests
-import psycopg2
+from common import tokens
+from common.db import Pool
+from common.outbox import Outbox, OUTBOX_STATEMENTS
+from common.users_client import UsersClient
+from graph import FriendGraph
 
 app = Flask('friends')
 api = Api(app)
@@ -12,17 +15,54 @@ api = Api(app)
 users_microservice_url = "http://users:5000"
 activities_microservice_url = "http://activities:5000"
 
-conn = None
+# Number of rows fetched per round trip while loading the friendship graph.
+LOAD_ITERSIZE = 5000
+# Default and maximum number of friend suggestions.
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 100
+# Maximum number of users whose friends can be retrieved in a single batch request.
+MAX_FRIENDS_BATCH = 1000
 
-while conn is None:
-    try:
-        conn = psycopg2.connect(dbname="friends", user="postgres", password="postgres", host="friends_persistence")
-        print("DB connection succesful")
-    except psycopg2.OperationalError:
-        import time
+# Checks if users exist, caching the users that do.
+users = UsersClient(users_microservice_url)
 
-        time.sleep(1)
-        print("Retrying DB connection")
+# Registry of the SQL statements of this service, prepared once on every pooled connection.
+STATEMENTS = {
+    # Friendships are stored in both directions. The rows are inserted in a fixed order, such that two concurrent
+    # requests for the same friendship wait on each other instead of deadlocking.
+    'add_friend': "INSERT INTO friends (username, username_friend) \
+        VALUES (LEAST($1::VARCHAR, $2::VARCHAR), GREATEST($1::VARCHAR, $2::VARCHAR)), \
+               (GREATEST($1::VARCHAR, $2::VARCHAR), LEAST($1::VARCHAR, $2::VARCHAR)) \
+        ON CONFLICT ON CONSTRAINT unique_friend_relationship DO NOTHING",
+    **OUTBOX_STATEMENTS,
+}
+
+pool = Pool(dbname="friends", host="friends_persistence", statements=STATEMENTS)
+
+# Publishes the activities of this service to the Activities microservice, in the background.
+outbox = Outbox(pool, activities_microservice_url, source='friends')
+
+
+def stream_friendships():
+    """
+    Lazily yields every (directed) friendship from a server-side cursor.
+
+    :return: generator of (username, username_friend) rows.
+    """
+    with pool.connection() as conn:
+        cursor = conn.cursor(name='friends_load')
+        cursor.itersize = LOAD_ITERSIZE
+        cursor.execute("SELECT username, username_friend FROM friends;")
+        for row in cursor:
+            yield row
+        cursor.close()
+
+
+# Keep the friendship graph in memory, such that friend lists are served without a query. This service is the only
+# writer of the friends table, and updates the graph whenever it adds a friendship.
+graph = FriendGraph()
+graph.build(stream_friendships())
+app.logger.info('Loaded the friends of %d users', len(graph))
 
 
 class AddFriend(Resource):
@@ -54,73 +94,171 @@ class AddFriend(Resource):
         if args['username'] == args['username_friend']:
             return {'message': 'You cannot add yourself as a friend'}, 400
 
-        # Check if the user that requested the friendship exists.
-        response = requests.get(f'{users_microservice_url}/users/exists?username={args["username"]}')
-        # Check if friend exists.
-        response_friend = requests.get(f'{users_microservice_url}/users/exists?username={args["username_friend"]}')
-
-        cursor = conn.cursor()
-        if not response.json()['exists'] or not response_friend.json()['exists']:
+        # Check if the user that requested the friendship and the friend exist, with a single request at most.
+        # A valid session token of the user proves that they exist, so only the friend has to be checked.
+        to_check = [args['username'], args['username_friend']]
+        if tokens.session_user(flask_request.headers) == args['username']:
+            to_check.remove(args['username'])
+        if not all(users.exists_many(to_check).values()):
             return {'message': 'User or friend not found'}, 404
-        # Check if the friend relationship already exists in db.
-        cursor.execute(
-            "INSERT INTO friends (username, username_friend) \
-             SELECT %s, %s WHERE NOT EXISTS \
-             (SELECT * FROM friends WHERE (username = %s AND username_friend = %s) OR (username = %s AND username_friend = %s));",
-            (args['username'], args['username_friend'], args['username'], args['username_friend'],
-             args['username_friend'], args['username']))
-        conn.commit()
-
-        if cursor.rowcount == 0:
+        with pool.transaction() as cursor:
+            # Add the friendship in both directions, unless it already exists.
+            pool.execute(cursor, 'add_friend', (args['username'], args['username_friend']))
+            inserted = cursor.rowcount
+            if inserted:
+                # Create new activity, which is only published if the friendship is committed.
+                outbox.add(cursor, {
+                    'activity_type': 'make_friend',
+                    'username': args['username'],
+                    'username_friend': args['username_friend']
+                })
+        # Only update the graph once the friendship is committed, the update is idempotent.
+        graph.add(args['username'], args['username_friend'])
+
+        if inserted == 0:
             return {'message': 'Friendship already exists'}, 409
-        # Create new activity.
-        requests.post(f'{activities_microservice_url}/activities/make-friend', json={
-            'username': args['username'],
-            'username_friend': args['username_friend']
-        })
+        outbox.notify()
         return {'message': 'Friend added successfully'}, 200
 
 
-
 class Friends(Resource):
     """
     Resource for listing a user's friends.
 
     GET /friends/<username>
-    Returns a list of all friends associated with the given username.
+    Returns a list of all friends associated with the given username, from the in-memory friendship graph.
 
     Request data:
     - username: The username of the user whose friends should be listed.
 
+    Request headers:
+    - If-None-Match (optional): The ETag of a previously retrieved friend list.
+
     Response:
-    - 200 OK: A list of friends associated with the given username.
+    - 200 OK: A list of friends associated with the given username, with its ETag.
+    - 304 Not Modified: The friends did not change since the friend list with the given ETag was retrieved.
     - 404 Not Found: The user could not be found in the database.
     """
 
     def get(self, username: str):
-        # Check if the user exists.
-        response = requests.get(f'{users_microservice_url}/users/exists?username={username}')
-        if not response.json()['exists']:
+        friends, etag = graph.friends(username)
+
+        # Users with friends certainly exist. Otherwise, check if the user exists, unless a valid session token of the
+        # user proves that already.
+        if not friends and tokens.session_user(flask_request.headers) != username and not users.exists(username):
             return {'message': 'User not found'}, 404
 
-        # List users friends.
-        cursor = conn.cursor()
-        # Retrieve the user's friends.
-        cursor.execute(
-            "SELECT username_friend \
-            FROM friends \
-            WHERE username = %s \
-            UNION \
-            SELECT username \
-            FROM friends \
-            WHERE username_friend = %s;",
-            (username, username))
-
-        # Reformat the results.
-        friends = [{'username': row[0]} for row in cursor.fetchall()]
+        headers = {'ETag': f'"{etag}"'}
+        if flask_request.if_none_match.contains(etag):
+            return None, 304, headers
+        return {'friends': [{'username': friend} for friend in friends]}, 200, headers
+
+
+class FriendsBatch(Resource):
+    """
+    Resource for listing the friends of many users at once.
+
+    POST /friends/batch
+    Returns the friends of every specified user from the in-memory friendship graph, in a single request.
+
+    Request data:
+    - usernames: A list of at most 1000 usernames whose friends should be listed.
+
+    Response:
+    - 200 OK: The friends were returned successfully, as {'friends': {username: [username, ...], ...}}. Users that
+      could not be found in the database map to null.
+    - 400 Bad Request: The usernames were missing, malformed or exceeded the batch size.
+    """
+
+    def post(self):
+        # Parse the request data.
+        data = flask_request.get_json(silent=True) or {}
+        usernames = data.get('usernames')
+        if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+            return {'message': 'Missing request data: usernames'}, 400
+        if len(usernames) > MAX_FRIENDS_BATCH:
+            return {'message': f'At most {MAX_FRIENDS_BATCH} users can be looked up at once'}, 400
+
+        friends = graph.friends_many(usernames)
+        # Users with friends certainly exist, the others are checked with a single request at most.
+        friendless = [username for username, user_friends in friends.items() if not user_friends]
+        for username, exists in users.exists_many(friendless).items():
+            if not exists:
+                friends[username] = None
         return {'friends': friends}, 200
 
 
+class MutualFriends(Resource):
+    """
+    Resource for listing the mutual friends of two users.
+
+    GET /friends/<username>/mutual/<other>
+    Returns the users that are friends of both users, from the in-memory friendship graph.
+
+    Response:
+    - 200 OK: The mutual friends were returned successfully, as {'mutual_friends': [{'username': ...}, ...]}.
+    - 404 Not Found: One of the users could not be found in the database.
+    """
+
+    def get(self, username: str, other: str):
+        mutual = graph.mutual(username, other)
+
+        # Users with mutual friends certainly exist. Otherwise, check both users with a single request at most.
+        if not mutual:
+            to_check = [username, other]
+            if tokens.session_user(flask_request.headers) == username:
+                to_check.remove(username)
+            if not all(users.exists_many(to_check).values()):
+                return {'message': 'User not found'}, 404
+        return {'mutual_friends': [{'username': friend} for friend in mutual]}, 200
+
+
+class FriendSuggestions(Resource):
+    """
+    Resource for suggesting people a user may know.
+
+    GET /friends/<username>/suggestions?k=<k>
+    Returns the friends of the user's friends that are not yet their friend, ranked by the number of mutual friends.
+
+    Query parameters:
+    - k: The maximum number of suggestions, default is 10 (at most 100).
+
+    Response:
+    - 200 OK: The suggestions were returned successfully, as {'suggestions': [{'username': ..., 'mutual_friends': ...},
+      ...]}, most mutual friends first.
+    - 400 Bad Request: k was not a positive integer.
+    - 404 Not Found: The user could not be found in the database.
+    """
+
+    def get(self, username: str):
+        args = flask_request.args
+        k = args.get('k', type=int)
+        if 'k' in args and (k is None or k < 1):
+            return {'message': 'k must be a positive integer'}, 400
+
+        suggestions = graph.suggestions(username, min(k or DEFAULT_SUGGESTIONS, MAX_SUGGESTIONS))
+        # Users without friends of friends may still exist, they simply get no suggestions.
+        if not suggestions and tokens.session_user(flask_request.headers) != username and not users.exists(username):
+            return {'message': 'User not found'}, 404
+        return {'suggestions': [{'username': suggestion, 'mutual_friends': mutual}
+                                for suggestion, mutual in suggestions]}, 200
+
+
+class DatabaseMetrics(Resource):
+    """
+    GET /friends/db/metrics
+    Retrieves the size and usage counters of the database connection pool, the number of calls and latency of every
+    prepared statement (most total time first), and the counters of the outbox.
+    """
+
+    def get(self):
+        return {**pool.metrics(), 'statements': pool.statement_metrics(), 'outbox': outbox.metrics()}, 200
+
+
 # Add the resources to the API.
 api.add_resource(AddFriend, '/friends/add')
 api.add_resource(Friends, '/friends/<username>')
+api.add_resource(FriendsBatch, '/friends/batch')
+api.add_resource(MutualFriends, '/friends/<username>/mutual/<other>')
+api.add_resource(FriendSuggestions, '/friends/<username>/suggestions')
+api.add_resource(DatabaseMetrics, '/friends/db/metrics')
@@ -0,0 +1,60 @@
+"""
+Benchmark of the latency of friend suggestions as the friendship graph grows.
+
+Random graphs are generated with a skewed degree distribution (a few users have very many friends, like in a real
+social network), after which suggestions are computed for a sample of users. No database is needed.
+
+Usage: python3 bench_suggestions.py [--edges 10000 100000 1000000] [--samples 1000]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from graph import FriendGraph
+
+
+def random_graph(edges: int, seed: int = 42):
+    """
+    Generates a graph of the given number of friendships between edges / 10 users, where the probability that a user
+    takes part in a friendship follows a power law.
+    """
+    rng = random.Random(seed)
+    users = max(2, edges // 10)
+    # Pareto distributed weights, such that some users end up with thousands of friends.
+    weights = [rng.paretovariate(1.5) for _ in range(users)]
+    graph = FriendGraph()
+    rows = []
+    for _ in range(edges):
+        a, b = rng.choices(range(users), weights=weights, k=2)
+        if a != b:
+            rows.append((f'user{a}', f'user{b}'))
+            rows.append((f'user{b}', f'user{a}'))
+    graph.build(rows)
+    return graph, users
+
+
+def benchmark(edges: int, samples: int):
+    graph, users = random_graph(edges)
+    rng = random.Random(7)
+    latencies = []
+    for _ in range(samples):
+        username = f'user{rng.randrange(users)}'
+        start = time.perf_counter()
+        graph.suggestions(username, 10)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    max_degree = max(len(friends) for friends in graph._friends.values())
+    return max_degree, statistics.median(latencies), latencies[int(0.99 * (len(latencies) - 1))], latencies[-1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--edges', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f'{"edges":>10} {"max degree":>11} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for edges in args.edges:
+        max_degree, p50, p99, maximum = benchmark(edges, args.samples)
+        print(f'{edges:>10} {max_degree:>11} {1000 * p50:>8.3f} {1000 * p99:>8.3f} {1000 * maximum:>8.3f}')
@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import secrets
+import threading
+
+# Maximum number of friends of a user whose friends are considered for suggestions, the least connected ones first.
+MAX_EXPANDED_FRIENDS = 100
+# Maximum number of friends of each of those friends that are considered for suggestions.
+MAX_FRIEND_FANOUT = 200
+
+
+class FriendGraph:
+    """
+    In-memory graph of all friendships, as a set of friends (adjacency set) per user.
+
+    Every user has a version that changes whenever their friends change, which is used as the ETag of their friend
+    list. Versions start from a random generation per process, such that an ETag handed out before a restart never
+    matches afterwards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._friends = {}  # Username -> set of usernames of friends.
+        self._versions = {}  # Username -> version of the friends of the user.
+        self._clock = 0  # Last handed out version.
+        self._generation = secrets.token_hex(4)
+
+    def __len__(self):
+        return len(self._friends)
+
+    def build(self, rows):
+        """
+        Adds every friendship of the table, which stores each friendship in both directions.
+
+        :param rows: iterable of (username, username_friend) rows.
+        """
+        with self._lock:
+            for username, friend in rows:
+                self._friends.setdefault(username, set()).add(friend)
+
+    def add(self, username: str, friend: str):
+        """
+        Adds a friendship, in both directions.
+
+        :return: True if the friendship was added, False if it already existed.
+        """
+        with self._lock:
+            friends = self._friends.setdefault(username, set())
+            if friend in friends:
+                return False
+            friends.add(friend)
+            self._friends.setdefault(friend, set()).add(username)
+            self._clock += 1
+            self._versions[username] = self._versions[friend] = self._clock
+            return True
+
+    def friends(self, username: str):
+        """
+        Retrieves the friends of a user.
+
+        :return: tuple (sorted list of usernames, ETag of the list).
+        """
+        with self._lock:
+            return sorted(self._friends.get(username, ())), self.etag(username)
+
+    def friends_many(self, usernames):
+        """
+        Retrieves the friends of many users at once.
+
+        :param usernames: iterable of usernames.
+        :return: dictionary of username -> sorted list of usernames of their friends.
+        """
+        with self._lock:
+            return {username: sorted(self._friends.get(username, ())) for username in usernames}
+
+    def mutual(self, username: str, other: str):
+        """
+        Retrieves the mutual friends of two users, by looking up the friends of the user with the fewest friends in the
+        friends of the other, which costs time in the number of friends of the former only.
+
+        :return: sorted list of usernames of the mutual friends.
+        """
+        with self._lock:
+            friends = self._friends.get(username, set())
+            others = self._friends.get(other, set())
+            return sorted(friends & others)
+
+    def etag(self, username: str):
+        """
+        :return: the (unquoted) ETag of the current friends of a user, which changes whenever their friends change.
+        """
+        return f'{self._generation}-{self._versions.get(username, 0)}'
+
+    def suggestions(self, username: str, k: int = 10):
+        """
+        Suggests users that the user may know: the friends of their friends, ranked by number of mutual friends.
+
+        The traversal is bounded for users with many friends: only the MAX_EXPANDED_FRIENDS least connected friends are
+        expanded (a shared friend with a small circle says more than a shared celebrity), and only MAX_FRIEND_FANOUT
+        friends of each of them are considered, so a suggestion costs the same however large the graph becomes.
+
+        :param username: the username of the user.
+        :param k: maximum number of suggestions.
+        :return: list of (username, number of mutual friends) tuples, most mutual friends first.
+        """
+        with self._lock:
+            friends = self._friends.get(username, set())
+            expanded = friends
+            if len(friends) > MAX_EXPANDED_FRIENDS:
+                expanded = heapq.nsmallest(MAX_EXPANDED_FRIENDS, friends, key=lambda friend: len(self._friends[friend]))
+
+            mutual = {}
+            for friend in expanded:
+                for candidate in itertools.islice(self._friends[friend], MAX_FRIEND_FANOUT):
+                    if candidate != username and candidate not in friends:
+                        mutual[candidate] = mutual.get(candidate, 0) + 1
+
+        # Ties are broken on username, such that the suggestions are stable.
+        return heapq.nsmallest(k, mutual.items(), key=lambda item: (-item[1], item[0]))
@@ -6,6 +6,8 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
 EOSQL
 
 # Connect to the new database and create the friends table.
+# Every friendship is stored as two directed rows, (a, b) and (b, a), such that the unique index on
+# (username, username_friend) covers listing the friends of a user with a single index-only range scan.
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "friends" <<-EOSQL
     CREATE TABLE IF NOT EXISTS friends (
       id SERIAL PRIMARY KEY,
@@ -13,4 +15,20 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "friends" <<-EOSQL
       username_friend VARCHAR(255) NOT NULL,
       CONSTRAINT unique_friend_relationship UNIQUE (username, username_friend)
     );
-EOSQL
\ No newline at end of file
+
+    -- Activities that still have to be published to the Activities service (common/outbox.py).
+    CREATE TABLE IF NOT EXISTS outbox (
+      id BIGSERIAL PRIMARY KEY,
+      payload JSONB NOT NULL,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    -- Activities of the outbox that the Activities service rejected, with its response.
+    CREATE TABLE IF NOT EXISTS outbox_dead (
+      id BIGINT PRIMARY KEY,
+      payload JSONB NOT NULL,
+      created_at TIMESTAMP NOT NULL,
+      error TEXT NOT NULL,
+      failed_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+EOSQL
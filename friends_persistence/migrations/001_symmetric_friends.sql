@@ -0,0 +1,9 @@
+-- Stores every friendship of a friends database that was initialised before friendships were symmetric in both
+-- directions, by adding the missing reverse row of every friendship.
+-- Run with: psql --username postgres --dbname friends -f 001_symmetric_friends.sql
+BEGIN;
+INSERT INTO friends (username, username_friend)
+    SELECT username_friend, username FROM friends
+    ON CONFLICT ON CONSTRAINT unique_friend_relationship DO NOTHING;
+COMMIT;
+ANALYZE friends;
@@ -0,0 +1,8 @@
+-- Adds the outbox of the activities that still have to be published to the Activities service, to a friends database
+-- that was initialised before it existed.
+-- Run with: psql --username postgres --dbname friends -f 002_outbox.sql
+CREATE TABLE IF NOT EXISTS outbox (
+  id BIGSERIAL PRIMARY KEY,
+  payload JSONB NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
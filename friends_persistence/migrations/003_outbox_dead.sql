@@ -0,0 +1,10 @@
+-- Adds the dead letters of the outbox (the activities that the Activities service rejected), to a friends database
+-- that was initialised before they existed.
+-- Run with: psql --username postgres --dbname friends -f 003_outbox_dead.sql
+CREATE TABLE IF NOT EXISTS outbox_dead (
+  id BIGINT PRIMARY KEY,
+  payload JSONB NOT NULL,
+  created_at TIMESTAMP NOT NULL,
+  error TEXT NOT NULL,
+  failed_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
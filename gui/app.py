@@ -1,7 +1,10 @@
-from flask import Flask, render_template, redirect, request, url_for
+from flask import Flask, render_template, redirect, request, session, url_for
+import os
 import requests
 
 app = Flask(__name__)
+# Key used to sign the session cookie, which holds the logged-in user of each browser.
+app.secret_key = os.environ.get('SESSION_SECRET', 'spotibook-dev-secret')
 
 # Microservice urls.
 users_microservice_url = "http://users:5000"
@@ -10,19 +13,28 @@ songs_microservice_url = "http://songs:5000"
 playlists_microservice_url = "http://playlists:5000"
 activities_microservice_url = "http://activities:5000"
 
-# The Username & Password of the currently logged-in User
-username = None
-password = None
-
-session_data = dict()
-
 
 def save_to_session(key, value):
-    session_data[key] = value
+    session[key] = value
 
 
 def load_from_session(key):
-    return session_data.pop(key) if key in session_data else None  # Pop to ensure that it is only used once
+    return session.pop(key, None)  # Pop to ensure that it is only used once
+
+
+def log_in(req_username, token):
+    # Remember the logged-in user and the session token issued by the Users microservice, per browser.
+    session['username'] = req_username
+    session['token'] = token
+
+
+def auth_headers():
+    """
+    Headers that forward the session token of the logged-in user, such that other microservices can verify the user
+    locally instead of asking the Users microservice.
+    """
+    token = session.get('token')
+    return {'Authorization': f'Bearer {token}'} if token else {}
 
 
 def format_activity(act: dict) -> tuple:
@@ -55,13 +67,14 @@ def feed():
     # Get the feed of the last N activities of your friends.
     # ================================
 
-    global username
+    username = session.get('username')
 
     N = 10
     if username is not None:
         feed = []
         # Retrieve the N latest activities from friends and sort them in descending order.
-        response = requests.get(f'{activities_microservice_url}/activities/{username}?n={N}&sort=desc')
+        response = requests.get(f'{activities_microservice_url}/activities/{username}?n={N}&sort=desc',
+                                headers=auth_headers())
 
         # Check if status code of response is 200.
         if response.status_code == 200:
@@ -69,20 +82,32 @@ def feed():
     else:
         feed = []
 
-    return render_template('feed.html', username=username, password=password, feed=feed)
+    return render_template('feed.html', username=username, feed=feed)
 
 
 @app.route("/catalogue")
 def catalogue():
-    songs = requests.get("http://songs:5000/songs").json()
+    username = session.get('username')
+    # Forward the cursor of the previous page (if any), the Songs microservice pages through the catalogue.
+    params = {key: request.args[key] for key in ('after_artist', 'after_title') if key in request.args}
+    response = requests.get(f"{songs_microservice_url}/songs/", params=params).json()
+
+    return render_template('catalogue.html', username=username, songs=response['songs'],
+                           next_page=response['next'])
+
 
-    return render_template('catalogue.html', username=username, password=password, songs=songs)
+@app.route("/catalogue/search")
+def catalogue_search():
+    # Proxy the autocomplete query of the catalogue page to the Songs microservice.
+    response = requests.get(f"{songs_microservice_url}/songs/search", params={'q': request.args.get('q', ''), 'k': 10})
+    return response.json(), response.status_code
 
 
 @app.route("/login")
 def login_page():
+    username = session.get('username')
     success = load_from_session('success')
-    return render_template('login.html', username=username, password=password, success=success)
+    return render_template('login.html', username=username, success=success)
 
 
 @app.route("/login", methods=['POST'])
@@ -104,18 +129,16 @@ def actual_login():
     success = response.status_code == 200
     save_to_session('success', success)
     if success:
-        global username, password
-
-        username = req_username
-        password = req_password
+        log_in(req_username, response.json()['token'])
 
     return redirect('/login')
 
 
 @app.route("/register")
 def register_page():
+    username = session.get('username')
     success = load_from_session('success')
-    return render_template('register.html', username=username, password=password, success=success)
+    return render_template('register.html', username=username, success=success)
 
 
 @app.route("/register", methods=['POST'])
@@ -139,10 +162,7 @@ def actual_register():
     save_to_session('success', success)
 
     if success:
-        global username, password
-
-        username = req_username
-        password = req_password
+        log_in(req_username, response.json()['token'])
 
     return redirect('/register')
 
@@ -151,7 +171,7 @@ def actual_register():
 def friends():
     success = load_from_session('success')
 
-    global username
+    username = session.get('username')
 
     # ================================
     # FEATURE 4
@@ -162,13 +182,13 @@ def friends():
     friend_list = []
     if username is not None:
         # Send post request to Friends microservice to retrieve friends.
-        response = requests.get(f"{friends_microservice_url}/friends/{username}")
+        response = requests.get(f"{friends_microservice_url}/friends/{username}", headers=auth_headers())
         # If status code is 200, user exists, we can retrieve the friends.
         if response.status_code == 200:
             # Response is a list of dictionaries, so we retrieve the usernames.
             friend_list = [i['username'] for i in response.json()['friends']]
 
-    return render_template('friends.html', username=username, password=password, success=success,
+    return render_template('friends.html', username=username, success=success,
                            friend_list=friend_list)
 
 
@@ -181,12 +201,12 @@ def add_friend():
     # microservice returns True if the friend request is successful (the friend exists & is not already friends), False if otherwise
     # ==============================
 
-    global username
+    username = session.get('username')
     req_username = request.form['username']
 
     # Send post request to Friends microservice to add a friend.
     response = requests.post(f"{friends_microservice_url}/friends/add",
-                             json={"username": username, "username_friend": req_username})
+                             json={"username": username, "username_friend": req_username}, headers=auth_headers())
 
     # If status code is 200, friend request is successful.
     success = response.status_code == 200
@@ -197,7 +217,7 @@ def add_friend():
 
 @app.route('/playlists')
 def playlists():
-    global username
+    username = session.get('username')
 
     my_playlists = []
     shared_with_me = []
@@ -217,7 +237,7 @@ def playlists():
         my_playlists = [(playlist['id'], playlist['name']) for playlist in response_own['playlists']]
         shared_with_me = [(playlist['id'], playlist['name']) for playlist in response_shared['playlists']]
 
-    return render_template('playlists.html', username=username, password=password, my_playlists=my_playlists,
+    return render_template('playlists.html', username=username, my_playlists=my_playlists,
                            shared_with_me=shared_with_me)
 
 
@@ -228,11 +248,11 @@ def create_playlist():
     #
     # Create a playlist by sending the owner and the title to the microservice.
     # ================================
-    global username
+    username = session.get('username')
     title = request.form['title']
     # Send post request to Playlists microservice to create a playlist.
     response = requests.post(f'{playlists_microservice_url}/playlists',
-                             json={'owner': username, 'name': title})
+                             json={'owner': username, 'name': title}, headers=auth_headers())
     # If status code is 201, playlist is created. (check documentation of endpoint to check what can go wrong)
 
     return redirect('/playlists')
@@ -246,10 +266,11 @@ def a_playlist(playlist_id):
     # List all songs within a playlist
     # ================================
     # Send post request to Playlists microservice to retrieve all songs within playlist.
+    username = session.get('username')
     response = requests.get(f'{playlists_microservice_url}/playlists/{playlist_id}').json()
     songs = [(song['song_title'], song['song_artist']) for song in response['songs']]
 
-    return render_template('a_playlist.html', username=username, password=password, songs=songs,
+    return render_template('a_playlist.html', username=username, songs=songs,
                            playlist_id=playlist_id)
 
 
@@ -260,11 +281,13 @@ def add_song_to_playlist(playlist_id):
     #
     # Add a song (represented by a title & artist) to a playlist (represented by an id)
     # ================================
+    username = session.get('username')
     title, artist = request.form['title'], request.form['artist']
 
     # Send post request to Playlists microservice to add a song to a playlist.
     response = requests.post(f'{playlists_microservice_url}/playlists/{playlist_id}',
-                             json={'song_title': title, 'song_artist': artist, 'added_by': username})
+                             json={'song_title': title, 'song_artist': artist, 'added_by': username},
+                             headers=auth_headers())
 
 
     # If status code is 200, song is added to playlist successfully. (check documentation of endpoint to check what can go wrong)
@@ -281,7 +304,7 @@ def invite_user_to_playlist(playlist_id):
     recipient = request.form['user']
     # Send post request to Playlists microservice to share a playlist with recipient.
     response = requests.post(f'{playlists_microservice_url}/playlists/{playlist_id}/shares',
-                  json={'recipient': recipient})
+                  json={'recipient': recipient}, headers=auth_headers())
 
 
     return redirect(f'/playlists/{playlist_id}')
@@ -289,10 +312,8 @@ def invite_user_to_playlist(playlist_id):
 
 @app.route("/logout")
 def logout():
-    global username, password
-
-    username = None
-    password = None
+    session.pop('username', None)
+    session.pop('token', None)
     return redirect('/')
 
 
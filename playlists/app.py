@@ -1,9 +1,14 @@
-from flask import Flask, jsonify
+from flask import Flask
 from flask import request as flask_request
 from flask_restful import Resource, Api, reqparse
 
 import requests
-import psycopg2
+from psycopg2.extras import execute_values
+
+from common import tokens
+from common.db import Pool
+from common.outbox import Outbox, OUTBOX_STATEMENTS
+from common.users_client import UsersClient
 
 app = Flask('playlists')
 api = Api(app)
@@ -13,17 +18,33 @@ users_microservice_url = "http://users:5000"
 songs_microservice_url = "http://songs:5000"
 activities_microservice_url = "http://activities:5000"
 
-conn = None
+# Checks if users exist, caching the users that do.
+users = UsersClient(users_microservice_url)
+
+# Maximum number of songs the Songs microservice checks in a single batch request.
+SONGS_EXIST_BATCH_SIZE = 1000
+
+# Registry of the SQL statements of this service, prepared once on every pooled connection.
+STATEMENTS = {
+    'playlist_exists': "SELECT * FROM playlists WHERE id = $1",
+    'playlists_by_owner': "SELECT * FROM playlists WHERE owner = $1",
+    'all_playlists': "SELECT * FROM playlists",
+    'playlist_by_name': "SELECT id FROM playlists WHERE name = $1 AND owner = $2",
+    'insert_playlist': "INSERT INTO playlists (name, owner) VALUES ($1, $2) RETURNING id",
+    'playlist_songs': "SELECT * FROM playlist_songs WHERE playlist_id = $1",
+    'insert_playlist_song': "INSERT INTO playlist_songs (playlist_id, song_artist, song_title) VALUES ($1, $2, $3)",
+    'playlist_owner': "SELECT owner FROM playlists WHERE id = $1",
+    'playlist_share': "SELECT * FROM playlist_shares WHERE playlist_id = $1 AND username = $2",
+    'insert_playlist_share': "INSERT INTO playlist_shares (playlist_id, username) VALUES ($1, $2)",
+    'shared_playlists': "SELECT p.id, p.name, p.owner, p.created_at FROM playlists p \
+        JOIN playlist_shares s ON p.id = s.playlist_id WHERE s.username = $1",
+    **OUTBOX_STATEMENTS,
+}
 
-while conn is None:
-    try:
-        conn = psycopg2.connect(dbname="playlists", user="postgres", password="postgres", host="playlists_persistence")
-        print("DB connection succesful")
-    except psycopg2.OperationalError:
-        import time
+pool = Pool(dbname="playlists", host="playlists_persistence", statements=STATEMENTS)
 
-        time.sleep(1)
-        print("Retrying DB connection")
+# Publishes the activities of this service to the Activities microservice, in the background.
+outbox = Outbox(pool, activities_microservice_url, source='playlists')
 
 
 def playlist_exists(playlist_id: int):
@@ -34,9 +55,9 @@ def playlist_exists(playlist_id: int):
     :return: True if the playlist exists, False otherwise.
     """
     # Check if playlist exists.
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM playlists WHERE id=%s", (playlist_id,))
-    return bool(cursor.fetchone())
+    with pool.transaction() as cursor:
+        pool.execute(cursor, 'playlist_exists', (playlist_id,))
+        return bool(cursor.fetchone())
 
 
 def song_exists(title: str, artist: str):
@@ -51,6 +72,22 @@ def song_exists(title: str, artist: str):
     return response.status_code == 200 and response.json()
 
 
+def songs_exist(songs: list):
+    """
+    Checks the existence of many songs in the Songs microservice, using one request per batch of songs.
+
+    :param songs: list of (title, artist) pairs to check.
+    :return: list of booleans, in the same order as the given songs.
+    """
+    exists = []
+    for start in range(0, len(songs), SONGS_EXIST_BATCH_SIZE):
+        batch = [[title, artist] for title, artist in songs[start:start + SONGS_EXIST_BATCH_SIZE]]
+        response = requests.post(f'{songs_microservice_url}/songs/exist/batch', json={'songs': batch})
+        response.raise_for_status()
+        exists.extend(response.json()['exists'])
+    return exists
+
+
 class Playlists(Resource):
     """
     Resource for retrieving playlists and creating new playlists.
@@ -77,18 +114,19 @@ class Playlists(Resource):
     def get(self):
         # Retrieve playlists owned by the specified username (if provided).
         username = flask_request.args.get('username')
-        cursor = conn.cursor()
-        if username:
-            cursor.execute("SELECT * FROM playlists WHERE owner = %s;", (username,))
-        else:
-            cursor.execute("SELECT * FROM playlists;")
+        with pool.transaction() as cursor:
+            if username:
+                pool.execute(cursor, 'playlists_by_owner', (username,))
+            else:
+                pool.execute(cursor, 'all_playlists')
+            rows = cursor.fetchall()
         # Reformat the results.
         playlists = [{
             'id': row[0],
             'name': row[1],
             'owner': row[2],
             'created_at': row[3].strftime('%Y-%m-%d %H:%M:%S')  # Convert datetime to string.
-        } for row in cursor.fetchall()]
+        } for row in rows]
         return {'playlists': playlists}, 200
 
     def post(self):
@@ -98,35 +136,29 @@ class Playlists(Resource):
         parser.add_argument('owner', type=str, required=True)
         args = parser.parse_args()
 
-        # Check if the owner exists.
-        response = requests.get(f'{users_microservice_url}/users/exists?username={args["owner"]}')
+        # Check if the owner exists, unless a valid session token of the owner proves that already.
         # If the owner doesn't exist, we return a 404 Not Found.
-        if not response.json()['exists']:
+        if tokens.session_user(flask_request.headers) != args['owner'] and not users.exists(args['owner']):
             return {'message': 'Owner not found'}, 404
 
-        # Check if the playlist name already exists for the owner.
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id \
-            FROM playlists \
-            WHERE name = %s AND owner = %s;",
-            (args['name'], args['owner']))
-        # If the playlists name already exists for the specified owner, we return a 400 Bad Request.
-        if cursor.fetchone():
-            return {'message': 'Playlist name already exists for the specified owner'}, 400
-
-        # Create the new playlist if everything is ok.
-        cursor.execute(
-            "INSERT INTO playlists (name, owner) \
-            VALUES (%s, %s);", (args['name'], args['owner']))
-        conn.commit()
-
-        # Send post request to activities microservice to create new create_playlist activity.
-        requests.post(f'{activities_microservice_url}/activities/create-playlist', json={
-            'username': args['owner'],
-            # Retrieve id of last created playlist.
-            'playlist_id': cursor.lastrowid
-        })
+        with pool.transaction() as cursor:
+            # Check if the playlist name already exists for the owner.
+            pool.execute(cursor, 'playlist_by_name', (args['name'], args['owner']))
+            # If the playlists name already exists for the specified owner, we return a 400 Bad Request.
+            if cursor.fetchone():
+                return {'message': 'Playlist name already exists for the specified owner'}, 400
+
+            # Create the new playlist if everything is ok, and retrieve its id.
+            pool.execute(cursor, 'insert_playlist', (args['name'], args['owner']))
+            playlist_id = cursor.fetchone()[0]
+
+            # Create new create_playlist activity, which is only published if the playlist is committed.
+            outbox.add(cursor, {
+                'activity_type': 'create_playlist',
+                'username': args['owner'],
+                'playlist_id': playlist_id
+            })
+        outbox.notify()
 
         return {'message': 'Playlist was created successfully'}, 201
 
@@ -160,9 +192,10 @@ class Playlist(Resource):
         if not playlist_exists(playlist_id):
             return {'message': 'Playlist not found'}, 404
 
-        cursor = conn.cursor()
-        # Retrieve songs from playlist.
-        cursor.execute("SELECT * FROM playlist_songs WHERE playlist_id=%s", (playlist_id,))
+        with pool.transaction() as cursor:
+            # Retrieve songs from playlist.
+            pool.execute(cursor, 'playlist_songs', (playlist_id,))
+            rows = cursor.fetchall()
         # Reformat the results.
         songs = [{
             'id': row[0],
@@ -170,7 +203,7 @@ class Playlist(Resource):
             'song_artist': row[2],
             'song_title': row[3],
             'added_at': row[4].strftime('%Y-%m-%d %H:%M:%S')  # Convert datetime to string.
-        } for row in cursor.fetchall()]
+        } for row in rows]
         return {'songs': songs}, 200
 
     def post(self, playlist_id):
@@ -189,24 +222,78 @@ class Playlist(Resource):
         if not song_exists(args['song_title'], args['song_artist']):
             return {'message': 'Song not found'}, 404
 
-        cursor = conn.cursor()
-        # Add the song to the playlist.
-        cursor.execute(
-            "INSERT INTO playlist_songs (playlist_id, song_artist, song_title) \
-            VALUES (%s, %s, %s);", (playlist_id, args['song_artist'], args['song_title']))
-        conn.commit()
-
-        # Send request to Activities microservice to create new add_song activity.
-        requests.post(f'{activities_microservice_url}/activities/add-song', json={
-            'username': args['added_by'],
-            'playlist_id': playlist_id,
-            'song_artist': args['song_artist'],
-            'song_title': args['song_title']
-        })
+        with pool.transaction() as cursor:
+            # Add the song to the playlist.
+            pool.execute(cursor, 'insert_playlist_song', (playlist_id, args['song_artist'], args['song_title']))
+
+            # Create new add_song activity, which is only published if the song is committed.
+            outbox.add(cursor, {
+                'activity_type': 'add_song',
+                'username': args['added_by'],
+                'playlist_id': playlist_id,
+                'song_artist': args['song_artist'],
+                'song_title': args['song_title']
+            })
+        outbox.notify()
 
         return {'message': 'Song added to playlist successfully'}, 200
 
 
+class PlaylistSongsBatch(Resource):
+    """
+    Resource for adding many songs to a playlist at once, e.g. when importing a playlist.
+
+    POST /playlists/<playlist_id>/songs/batch
+    Adds all specified songs to the playlist, or none of them if any song could not be found.
+
+    Request data:
+    - songs: A list of songs, each a {'song_title': ..., 'song_artist': ...} object.
+    - added_by: The username of the user who added the songs.
+
+    Response:
+    - 200 OK: The songs were added to the playlist successfully.
+    - 400 Bad Request: The songs were missing or malformed.
+    - 404 Not Found: The playlist or any of the songs could not be found, the missing songs are returned.
+    """
+
+    def post(self, playlist_id):
+        # Parse the request data.
+        data = flask_request.get_json(silent=True) or {}
+        songs, added_by = data.get('songs'), data.get('added_by')
+        if not isinstance(songs, list) or not isinstance(added_by, str):
+            return {'message': 'Missing request data: songs and added_by'}, 400
+        if not all(isinstance(song, dict) and isinstance(song.get('song_title'), str)
+                   and isinstance(song.get('song_artist'), str) for song in songs):
+            return {'message': 'Every song must have a song_title and song_artist'}, 400
+
+        # Return 404 Not Found if playlist doesn't exist.
+        if not playlist_exists(playlist_id):
+            return {'message': 'Playlist not found'}, 404
+
+        # Validate all songs with a single round trip to the Songs microservice.
+        pairs = [(song['song_title'], song['song_artist']) for song in songs]
+        missing = [song for song, exists in zip(songs, songs_exist(pairs)) if not exists]
+        if missing:
+            return {'message': 'Songs not found', 'songs': missing}, 404
+
+        with pool.transaction() as cursor:
+            # Add all songs to the playlist in one statement.
+            execute_values(cursor, "INSERT INTO playlist_songs (playlist_id, song_artist, song_title) VALUES %s;",
+                           [(playlist_id, artist, title) for title, artist in pairs])
+
+            # Create new add_song activities, which are sent to the Activities microservice in batches.
+            outbox.add_many(cursor, [{
+                'activity_type': 'add_song',
+                'username': added_by,
+                'playlist_id': playlist_id,
+                'song_artist': artist,
+                'song_title': title
+            } for title, artist in pairs])
+        outbox.notify()
+
+        return {'message': 'Songs added to playlist successfully'}, 200
+
+
 class PlaylistShare(Resource):
     """
     Resource for sharing a playlist with another user.
@@ -230,42 +317,38 @@ class PlaylistShare(Resource):
         parser.add_argument('recipient', type=str, required=True)
         args = parser.parse_args()
 
-        cursor = conn.cursor()
         # Check if the playlist exists.
         if not playlist_exists(playlist_id):
             return {'message': 'Playlist not found'}, 404
 
         # Check if the user being shared the playlist exists.
-        response = requests.get(f'{users_microservice_url}/users/exists?username={args["recipient"]}')
-        if not response.json()['exists']:
+        if not users.exists(args['recipient']):
             return {'message': 'User not found'}, 404
 
-        # Check if the user is sharing the playlist with themselves.
-        cursor.execute("SELECT owner FROM playlists WHERE id=%s", (playlist_id,))
-        owner = cursor.fetchone()[0]
-        # Return 404 Bad Request.
-        if owner == args['recipient']:
-            return {'message': 'You cannot share the playlist with yourself'}, 400
-
-        # Check if the playlist is already shared with the recipient.
-        cursor.execute("SELECT * FROM playlist_shares WHERE playlist_id=%s AND username=%s",
-                       (playlist_id, args['recipient']))
-        if cursor.fetchone():
-            return {'message': 'Playlist is already shared with the specified user'}, 409
-
-        # Share the playlist with the user.
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO playlist_shares (playlist_id, username) \
-            VALUES (%s, %s);", (playlist_id, args['recipient']))
-        conn.commit()
-
-        # Send request to Activities microservice to create new share_playlist activity.
-        requests.post(f'{activities_microservice_url}/activities/share-playlist', json={
-            'username': owner,
-            'username_friend': args['recipient'],
-            'playlist_id': playlist_id,
-        })
+        with pool.transaction() as cursor:
+            # Check if the user is sharing the playlist with themselves.
+            pool.execute(cursor, 'playlist_owner', (playlist_id,))
+            owner = cursor.fetchone()[0]
+            # Return 404 Bad Request.
+            if owner == args['recipient']:
+                return {'message': 'You cannot share the playlist with yourself'}, 400
+
+            # Check if the playlist is already shared with the recipient.
+            pool.execute(cursor, 'playlist_share', (playlist_id, args['recipient']))
+            if cursor.fetchone():
+                return {'message': 'Playlist is already shared with the specified user'}, 409
+
+            # Share the playlist with the user.
+            pool.execute(cursor, 'insert_playlist_share', (playlist_id, args['recipient']))
+
+            # Create new share_playlist activity, which is only published if the share is committed.
+            outbox.add(cursor, {
+                'activity_type': 'share_playlist',
+                'username': owner,
+                'username_friend': args['recipient'],
+                'playlist_id': playlist_id,
+            })
+        outbox.notify()
 
         return {'message': 'Playlist shared successfully'}, 200
 
@@ -283,26 +366,37 @@ class SharedPlaylists(Resource):
     def get(self):
         # Parse the request data.
         username = flask_request.args.get('username')
-        cursor = conn.cursor()
 
-        # Retrieve all playlists shared with the user.
-        cursor.execute(
-            "SELECT p.id, p.name, p.owner, p.created_at FROM playlists p \
-            JOIN playlist_shares s ON p.id = s.playlist_id WHERE s.username = %s;", (username,))
+        with pool.transaction() as cursor:
+            # Retrieve all playlists shared with the user.
+            pool.execute(cursor, 'shared_playlists', (username,))
+            rows = cursor.fetchall()
 
-        playlists = []
         # Reformat the results.
         playlists = [{
             'id': row[0],
             'name': row[1],
             'owner': row[2],
             'created_at': row[3].strftime('%Y-%m-%d %H:%M:%S')  # Convert datetime to string.
-        } for row in cursor.fetchall()]
+        } for row in rows]
         return {'playlists': playlists}, 200
 
 
+class DatabaseMetrics(Resource):
+    """
+    GET /playlists/db/metrics
+    Retrieves the size and usage counters of the database connection pool, the number of calls and latency of every
+    prepared statement (most total time first), and the counters of the outbox.
+    """
+
+    def get(self):
+        return {**pool.metrics(), 'statements': pool.statement_metrics(), 'outbox': outbox.metrics()}, 200
+
+
 # Add the resources to the API.
 api.add_resource(Playlists, '/playlists')
 api.add_resource(Playlist, '/playlists/<int:playlist_id>')
+api.add_resource(PlaylistSongsBatch, '/playlists/<int:playlist_id>/songs/batch')
 api.add_resource(PlaylistShare, '/playlists/<int:playlist_id>/shares')
 api.add_resource(SharedPlaylists, '/playlists/shared')
+api.add_resource(DatabaseMetrics, '/playlists/db/metrics')
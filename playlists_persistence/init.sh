@@ -29,4 +29,20 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "playlists" <<-EOSQ
       username VARCHAR(255) NOT NULL,
       shared_at TIMESTAMP DEFAULT NOW()
     );
+
+    -- Activities that still have to be published to the Activities service (common/outbox.py).
+    CREATE TABLE IF NOT EXISTS outbox (
+      id BIGSERIAL PRIMARY KEY,
+      payload JSONB NOT NULL,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    -- Activities of the outbox that the Activities service rejected, with its response.
+    CREATE TABLE IF NOT EXISTS outbox_dead (
+      id BIGINT PRIMARY KEY,
+      payload JSONB NOT NULL,
+      created_at TIMESTAMP NOT NULL,
+      error TEXT NOT NULL,
+      failed_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
 EOSQL
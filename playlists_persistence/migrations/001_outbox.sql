@@ -0,0 +1,8 @@
+-- Adds the outbox of the activities that still have to be published to the Activities service, to a playlists database
+-- that was initialised before it existed.
+-- Run with: psql --username postgres --dbname playlists -f 001_outbox.sql
+CREATE TABLE IF NOT EXISTS outbox (
+  id BIGSERIAL PRIMARY KEY,
+  payload JSONB NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
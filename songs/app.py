@@ -1,7 +1,18 @@
-from flask import Flask
+from flask import Flask, Response
 from flask import request as flask_request
 from flask_restful import Resource, Api, reqparse
+
+import collections
+import csv
+import io
+import json
 import psycopg2
+import threading
+import time
+
+from common.cache import BloomFilter, LRUCache
+from common.db import Pool
+from search import SongIndex
 
 parser = reqparse.RequestParser()
 parser.add_argument('title')
@@ -10,60 +21,493 @@ parser.add_argument('artist')
 app = Flask("songs")
 api = Api(app)
 
-conn = None
+# Default and maximum number of songs returned in a single page of the catalogue.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+# Number of rows fetched per round trip by the server-side cursor used for streaming exports.
+EXPORT_ITERSIZE = 2000
+# Maximum number of songs that can be checked in a single batch existence request.
+MAX_EXISTS_BATCH = 1000
+# Default and maximum number of results returned by a search.
+DEFAULT_SEARCH_RESULTS = 10
+MAX_SEARCH_RESULTS = 100
+# Target false positive rate of the song existence filter, and its minimum capacity to leave room for new songs.
+EXISTS_FILTER_FALSE_POSITIVE_RATE = 0.01
+EXISTS_FILTER_MIN_CAPACITY = 100000
+# Number of positive existence checks that are cached, and for how many seconds.
+EXISTS_CACHE_SIZE = 10000
+EXISTS_CACHE_TTL = 300
 
-while conn is None:
-    try:
-        conn = psycopg2.connect(dbname="songs", user="postgres", password="postgres", host="songs_persistence")
-        print("DB connection succesful")
-    except psycopg2.OperationalError:
-        import time
 
-        time.sleep(1)
-        print("Retrying DB connection")
+# Registry of the SQL statements of this service, prepared once on every pooled connection.
+STATEMENTS = {
+    'songs_first_page': "SELECT title, artist FROM songs ORDER BY artist, title LIMIT $1",
+    # Row comparison lets Postgres seek straight into the primary key index, so every page costs the same.
+    'songs_page': "SELECT title, artist FROM songs WHERE (artist, title) > ($1, $2) ORDER BY artist, title LIMIT $3",
+    'insert_song': "INSERT INTO songs (title, artist) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+    'song_exists': "SELECT COUNT(*) FROM songs WHERE title = $1 AND artist = $2",
+    'song_exists_normalized': "SELECT EXISTS (SELECT 1 FROM songs "
+                              "WHERE song_key(artist) = song_key($1) AND song_key(title) = song_key($2))",
+    'songs_exist': "SELECT q.title, q.artist FROM unnest($1::text[], $2::text[]) AS q(title, artist) "
+                   "JOIN songs s ON s.artist = q.artist AND s.title = q.title",
+}
+
+pool = Pool(dbname="songs", host="songs_persistence", statements=STATEMENTS)
+
+
+def songs_page(after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Retrieves a single page of the catalogue, walking the (artist, title) primary key.
+
+    :param after: (artist, title) of the last song of the previous page, None for the first page.
+    :param limit: maximum number of songs to return.
+    :return: list of (title, artist) rows, ordered by artist and title.
+    """
+    with pool.transaction() as cur:
+        if after:
+            pool.execute(cur, 'songs_page', (after[0], after[1], limit))
+        else:
+            pool.execute(cur, 'songs_first_page', (limit,))
+        return cur.fetchall()
+
+
+def stream_songs(after=None, limit=None):
+    """
+    Lazily yields the catalogue from a server-side cursor, such that an export never holds every row in memory.
+
+    The connection stays checked out of the pool for as long as the client is reading, since the named cursor lives
+    in its transaction.
+
+    :param after: (artist, title) to start after, None to start at the beginning of the catalogue.
+    :param limit: maximum number of songs to yield, None for the remainder of the catalogue.
+    :return: generator of (title, artist) rows, ordered by artist and title.
+    """
+    with pool.connection() as conn:
+        cur = conn.cursor(name='songs_export')
+        cur.itersize = EXPORT_ITERSIZE
+        # LIMIT NULL is the same as no limit at all.
+        if after:
+            cur.execute("SELECT title, artist FROM songs WHERE (artist, title) > (%s, %s) "
+                        "ORDER BY artist, title LIMIT %s;", (after[0], after[1], limit))
+        else:
+            cur.execute("SELECT title, artist FROM songs ORDER BY artist, title LIMIT %s;", (limit,))
+        for row in cur:
+            yield row
+        cur.close()
 
 
-def all_songs(limit=1000):
-    cur = conn.cursor()
-    cur.execute(f"SELECT title, artist FROM songs LIMIT {limit};")
-    return cur.fetchall()
+# Build the search index over the whole catalogue when the service starts.
+search_index = SongIndex()
+search_index.build(stream_songs())
+app.logger.info('Indexed %d songs for search', len(search_index))
+
+# Build the existence filter over all (title, artist) keys, sized for twice the current catalogue. The keys are taken
+# from the search index, such that the catalogue is only read once.
+exists_filter = BloomFilter(max(EXISTS_FILTER_MIN_CAPACITY, 2 * len(search_index)), EXISTS_FILTER_FALSE_POSITIVE_RATE)
+for song in search_index.songs():
+    exists_filter.add(song)
+# Positive existence checks, the catalogue is (almost) read-only so these rarely change.
+exists_cache = LRUCache(EXISTS_CACHE_SIZE, EXISTS_CACHE_TTL)
+# Counters of how existence checks were answered, used to size the filter and the cache.
+exists_stats = collections.Counter()
+exists_stats_lock = threading.Lock()
+
+
+def count_exists(**counts):
+    with exists_stats_lock:
+        exists_stats.update(counts)
+
+
+def song_added(title, artist):
+    # Keep the search index, existence filter and cache in sync with the catalogue.
+    search_index.add(title, artist)
+    exists_filter.add((title, artist))
+    exists_cache.put((title, artist), True)
 
 
 def add_song(title, artist):
     if not song_exists(title, artist):
-        cur = conn.cursor()
-        cur.execute("INSERT INTO songs (title, artist) VALUES (%s, %s);", (title, artist))
-        conn.commit()
-        return True
+        with pool.transaction() as cur:
+            # The conflict clause makes concurrent adds of the same song safe, only one of them inserts it.
+            pool.execute(cur, 'insert_song', (title, artist))
+            inserted = cur.rowcount
+        if inserted:
+            song_added(title, artist)
+            return True
     return False
 
 
+def _ndjson_song(line):
+    """
+    Parses a single NDJSON line into an (artist, title) row.
+
+    :raises ValueError: if the line is not a JSON object with a non-empty artist and song.
+    """
+    try:
+        song = json.loads(line)
+    except ValueError:
+        raise ValueError('not valid JSON') from None
+    if not isinstance(song, dict):
+        raise ValueError('not a JSON object')
+    # Accept 'title' as well, for songs coming from the other endpoints.
+    row = (song.get('artist'), song.get('song', song.get('title')))
+    for name, value in zip(('artist', 'song'), row):
+        if not isinstance(value, str) or not value:
+            raise ValueError(f'missing {name}')
+    return row
+
+
+class _NDJSONAsCSV(io.RawIOBase):
+    """
+    Read-only file that converts NDJSON songs ({"artist": ..., "song": ...} per line) to CSV on the fly, such that
+    both formats can be streamed through the same COPY.
+
+    Every line is validated before its row is handed to COPY. An error raised inside read() would abort the COPY as a
+    QueryCanceled, so the first malformed line is recorded in `error` instead and ends the stream.
+    """
+
+    def __init__(self, lines):
+        self._lines = enumerate(lines, start=1)
+        self._buffer = b''
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) < len(b) and self.error is None:
+            number, line = next(self._lines, (None, None))
+            if line is None:
+                break
+            try:
+                line = line.decode()
+                if not line.strip():
+                    continue
+                song = _ndjson_song(line)
+            except ValueError as e:
+                self.error = f'line {number}: {e}'
+                break
+            row = io.StringIO()
+            csv.writer(row).writerow(song)
+            self._buffer += row.getvalue().encode()
+        size = min(len(b), len(self._buffer))
+        b[:size], self._buffer = self._buffer[:size], self._buffer[size:]
+        return size
+
+
+def bulk_add_songs(stream, fmt):
+    """
+    Adds many songs at once, by streaming them through COPY into a staging table and merging that into the catalogue.
+
+    The whole load runs in a single transaction, such that a malformed body doesn't leave half of it behind.
+
+    :param stream: binary file-like object with the songs, in the format of mil_song.csv (artist,song).
+    :param fmt: either 'csv' (with a header line) or 'ndjson'.
+    :return: tuple of the number of rows received, the number of CSV rows skipped because their artist or song is
+             empty, and the (title, artist) pairs that were inserted.
+    :raises ValueError: if an NDJSON line is malformed, with its line number.
+    """
+    with pool.transaction() as cur:
+        cur.execute("CREATE TEMP TABLE songs_staging (artist TEXT, title TEXT) ON COMMIT DROP;")
+        if fmt == 'ndjson':
+            source = _NDJSONAsCSV(iter(stream))
+            cur.copy_expert("COPY songs_staging (artist, title) FROM STDIN WITH (FORMAT csv);", source)
+            if source.error:
+                # Raising rolls back the rows that were copied before the malformed line.
+                raise ValueError(source.error)
+        else:
+            cur.copy_expert("COPY songs_staging (artist, title) FROM STDIN WITH (FORMAT csv, HEADER true);", stream)
+        received = cur.rowcount
+        cur.execute("DELETE FROM songs_staging WHERE artist IS NULL OR title IS NULL;")
+        skipped = cur.rowcount
+        cur.execute("INSERT INTO songs (artist, title) SELECT artist, title FROM songs_staging "
+                    "ON CONFLICT DO NOTHING RETURNING title, artist;")
+        return received, skipped, cur.fetchall()
+
+
+def song_exists_normalized(title, artist):
+    """
+    Checks if a song exists, ignoring case and differences in whitespace.
+
+    Both sides are compared through song_key(), which has its own index, so this is a single index probe as well.
+
+    :param title: title of the song to check.
+    :param artist: artist of the song to check.
+    :return: True if the song exists, False otherwise.
+    """
+    with pool.transaction() as cur:
+        pool.execute(cur, 'song_exists_normalized', (artist, title))
+        return cur.fetchone()[0]
+
+
 def song_exists(title, artist):
-    cur = conn.cursor()
     app.logger.info('title: %s, artist: %s', title, artist)
-    # # Added LOWER() to make the search case-insensitive.
-    # cur.execute("SELECT COUNT(*) FROM songs WHERE LOWER(title) = LOWER(%s) AND LOWER(artist) = LOWER(%s);", (title, artist))
-    cur.execute("SELECT COUNT(*) FROM songs WHERE title = %s AND artist = %s;", (title, artist))
-    return bool(cur.fetchone()[0])  # Either True or False
+    key = (title, artist)
+    # The filter has no false negatives, so a song it doesn't contain definitely doesn't exist.
+    if key not in exists_filter:
+        count_exists(filter_negatives=1)
+        return False
+    if exists_cache.get(key):
+        return True
+
+    with pool.transaction() as cur:
+        # Case-insensitive lookups are done by song_exists_normalized(), which is backed by its own index.
+        pool.execute(cur, 'song_exists', (title, artist))
+        exists = bool(cur.fetchone()[0])  # Either True or False
+    if exists:
+        exists_cache.put(key, True)
+        count_exists(db_positives=1)
+    else:
+        # The filter claimed the song might exist, but it doesn't.
+        count_exists(false_positives=1)
+    return exists
 
 
 class AllSongsResource(Resource):
+    """
+    Resource for browsing the catalogue.
+
+    GET /songs/?limit=<limit>&after_artist=<artist>&after_title=<title>&format=<format>
+    Retrieves the catalogue ordered by artist and title, starting after the given (artist, title) cursor.
+
+    Query parameters:
+    - limit: The maximum number of songs to retrieve, default is 1000 (at most 5000 for 'json').
+    - after_artist, after_title (optional): The artist and title of the last song of the previous page.
+    - format: Either 'json' (a single page, default) or 'ndjson' (a stream of one [title, artist] per line,
+      covering the rest of the catalogue when no limit is given).
+
+    Response:
+    - 200 OK: The songs were retrieved successfully. For 'json' the body is {'songs': [[title, artist], ...],
+      'next': {'artist': ..., 'title': ...}}, where 'next' is null on the last page.
+    - 400 Bad Request: The limit, cursor or format was invalid.
+    """
+
     def get(self):
-        return all_songs()
+        args = flask_request.args
+        fmt = args.get('format', 'json')
+        if fmt not in ['json', 'ndjson']:
+            return {'message': 'Invalid format, expected json or ndjson'}, 400
+
+        # Both halves of the cursor have to be given together.
+        after_artist, after_title = args.get('after_artist'), args.get('after_title')
+        if (after_artist is None) != (after_title is None):
+            return {'message': 'after_artist and after_title must be given together'}, 400
+        after = (after_artist, after_title) if after_artist is not None else None
+
+        limit = args.get('limit', type=int)
+        if 'limit' in args and (limit is None or limit < 1):
+            return {'message': 'limit must be a positive integer'}, 400
+
+        if fmt == 'ndjson':
+            lines = (json.dumps(row) + '\n' for row in stream_songs(after, limit))
+            return Response(lines, mimetype='application/x-ndjson')
+
+        limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        songs = songs_page(after, limit)
+        # Only hand out a cursor if the page was full, otherwise this was the last page.
+        next_cursor = {'artist': songs[-1][1], 'title': songs[-1][0]} if len(songs) == limit else None
+        return {'songs': songs, 'next': next_cursor}
+
+
+class SearchSongs(Resource):
+    """
+    Resource for searching the catalogue, e.g. to autocomplete songs while the user is typing.
+
+    GET /songs/search?q=<query>&k=<k>
+    Retrieves the songs whose title and artist contain every word of the query, the last word may be incomplete.
+    Matching is case and accent insensitive.
+
+    Query parameters:
+    - q: The query to search for.
+    - k: The maximum number of songs to retrieve, default is 10 (at most 100).
+
+    Response:
+    - 200 OK: The songs were retrieved successfully, best match first, as {'songs': [[title, artist], ...]}.
+    - 400 Bad Request: The query parameter was missing or k was invalid.
+    """
+
+    def get(self):
+        args = flask_request.args
+        query = args.get('q')
+        if query is None:
+            return {'message': 'Missing query parameter: q'}, 400
+        k = args.get('k', type=int)
+        if 'k' in args and (k is None or k < 1):
+            return {'message': 'k must be a positive integer'}, 400
+        return {'songs': search_index.search(query, min(k or DEFAULT_SEARCH_RESULTS, MAX_SEARCH_RESULTS))}, 200
 
 
 class SongExists(Resource):
+    """
+    Resource for checking if a song exists.
+
+    GET /songs/exist/?title=<title>&artist=<artist>&normalized=<normalized>
+    Returns True if the song exists, otherwise returns False.
+
+    Query parameters:
+    - title, artist: The title and artist of the song.
+    - normalized (optional): If 'true', case and whitespace differences are ignored, default is 'false'.
+    """
+
     def get(self):
         args = flask_request.args
+        if args.get('normalized', 'false').lower() == 'true':
+            return song_exists_normalized(args['title'], args['artist'])
         return song_exists(args['title'], args['artist'])
 
 
+def songs_exist(songs):
+    """
+    Checks the existence of many songs at once, using a single primary key join.
+
+    :param songs: list of (title, artist) pairs.
+    :return: list of booleans, in the same order as the given songs.
+    """
+    # Only songs that pass the existence filter, and that are not cached as existing, have to be looked up.
+    candidates = {song for song in songs if song in exists_filter}
+    count_exists(filter_negatives=sum(song not in candidates for song in songs))
+    found = {song for song in candidates if exists_cache.get(song)}
+    candidates -= found
+    if candidates:
+        with pool.transaction() as cur:
+            pool.execute(cur, 'songs_exist', ([title for title, _ in candidates], [artist for _, artist in candidates]))
+            exists = set(cur.fetchall())
+        for song in exists:
+            exists_cache.put(song, True)
+        count_exists(db_positives=len(exists), false_positives=len(candidates - exists))
+        found |= exists
+    return [song in found for song in songs]
+
+
+class SongsExistBatch(Resource):
+    """
+    Resource for checking the existence of many songs in one request.
+
+    POST /songs/exist/batch
+    Checks which of the given songs exist in the catalogue.
+
+    Request data:
+    - songs: A list of at most 1000 songs, each either a [title, artist] pair or a {'title': ..., 'artist': ...} object.
+
+    Response:
+    - 200 OK: The existence of the songs was checked successfully, as {'exists': [true, false, ...]} in request order.
+    - 400 Bad Request: The songs were missing, malformed or exceeded the batch size.
+    """
+
+    def post(self):
+        data = flask_request.get_json(silent=True) or {}
+        songs = data.get('songs')
+        if not isinstance(songs, list):
+            return {'message': 'Missing request data: songs'}, 400
+        if len(songs) > MAX_EXISTS_BATCH:
+            return {'message': f'At most {MAX_EXISTS_BATCH} songs can be checked at once'}, 400
+
+        pairs = []
+        for song in songs:
+            if isinstance(song, dict):
+                song = (song.get('title'), song.get('artist'))
+            if not isinstance(song, (list, tuple)) or len(song) != 2 or not all(isinstance(x, str) for x in song):
+                return {'message': 'Every song must be a [title, artist] pair'}, 400
+            pairs.append(tuple(song))
+        return {'exists': songs_exist(pairs)}, 200
+
+
+class SongExistsStats(Resource):
+    """
+    Resource for inspecting the existence filter and cache, e.g. to size them for the real catalogue.
+
+    GET /songs/exist/stats
+    Retrieves how existence checks were answered so far and the state of the filter and cache.
+
+    Response:
+    - 200 OK: The statistics were retrieved successfully.
+    """
+
+    def get(self):
+        with exists_stats_lock:
+            stats = dict(exists_stats)
+        return {
+            'filter_negatives': stats.get('filter_negatives', 0),
+            'false_positives': stats.get('false_positives', 0),
+            'db_positives': stats.get('db_positives', 0),
+            'cache_hits': exists_cache.hits,
+            'cache_misses': exists_cache.misses,
+            'cache_size': len(exists_cache),
+            'filter': {
+                'keys': len(exists_filter),
+                'capacity': exists_filter.capacity,
+                'bits': exists_filter.num_bits,
+                'hashes': exists_filter.num_hashes,
+                'estimated_false_positive_rate': exists_filter.estimated_false_positive_rate(),
+            },
+        }, 200
+
+
+class DatabaseMetrics(Resource):
+    """
+    GET /songs/db/metrics
+    Retrieves the size and usage counters of the database connection pool, and the number of calls and latency of
+    every prepared statement (most total time first).
+    """
+
+    def get(self):
+        return {**pool.metrics(), 'statements': pool.statement_metrics()}, 200
+
+
 class AddSong(Resource):
     def put(self):
         args = flask_request.args
         return add_song(args['title'], args['artist'])
 
 
+class BulkAddSongs(Resource):
+    """
+    Resource for loading many songs at once, e.g. a delta of the catalogue.
+
+    PUT /songs/bulk
+    Adds all songs in the request body, songs that already exist are skipped.
+
+    Request data (the body itself, not a form):
+    - Content-Type text/csv: A CSV file in the format of mil_song.csv, i.e. a header line and artist,song rows.
+    - Content-Type application/x-ndjson: One {"artist": ..., "song": ...} object per line.
+
+    Response:
+    - 200 OK: The songs were loaded, returns the number of received, inserted and duplicate songs and the throughput.
+      CSV rows with an empty artist or song are not loaded, and counted as skipped.
+    - 400 Bad Request: The content type is not supported or the body is malformed, e.g. an NDJSON line that is not
+      valid JSON or has no artist or song (the message has its line number). Nothing is loaded in that case.
+    """
+
+    def put(self):
+        content_type = flask_request.mimetype
+        if content_type not in ['text/csv', 'application/x-ndjson']:
+            return {'message': 'Content-Type must be text/csv or application/x-ndjson'}, 400
+
+        start = time.perf_counter()
+        try:
+            received, skipped, inserted = bulk_add_songs(flask_request.stream,
+                                                         'csv' if content_type == 'text/csv' else 'ndjson')
+        except (psycopg2.DataError, ValueError) as e:
+            return {'message': f'Malformed songs: {e}'}, 400
+        for title, artist in inserted:
+            song_added(title, artist)
+        seconds = time.perf_counter() - start
+
+        return {
+            'received': received,
+            'inserted': len(inserted),
+            'duplicates': received - skipped - len(inserted),
+            'skipped': skipped,
+            'seconds': round(seconds, 3),
+            'songs_per_second': round(received / seconds) if seconds else None,
+        }, 200
+
+
 api.add_resource(AllSongsResource, '/songs/')
+api.add_resource(SearchSongs, '/songs/search')
 api.add_resource(SongExists, '/songs/exist/')
+api.add_resource(SongsExistBatch, '/songs/exist/batch')
+api.add_resource(SongExistsStats, '/songs/exist/stats')
 api.add_resource(AddSong, '/songs/add/')
+api.add_resource(BulkAddSongs, '/songs/bulk')
+api.add_resource(DatabaseMetrics, '/songs/db/metrics')
@@ -0,0 +1,275 @@
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+
+# Maximum number of completions remembered per trie node, the most frequent tokens are kept. This also bounds the
+# number of posting lists that are merged for a query.
+MAX_COMPLETIONS = 32
+
+_non_alnum = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text: str):
+    """
+    Normalizes a title or artist into its search tokens.
+
+    Accents are stripped, everything is case folded and anything that is not a letter or digit separates tokens,
+    such that 'Beyoncé - Halo' and 'beyonce halo' result in the same tokens.
+
+    :param text: the text to normalize.
+    :return: list of tokens, in the order in which they appear in the text.
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return _non_alnum.sub(' ', stripped.casefold()).split()
+
+
+class _TrieNode:
+    __slots__ = ('children', 'completions')
+
+    def __init__(self):
+        self.children = {}
+        # (-number of songs, token) of the most frequent tokens with this prefix, most frequent first (ties: a to z).
+        self.completions = []
+
+
+class SongIndex:
+    """
+    In-memory search index over the titles and artists of the catalogue.
+
+    Every song is split into normalized tokens. An inverted index maps each token to the songs containing it, while a
+    prefix trie maps each prefix to its most frequent complete tokens. A query matches every one of its tokens, where
+    the last token may be incomplete (as is the case while the user is still typing).
+
+    The songs of a token are kept sorted on their static rank (the length of the title), such that the best songs of a
+    query are at the front of its posting lists.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._songs = []  # Song id -> (title, artist).
+        self._ids = {}  # (artist, title) -> song id.
+        self._normalized = []  # Song id -> (normalized title, normalized artist, set of tokens).
+        self._postings = {}  # Token -> sorted list of (rank, song id) of the songs containing it.
+        self._leading = {}  # Token -> sorted list of (rank, song id) of the songs whose title or artist starts with it.
+        self._root = _TrieNode()
+
+    def __len__(self):
+        return len(self._songs)
+
+    def songs(self):
+        """
+        :return: list of the (title, artist) of every indexed song.
+        """
+        with self._lock:
+            return list(self._songs)
+
+    def build(self, rows):
+        """
+        Builds the index from scratch.
+
+        The inverted index is filled first, such that every distinct token only has to be inserted in the trie once,
+        with its final frequency.
+
+        :param rows: iterable of (title, artist) rows.
+        """
+        with self._lock:
+            for title, artist in rows:
+                self._add_postings(title, artist, insort=False)
+            for postings in (self._postings, self._leading):
+                for songs in postings.values():
+                    songs.sort()
+            for token, songs in self._postings.items():
+                self._insert_token(token, len(songs))
+
+    def add(self, title: str, artist: str):
+        """
+        Adds a single song to the index, does nothing if the song is already indexed.
+
+        :param title: title of the song.
+        :param artist: artist of the song.
+        """
+        with self._lock:
+            for token in self._add_postings(title, artist):
+                self._insert_token(token, len(self._postings[token]))
+
+    def search(self, query: str, k: int = 10):
+        """
+        Retrieves the best matching songs for a query.
+
+        Songs whose title or artist starts with the query rank first, then songs in which the last (possibly
+        incomplete) token of the query is a complete word, and finally songs with shorter titles. Of the songs that
+        start with the query, the ones where the last token is a complete word go first as well.
+
+        Every posting list is kept sorted on the title length, so the songs are taken in ranking order from the posting
+        lists, one tier at a time, and only about k songs are looked at instead of every match.
+
+        :param query: the (partial) query typed by the user.
+        :param k: maximum number of songs to return.
+        :return: list of (title, artist) tuples, best match first.
+        """
+        tokens = normalize(query)
+        if not tokens:
+            return []
+        *complete, prefix = tokens
+
+        with self._lock:
+            if complete:
+                song_ids = self._search_phrase(complete, prefix, k)
+            else:
+                song_ids = self._take(self._prefix_tiers(prefix, self._completions(prefix)), k)
+                if len(song_ids) < k and self._capped(prefix):
+                    # Fewer matches than requested among the most frequent completions, so try every completion.
+                    song_ids = self._take(self._prefix_tiers(prefix, self._completions(prefix, everything=True)), k)
+            return [self._songs[song_id] for song_id in song_ids]
+
+    def _prefix_tiers(self, prefix, expansions):
+        """
+        :param expansions: the tokens that start with the prefix.
+        :return: list of the tiers of songs matching a single (partial) token, best first, every tier ordered by rank.
+        """
+        others = [token for token in expansions if token != prefix]
+        # The posting lists of the expansions are merged lazily, in a heap with an entry per expansion.
+        return [
+            self._leading.get(prefix, []),
+            heapq.merge(*(self._leading.get(token, []) for token in others)),
+            self._postings.get(prefix, []),
+            heapq.merge(*(self._postings[token] for token in others)),
+        ]
+
+    @staticmethod
+    def _take(tiers, k):
+        """
+        :return: list of the first k distinct song ids of the tiers, in order.
+        """
+        song_ids, seen = [], set()
+        for tier in tiers:
+            for _, song_id in tier:
+                if song_id not in seen:
+                    seen.add(song_id)
+                    song_ids.append(song_id)
+                    if len(song_ids) == k:
+                        return song_ids
+        return song_ids
+
+    def _search_phrase(self, complete, prefix, k):
+        """
+        Searches songs that contain every complete token, and a word that starts with the prefix.
+
+        Every tier is taken from the shortest posting list its songs must be in: songs that start with the query are in
+        the leading list of the first token, and songs with the prefix as a complete word are in its posting list.
+        """
+        postings = [self._postings.get(token) for token in complete]
+        if not all(postings):
+            return []
+        required = frozenset(complete)
+        phrase = ' '.join(complete + [prefix])
+
+        def tier_of(song_id):
+            title, artist, words = self._normalized[song_id]
+            if not required <= words:
+                return None
+            exact = prefix in words
+            if not exact and not any(word.startswith(prefix) for word in words):
+                return None
+            return title.startswith(phrase) or artist.startswith(phrase), exact
+
+        rarest = min(postings, key=len)
+        leading = self._leading.get(complete[0], [])
+        exact = self._postings.get(prefix, [])
+        tiers = [
+            ((True, True), min(leading, exact, key=len)),
+            ((True, False), leading),
+            ((False, True), min(rarest, exact, key=len)),
+            ((False, False), rarest),
+        ]
+        song_ids = []
+        for tier, songs in tiers:
+            for _, song_id in songs:
+                if tier_of(song_id) == tier:
+                    song_ids.append(song_id)
+                    if len(song_ids) == k:
+                        return song_ids
+        return song_ids
+
+    def _add_postings(self, title, artist, insort=True):
+        """
+        Registers a song in the inverted index.
+
+        :param insort: keep the posting lists sorted, otherwise the song is appended and they have to be sorted after.
+        :return: the distinct tokens of the song, empty if the song was already indexed.
+        """
+        if (artist, title) in self._ids:
+            return set()
+        song_id = len(self._songs)
+        self._ids[(artist, title)] = song_id
+        self._songs.append((title, artist))
+
+        title_tokens, artist_tokens = normalize(title), normalize(artist)
+        tokens = frozenset(title_tokens) | frozenset(artist_tokens)
+        normalized_title = ' '.join(title_tokens)
+        self._normalized.append((normalized_title, ' '.join(artist_tokens), tokens))
+        entry = (len(normalized_title), song_id)
+        add = bisect.insort if insort else list.append
+        for token in tokens:
+            add(self._postings.setdefault(token, []), entry)
+        for token in {words[0] for words in (title_tokens, artist_tokens) if words}:
+            add(self._leading.setdefault(token, []), entry)
+        return tokens
+
+    def _insert_token(self, token, frequency):
+        """
+        Inserts (or updates the frequency of) a token along its path in the trie.
+        """
+        entry = (-frequency, token)
+        node = self._root
+        for char in token:
+            node = node.children.setdefault(char, _TrieNode())
+            completions = node.completions
+            for position, (_, completion) in enumerate(completions):
+                if completion == token:
+                    del completions[position]
+                    break
+            bisect.insort(completions, entry)
+            if len(completions) > MAX_COMPLETIONS:
+                # Only the least frequent completion is forgotten, which may be the token itself.
+                completions.pop()
+
+    def _node(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _capped(self, prefix):
+        """
+        :return: True if the prefix has more completions than are remembered in the trie.
+        """
+        node = self._node(prefix)
+        return node is not None and len(node.completions) == MAX_COMPLETIONS
+
+    def _completions(self, prefix, everything=False):
+        """
+        Retrieves the tokens that start with the given prefix, the prefix itself first if it is a token.
+
+        :param everything: retrieve every token instead of only the most frequent ones, by walking the whole subtree.
+        """
+        node = self._node(prefix)
+        if node is None:
+            return []
+        if not everything:
+            completions = [token for _, token in node.completions]
+        else:
+            completions, stack = [], [(prefix, node)]
+            while stack:
+                path, node = stack.pop()
+                if path in self._postings:
+                    completions.append(path)
+                stack.extend((path + char, child) for char, child in node.children.items())
+        if prefix in self._postings:
+            completions = [prefix] + [token for token in completions if token != prefix]
+        return completions
@@ -15,4 +15,10 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "songs" <<-EOSQL
     FROM '/docker-entrypoint-initdb.d/mil_song.csv'
     DELIMITER ','
     CSV HEADER;
+
+    -- Case and whitespace insensitive key of a title or artist, used for normalized lookups.
+    CREATE FUNCTION song_key(TEXT) RETURNS TEXT AS
+        \$\$ SELECT lower(btrim(regexp_replace(\$1, '\s+', ' ', 'g'))) \$\$
+        LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+    CREATE INDEX songs_key_idx ON songs (song_key(artist), song_key(title));
 EOSQL
@@ -0,0 +1,9 @@
+-- Adds the normalized song key to a songs database that was initialised before it was part of init.sh, or updates it
+-- to the current definition (whitespace is collapsed before it is trimmed, such that trailing tabs are ignored too).
+-- Run with: psql --username postgres --dbname songs -f 001_song_key.sql
+CREATE OR REPLACE FUNCTION song_key(TEXT) RETURNS TEXT AS
+    $$ SELECT lower(btrim(regexp_replace($1, '\s+', ' ', 'g'))) $$
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+CREATE INDEX IF NOT EXISTS songs_key_idx ON songs (song_key(artist), song_key(title));
+-- The index is rebuilt, in case it was created with a previous definition of song_key().
+REINDEX INDEX songs_key_idx;
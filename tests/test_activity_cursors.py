@@ -0,0 +1,116 @@
+import contextlib
+import datetime
+import importlib.util
+import os
+import sys
+import unittest
+from unittest import mock
+
+ACTIVITIES_DIR = os.path.join(os.path.dirname(__file__), '..', 'activities')
+
+try:
+    # The service imports its sibling modules (archive, live, ...) as top-level modules.
+    sys.path.insert(0, ACTIVITIES_DIR)
+    spec = importlib.util.spec_from_file_location('activities_app', os.path.join(ACTIVITIES_DIR, 'app.py'))
+    activities_app = importlib.util.module_from_spec(spec)
+    # Flask('activities') finds its root path through the module named 'activities', otherwise the service folder.
+    with mock.patch.dict(sys.modules, {'activities': activities_app}):
+        spec.loader.exec_module(activities_app)
+except ImportError:
+    activities_app = None
+
+
+class FakePool:
+    """
+    Runs the keyset statements of GET /activities/ on a list of activity rows instead of Postgres.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield mock.MagicMock()
+
+    def execute(self, cursor, name, params):
+        n, *bound = params
+        key = activities_app.activity_key
+        direction = name[len('activities_'):]
+        rows = sorted(self.rows, key=key, reverse=direction in ('desc', 'before'))
+        if direction == 'before':
+            rows = [row for row in rows if key(row) < tuple(bound)]
+        elif direction == 'after':
+            rows = [row for row in rows if key(row) > tuple(bound)]
+        cursor.fetchall.return_value = rows[:n]
+
+
+@unittest.skipIf(activities_app is None, 'The activities service needs its requirements to be installed')
+class ActivityCursorsTest(unittest.TestCase):
+    """
+    Pages through all activities in every direction and sort order, following the next cursor of every page.
+    """
+
+    def setUp(self):
+        start = datetime.datetime(2023, 5, 1, 12)
+        # Activities share timestamps, such that the type and id break the ties of the key.
+        self.rows = [('add_song' if activity_id % 3 else 'create_playlist', 'user1', None, None, None, activity_id,
+                      start + datetime.timedelta(minutes=activity_id // 4), activity_id)
+                     for activity_id in range(1, 12)]
+        patcher = mock.patch.object(activities_app, 'pool', FakePool(self.rows))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = activities_app.app.test_client()
+
+    def page_through(self, n, sort, direction=None, cursor=None):
+        """
+        :return: list of the playlist ids (the activity ids) of all pages, in the order in which they were returned.
+        """
+        ids, pages = [], 0
+        while True:
+            params = {'n': n, 'sort': sort}
+            if cursor is not None:
+                params[direction] = cursor
+            response = self.client.get('/activities', query_string=params)
+            self.assertEqual(response.status_code, 200)
+            page = response.get_json()
+            page_ids = [activity['playlist_id'] for activity in page['activities']]
+            keys = [activities_app.activity_key(self.rows[activity_id - 1]) for activity_id in page_ids]
+            self.assertEqual(keys, sorted(keys, reverse=sort == 'desc'))
+            ids.extend(page_ids)
+            pages += 1
+            self.assertLessEqual(pages, len(self.rows) + 1)
+            if page['next'] is None:
+                return ids
+            # A first page continues in the direction of its sort order.
+            direction = direction or {'desc': 'before', 'asc': 'after'}[sort]
+            cursor = page['next']
+
+    def assert_every_row_once(self, ids):
+        self.assertEqual(sorted(ids), [row[7] for row in self.rows])
+
+    def test_first_pages(self):
+        for n in (3, 11):
+            for sort in ('asc', 'desc'):
+                with self.subTest(n=n, sort=sort):
+                    self.assert_every_row_once(self.page_through(n, sort))
+
+    def test_cursor_pages(self):
+        edges = {
+            'before': activities_app.encode_cursor(('add_song', None, None, None, None, None,
+                                                    datetime.datetime(2024, 1, 1), 0)),
+            'after': activities_app.encode_cursor(('add_song', None, None, None, None, None,
+                                                   datetime.datetime(2022, 1, 1), 0)),
+        }
+        for n in (3, 11):
+            for direction in ('before', 'after'):
+                for sort in ('asc', 'desc'):
+                    with self.subTest(n=n, direction=direction, sort=sort):
+                        self.assert_every_row_once(self.page_through(n, sort, direction, edges[direction]))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/activities', query_string={'before': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import datetime
+import os
+import re
+import unittest
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+INIT_SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'activities_persistence', 'init.sh')
+# Connection string of a scratch Postgres database, e.g. "host=localhost user=postgres password=postgres".
+DSN = os.environ.get('TEST_DATABASE_DSN')
+
+
+def schema_sql():
+    """
+    :return: the SQL that init.sh runs on the activities database.
+    """
+    with open(INIT_SCRIPT) as file:
+        script = file.read()
+    # The second heredoc creates the tables, in which the dollar signs are escaped for the shell.
+    return re.findall(r'<<-EOSQL\n(.*?)\nEOSQL', script, re.S)[1].replace('\\$', '$')
+
+
+@unittest.skipIf(psycopg2 is None or not DSN, 'Set TEST_DATABASE_DSN to a Postgres database to run this test')
+class ActivityPartitionsTest(unittest.TestCase):
+    """
+    Creates the activities schema of init.sh in a scratch schema, and creates the partitions of months whose
+    activities ended up in the default partition.
+    """
+
+    def setUp(self):
+        self.conn = psycopg2.connect(DSN)
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("DROP SCHEMA IF EXISTS test_activity_partitions CASCADE;")
+        self.cursor.execute("CREATE SCHEMA test_activity_partitions;")
+        self.cursor.execute("SET search_path TO test_activity_partitions;")
+        self.cursor.execute(schema_sql())
+
+    def tearDown(self):
+        self.cursor.execute("DROP SCHEMA test_activity_partitions CASCADE;")
+        self.conn.close()
+
+    def partition_of(self, activity_id):
+        self.cursor.execute("SELECT tableoid::regclass::TEXT FROM activities WHERE id = %s;", (activity_id,))
+        return self.cursor.fetchone()[0]
+
+    def test_default_partition_activities_are_moved(self):
+        # A clock-skewed activity, a year ahead, has no partition yet.
+        future = datetime.datetime.now().replace(day=15) + datetime.timedelta(days=365)
+        self.cursor.execute("INSERT INTO activities (activity_type, username, activity_timestamp) "
+                            "VALUES ('create_playlist', 'user1', %s) RETURNING id;", (future,))
+        activity_id = self.cursor.fetchone()[0]
+        self.assertEqual(self.partition_of(activity_id), 'activities_default')
+
+        # The daily partition job reaches its month.
+        self.cursor.execute("SELECT create_activity_partitions(NOW()::DATE, %s);", (future.date(),))
+        self.assertEqual(self.partition_of(activity_id), f'activities_{future:%Y_%m}')
+
+        # Running it again is a no-op, and new activities of the month go to its partition.
+        self.cursor.execute("SELECT create_activity_partitions(NOW()::DATE, %s);", (future.date(),))
+        self.cursor.execute("INSERT INTO activities (activity_type, username, activity_timestamp) "
+                            "VALUES ('create_playlist', 'user2', %s) RETURNING id;", (future,))
+        self.assertEqual(self.partition_of(self.cursor.fetchone()[0]), f'activities_{future:%Y_%m}')
+        self.cursor.execute("SELECT COUNT(*) FROM activities_default;")
+        self.assertEqual(self.cursor.fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
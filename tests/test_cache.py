@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+
+from common.cache import BloomFilter, LRUCache
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        songs = [(f'title{i}', f'artist{i}') for i in range(1000)]
+        for song in songs:
+            bloom.add(song)
+        self.assertEqual(len(bloom), 1000)
+        self.assertTrue(all(song in bloom for song in songs))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add((f'title{i}', f'artist{i}'))
+        false_positives = sum((f'other{i}', f'artist{i}') in bloom for i in range(10000))
+        # About 1% at capacity, with plenty of room for chance.
+        self.assertLess(false_positives, 300)
+        self.assertAlmostEqual(bloom.estimated_false_positive_rate(), 0.01, delta=0.005)
+
+    def test_key_parts_are_separated(self):
+        bloom = BloomFilter(100, 0.01)
+        bloom.add(('ab', 'c'))
+        self.assertIn(('ab', 'c'), bloom)
+        self.assertNotIn(('a', 'bc'), bloom)
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.evicted = []
+        self.cache = LRUCache(3, 60, on_evict=lambda key, value: self.evicted.append(key))
+
+    def test_least_recently_used_is_evicted(self):
+        for key in 'abc':
+            self.cache.put(key, key.upper())
+        # Reading a makes b the least recently used entry.
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.cache.put('d', 'D')
+        self.assertEqual(self.evicted, ['b'])
+        self.assertIsNone(self.cache.get('b'))
+        # Replacing c makes it the most recently used entry, without evicting it.
+        self.cache.put('c', 'C2')
+        self.cache.put('e', 'E')
+        self.assertEqual(self.evicted, ['b', 'a'])
+        self.assertEqual([self.cache.get(key) for key in 'cde'], ['C2', 'D', 'E'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (4, 1))
+
+    def test_entries_expire(self):
+        with mock.patch('common.cache.time.monotonic', return_value=1000.0):
+            self.cache.put('a', 'A')
+        with mock.patch('common.cache.time.monotonic', return_value=1060.0):
+            self.assertEqual(self.cache.get('a'), 'A')
+        with mock.patch('common.cache.time.monotonic', return_value=1060.5):
+            self.assertEqual(self.cache.get('a', 'default'), 'default')
+        self.assertEqual(self.evicted, ['a'])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate(self):
+        self.cache.put('a', 'A')
+        self.cache.invalidate('a')
+        self.cache.invalidate('b')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.evicted, ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from activities.feed_cache import FeedCache
+
+
+class FeedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = FeedCache(maxsize=2, ttl=60)
+
+    def cache_page(self, username, page, friends=()):
+        key = self.cache.key(username, 10, 'desc')
+        self.cache.put(key, page, friends)
+        return key
+
+    def test_invalidation(self):
+        key = self.cache_page('user1', 'page', ['friend1'])
+        self.assertEqual(self.cache.get(key), 'page')
+        self.cache.invalidate_watchers(['friend1'])
+        self.assertIsNone(self.cache.get(self.cache.key('user1', 10, 'desc')))
+
+    def test_page_that_raced_with_an_invalidation_is_not_cached(self):
+        key = self.cache.key('user1', 10, 'desc')
+        self.cache.invalidate(['user1'])
+        self.cache.put(key, 'stale page')
+        self.assertIsNone(self.cache.get(self.cache.key('user1', 10, 'desc')))
+
+    def test_evicted_users_are_forgotten(self):
+        for user in range(100):
+            self.cache_page(f'user{user}', 'page', [f'friend{user}', 'friend'])
+        # Only the users of the two cached pages are still watching.
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.metrics()['users'], 2)
+        self.assertEqual(set(self.cache._watchers), {'friend98', 'friend99', 'friend'})
+        self.assertEqual(self.cache._watchers['friend'], {'user98', 'user99'})
+        self.assertLessEqual(len(self.cache._generations), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from unittest import mock
+
+from friends.graph import FriendGraph
+
+
+class FriendGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = FriendGraph()
+        for username, friend in [('user', 'a'), ('user', 'b'), ('user', 'c'), ('a', 'x'), ('b', 'x'), ('c', 'x'),
+                                 ('a', 'y'), ('b', 'y'), ('c', 'z'), ('a', 'b')]:
+            self.graph.add(username, friend)
+
+    def test_mutual_counts(self):
+        # Friends of the user (a, b and c) and the user themselves are never suggested.
+        self.assertEqual(self.graph.suggestions('user'), [('x', 3), ('y', 2), ('z', 1)])
+        self.assertEqual(self.graph.suggestions('user', k=2), [('x', 3), ('y', 2)])
+        self.assertEqual(self.graph.suggestions('unknown'), [])
+        self.assertEqual(self.graph.mutual('user', 'x'), ['a', 'b', 'c'])
+        self.assertEqual(self.graph.mutual('x', 'user'), ['a', 'b', 'c'])
+        self.assertEqual(self.graph.mutual('user', 'unknown'), [])
+
+    def test_ties_are_broken_on_username(self):
+        self.graph.add('c', 'w')
+        self.assertEqual(self.graph.suggestions('user'), [('x', 3), ('y', 2), ('w', 1), ('z', 1)])
+
+    def test_expanded_friends_cap(self):
+        # Only the two least connected friends of the user are expanded: a and b have 4 friends, c has 6.
+        for friend in ('d', 'e', 'f'):
+            self.graph.add('c', friend)
+        with mock.patch('friends.graph.MAX_EXPANDED_FRIENDS', 2):
+            self.assertEqual(self.graph.suggestions('user'), [('x', 2), ('y', 2)])
+
+    def test_fanout_cap(self):
+        for candidate in range(20):
+            self.graph.add('a', f'candidate{candidate}')
+        with mock.patch('friends.graph.MAX_FRIEND_FANOUT', 5):
+            suggestions = dict(self.graph.suggestions('user', k=100))
+        # At most 5 of the 24 friends of a are considered, the friends of b and c are all considered.
+        self.assertLessEqual(sum(username.startswith('candidate') for username in suggestions), 5)
+        self.assertIn(suggestions['x'], (2, 3))
+        self.assertEqual(suggestions['z'], 1)
+
+    def test_etag_changes_with_the_friends(self):
+        friends, etag = self.graph.friends('user')
+        self.assertEqual(friends, ['a', 'b', 'c'])
+        self.assertEqual(self.graph.etag('user'), etag)
+        self.assertFalse(self.graph.add('user', 'a'))
+        self.assertEqual(self.graph.etag('user'), etag)
+        self.assertTrue(self.graph.add('user', 'x'))
+        self.assertNotEqual(self.graph.etag('user'), etag)
+        self.assertEqual(self.graph.friends_many(['x', 'unknown']), {'x': ['a', 'b', 'c', 'user'], 'unknown': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
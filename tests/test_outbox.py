@@ -0,0 +1,68 @@
+import contextlib
+import datetime
+import unittest
+from unittest import mock
+
+from common.outbox import Outbox
+
+
+class Response:
+    def __init__(self, status_code: int, text: str = ''):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError(f'{self.status_code} error')
+
+
+class OutboxTest(unittest.TestCase):
+    """
+    Sends batches of an outbox with a fake pool and Activities microservice, which rejects every batch that contains
+    an activity without username, like POST /activities/batch.
+    """
+
+    def setUp(self):
+        created_at = datetime.datetime(2023, 4, 28, 10, 15)
+        self.rows = [(outbox_id, {'activity_type': 'make_friend', 'username': f'user{outbox_id}',
+                                  'username_friend': 'friend'}, created_at) for outbox_id in range(1, 9)]
+        self.cursor = mock.MagicMock()
+        self.cursor.fetchall.return_value = self.rows
+        pool = mock.MagicMock()
+        pool.transaction.side_effect = lambda: contextlib.nullcontext(self.cursor)
+        # The background thread is not started, the test calls dispatch() itself.
+        with mock.patch.object(Outbox, '_run'):
+            self.outbox = Outbox(pool, 'http://activities:5000', source='friends')
+        self.sent = []
+
+    def post(self, url, json, timeout):
+        activities = json['activities']
+        if any('username' not in activity for activity in activities):
+            return Response(400, 'Invalid activity: Missing username')
+        self.sent.extend(activity['idempotency_key'] for activity in activities)
+        return Response(201)
+
+    def test_rejected_activity_is_dead_lettered(self):
+        del self.rows[5][1]['username']
+        with mock.patch('common.outbox.requests.post', side_effect=self.post), \
+                mock.patch('common.outbox.psycopg2.extras.execute_values') as execute_values:
+            self.assertEqual(self.outbox.dispatch(), 8)
+
+        # The other activities were sent, the malformed one was moved to the dead letters with the response.
+        self.assertEqual(sorted(self.sent), sorted(f'friends-{outbox_id}' for outbox_id in (1, 2, 3, 4, 5, 7, 8)))
+        self.assertEqual(execute_values.call_args[0][2], [(6, '400: Invalid activity: Missing username')])
+        # The whole batch left the outbox, such that the rows behind it are sent next.
+        self.cursor.execute.assert_called_with("DELETE FROM outbox WHERE id = ANY(%s);", (list(range(1, 9)),))
+        metrics = self.outbox.metrics()
+        self.assertEqual((metrics['sent'], metrics['rejected']), (7, 1))
+
+    def test_server_error_is_retried(self):
+        with mock.patch('common.outbox.requests.post', return_value=Response(503)):
+            with self.assertRaises(OSError):
+                self.outbox.dispatch()
+        # Nothing was deleted, the batch is sent again on the next attempt.
+        self.assertNotIn('DELETE', ' '.join(str(call) for call in self.cursor.execute.call_args_list))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+from songs import search
+from songs.search import SongIndex
+
+
+class SongIndexTest(unittest.TestCase):
+    """
+    Searches a small catalogue, in which the order of the songs is fully determined by the ranking.
+    """
+
+    def setUp(self):
+        self.index = SongIndex()
+        self.index.build([
+            ('Lovely Day', 'Bill Withers'),
+            ('Love Me Do', 'The Beatles'),
+            ('Crazy In Love', 'Beyoncé'),
+            ('Love', 'Inna'),
+            ('She Loves You', 'The Beatles'),
+            ('Halo', 'Beyoncé'),
+        ])
+
+    def test_prefix_search(self):
+        self.assertEqual(self.index.search('hal'), [('Halo', 'Beyoncé')])
+        # Case and accents are ignored.
+        self.assertEqual(self.index.search('BEYONCE HA'), [('Halo', 'Beyoncé')])
+        self.assertEqual(self.index.search('beatles lo'), [('Love Me Do', 'The Beatles'),
+                                                           ('She Loves You', 'The Beatles')])
+        self.assertEqual(self.index.search('zeppelin'), [])
+        self.assertEqual(self.index.search('  '), [])
+
+    def test_exact_match_ordering(self):
+        # Titles that start with the query first, the complete word before longer words, then shorter titles first.
+        self.assertEqual(self.index.search('love'), [
+            ('Love', 'Inna'),
+            ('Love Me Do', 'The Beatles'),
+            ('Lovely Day', 'Bill Withers'),
+            ('Crazy In Love', 'Beyoncé'),
+            ('She Loves You', 'The Beatles'),
+        ])
+        self.assertEqual(self.index.search('love', k=2), [('Love', 'Inna'), ('Love Me Do', 'The Beatles')])
+
+    def test_add(self):
+        self.index.add('Lo', 'Test')
+        self.assertEqual(self.index.search('lo', k=1), [('Lo', 'Test')])
+        # Adding a song twice does nothing.
+        self.index.add('Lo', 'Test')
+        self.assertEqual(len(self.index), 7)
+        self.assertEqual(self.index.search('test'), [('Lo', 'Test')])
+
+    def test_add_updates_completion_frequencies(self):
+        self.assertEqual(self.index._completions('lov'), ['love', 'lovely', 'loves'])
+        for title in ('Loves Me', 'Loves Me Not', 'Loves Me Too'):
+            self.index.add(title, 'Test')
+        self.assertEqual(self.index._completions('lov'), ['loves', 'love', 'lovely'])
+
+    def test_completion_cap(self):
+        index = SongIndex()
+        # Token wN is in N songs, so the most frequent tokens are inserted last.
+        index.build([(f'w{n}', f'artist {n} {copy}') for n in range(1, search.MAX_COMPLETIONS + 11)
+                     for copy in range(n)])
+        completions = index._completions('w')
+        self.assertEqual(len(completions), search.MAX_COMPLETIONS)
+        self.assertEqual(completions[:2], [f'w{search.MAX_COMPLETIONS + 10}', f'w{search.MAX_COMPLETIONS + 9}'])
+
+        # A token that is not remembered at a short prefix is still found there if the others don't fill the results.
+        index.add('wzebra', 'Test')
+        self.assertNotIn('wzebra', index._completions('w'))
+        self.assertIn(('wzebra', 'Test'), index.search('w', k=1000))
+        self.assertEqual(index.search('wz'), [('wzebra', 'Test')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import contextlib
+import importlib.util
+import os
+import sys
+import unittest
+from unittest import mock
+
+SONGS_DIR = os.path.join(os.path.dirname(__file__), '..', 'songs')
+
+try:
+    # The service imports its search index as a top-level module, and reads the catalogue from the pool on import.
+    sys.path.insert(0, SONGS_DIR)
+    spec = importlib.util.spec_from_file_location('songs_app', os.path.join(SONGS_DIR, 'app.py'))
+    songs_app = importlib.util.module_from_spec(spec)
+    # Flask('songs') finds its root path through the module named 'songs', otherwise the service folder.
+    with mock.patch('common.db.Pool'), mock.patch.dict(sys.modules, {'songs': songs_app}):
+        spec.loader.exec_module(songs_app)
+except ImportError:
+    songs_app = None
+
+
+class FakePool:
+    """
+    Answers the existence statements from a set of (title, artist) songs, and records the statements it ran.
+    """
+
+    def __init__(self, songs):
+        self.songs = songs
+        self.executed = []
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield mock.MagicMock()
+
+    def execute(self, cursor, name, params):
+        self.executed.append(name)
+        if name == 'song_exists':
+            cursor.fetchone.return_value = (int(params in self.songs),)
+        elif name == 'songs_exist':
+            cursor.fetchall.return_value = [song for song in zip(*params) if song in self.songs]
+
+
+@unittest.skipIf(songs_app is None, 'The songs service needs its requirements to be installed')
+class SongExistsTest(unittest.TestCase):
+    """
+    Checks songs through the existence filter and cache of the songs service, with a fake database.
+    """
+
+    def setUp(self):
+        self.pool = FakePool({('Halo', 'Beyoncé')})
+        self.filter = set(self.pool.songs)
+        replacements = {
+            'pool': self.pool,
+            'exists_filter': self.filter,
+            'exists_cache': songs_app.LRUCache(10, 60),
+            'exists_stats': songs_app.collections.Counter(),
+        }
+        for name, value in replacements.items():
+            patcher = mock.patch.object(songs_app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_filter_negative_skips_the_database(self):
+        self.assertFalse(songs_app.song_exists('Unknown', 'Nobody'))
+        self.assertEqual(self.pool.executed, [])
+        self.assertEqual(songs_app.exists_stats['filter_negatives'], 1)
+
+    def test_false_positive_falls_through_to_the_database(self):
+        # The filter claims the song might exist, the database has the final say.
+        self.filter.add(('Unknown', 'Nobody'))
+        self.assertFalse(songs_app.song_exists('Unknown', 'Nobody'))
+        self.assertEqual(self.pool.executed, ['song_exists'])
+        self.assertEqual(songs_app.exists_stats['false_positives'], 1)
+        # Negative answers are not cached.
+        self.assertFalse(songs_app.song_exists('Unknown', 'Nobody'))
+        self.assertEqual(self.pool.executed, ['song_exists', 'song_exists'])
+
+    def test_positive_is_cached(self):
+        self.assertTrue(songs_app.song_exists('Halo', 'Beyoncé'))
+        self.assertTrue(songs_app.song_exists('Halo', 'Beyoncé'))
+        self.assertEqual(self.pool.executed, ['song_exists'])
+
+    def test_batch(self):
+        self.filter.add(('Unknown', 'Nobody'))
+        songs = [('Halo', 'Beyoncé'), ('Unknown', 'Nobody'), ('Other', 'Nobody')]
+        self.assertEqual(songs_app.songs_exist(songs), [True, False, False])
+        self.assertEqual(songs_app.exists_stats['false_positives'], 1)
+        # The song that was found is cached, the false positive is looked up again.
+        self.assertEqual(songs_app.songs_exist(songs), [True, False, False])
+        self.assertEqual(self.pool.executed, ['songs_exist', 'songs_exist'])
+        self.assertEqual(songs_app.exists_stats['db_positives'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import datetime
+import unittest
+
+from activities.trending import SlidingCounter, Trending
+
+
+class SlidingCounterTest(unittest.TestCase):
+    def setUp(self):
+        # A window of a minute, in buckets of 10 seconds.
+        self.counter = SlidingCounter(60, 6)
+
+    def test_bucket_rollover(self):
+        self.counter.add('a', 100, now=100)
+        self.counter.add('a', 109.9, now=109.9)
+        self.counter.add('b', 110, now=110)
+        self.assertEqual(self.counter.top(10), [('a', 2), ('b', 1)])
+        self.assertEqual(sorted(self.counter._buckets), [10, 11])
+
+        # The bucket of [100, 110) is counted until a whole window after it ended.
+        self.counter.expire(now=169.9)
+        self.assertEqual(self.counter.top(10), [('a', 2), ('b', 1)])
+        self.counter.expire(now=170)
+        self.assertEqual(self.counter.top(10), [('b', 1)])
+        self.counter.expire(now=180)
+        self.assertEqual(self.counter.top(10), [])
+        self.assertEqual(len(self.counter), 0)
+
+    def test_occurrences_outside_of_the_window(self):
+        # Too old to be counted at all.
+        self.counter.add('a', 100, now=170)
+        self.assertEqual(len(self.counter), 0)
+        # Times in the future count as now.
+        self.counter.add('b', 1000, now=170)
+        self.counter.expire(now=239.9)
+        self.assertEqual(self.counter.top(10), [('b', 1)])
+        self.counter.expire(now=240)
+        self.assertEqual(self.counter.top(10), [])
+
+    def test_top(self):
+        for key, count in [('a', 3), ('b', 5), ('c', 1)]:
+            self.counter.add(key, 100, now=100, count=count)
+        self.assertEqual(self.counter.top(2), [('b', 5), ('a', 3)])
+
+
+class TrendingTest(unittest.TestCase):
+    def test_windows(self):
+        trending = Trending(size=2)
+        now = datetime.datetime.now()
+        recent, older = now - datetime.timedelta(minutes=30), now - datetime.timedelta(days=2)
+        trending.add([
+            ('add_song', 'user1', None, 'Beyoncé', 'Halo', 1, recent, 1),
+            ('add_song', 'user2', None, 'Beyoncé', 'Halo', 2, older, 2),
+            ('add_song', 'user2', None, 'Inna', 'Love', 2, older, 3),
+            ('make_friend', 'user2', 'user3', None, None, None, older, 4),
+        ])
+        trending.add_count('songs', ('Inna', 'Love'), older, 2)
+
+        self.assertEqual(trending.snapshot()['updated'], None)
+        trending.refresh()
+        windows = trending.snapshot()['windows']
+        self.assertEqual(windows['1h']['songs'], [{'song_artist': 'Beyoncé', 'song_title': 'Halo', 'count': 1}])
+        self.assertEqual(windows['24h'], windows['1h'])
+        self.assertEqual(windows['1h']['users'], [{'username': 'user1', 'count': 1}])
+        self.assertEqual(windows['7d']['songs'], [{'song_artist': 'Inna', 'song_title': 'Love', 'count': 3},
+                                                  {'song_artist': 'Beyoncé', 'song_title': 'Halo', 'count': 2}])
+        self.assertEqual(windows['7d']['users'], [{'username': 'user2', 'count': 3},
+                                                  {'username': 'user1', 'count': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
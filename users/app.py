@@ -1,8 +1,12 @@
-from flask import Flask, jsonify
+import json
+
+from flask import Flask, Response
 from flask import request as flask_request
 from flask_restful import Resource, Api, reqparse
 
-import psycopg2
+from common import tokens
+from common.db import Pool
+from passwords import HasherBusy, PasswordHasher
 
 app = Flask('users')
 api = Api(app)
@@ -10,17 +14,33 @@ api = Api(app)
 # Microservice URLs.
 users_microservice_url = "http://users:5000"
 
-conn = None
-
-while conn is None:
-    try:
-        conn = psycopg2.connect(dbname="users", user="postgres", password="postgres", host="users_persistence")
-        print("DB connection succesful")
-    except psycopg2.OperationalError:
-        import time
-
-        time.sleep(1)
-        print("Retrying DB connection")
+# Maximum number of usernames that can be checked in a single batch existence request.
+MAX_EXISTS_BATCH = 1000
+# Default and maximum number of users returned in a single page of the user listing.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+# Number of rows fetched per round trip by the server-side cursor used for streaming the user listing.
+EXPORT_ITERSIZE = 2000
+# Fields that can be selected in the user listing, in the order they are returned. Password hashes are never listed.
+USER_FIELDS = ['id', 'username']
+
+# Registry of the SQL statements of this service, prepared once on every pooled connection.
+STATEMENTS = {
+    'user_exists': "SELECT COUNT(*) FROM users WHERE username = $1",
+    'users_exist': "SELECT username FROM users WHERE username = ANY($1::VARCHAR[])",
+    'user_by_username': "SELECT * FROM users WHERE username = $1",
+    'users_first_page': "SELECT id, username FROM users ORDER BY id LIMIT $1",
+    # Seeks straight into the primary key index, so every page costs the same.
+    'users_page': "SELECT id, username FROM users WHERE id > $1 ORDER BY id LIMIT $2",
+    'insert_user': "INSERT INTO users (username, password) VALUES ($1, $2)",
+    'password_by_username': "SELECT password FROM users WHERE username = $1",
+    'update_password': "UPDATE users SET password = $2 WHERE username = $1",
+}
+
+pool = Pool(dbname="users", host="users_persistence", statements=STATEMENTS)
+
+# Hashes and verifies passwords in a separate pool of processes.
+hasher = PasswordHasher()
 
 
 def user_exists(username: str):
@@ -30,9 +50,47 @@ def user_exists(username: str):
     :param username: The username of the user to check.
     :return: True if the user exists, False otherwise.
     """
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM users WHERE username = %s", (username,))
-    return bool(cursor.fetchone()[0])
+    with pool.transaction() as cursor:
+        pool.execute(cursor, 'user_exists', (username,))
+        return bool(cursor.fetchone()[0])
+
+
+def users_page(after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Retrieves a single page of the users, walking the primary key.
+
+    :param after: id of the last user of the previous page, None for the first page.
+    :param limit: maximum number of users to return.
+    :return: list of (id, username) rows, ordered by id.
+    """
+    with pool.transaction() as cursor:
+        if after is not None:
+            pool.execute(cursor, 'users_page', (after, limit))
+        else:
+            pool.execute(cursor, 'users_first_page', (limit,))
+        return cursor.fetchall()
+
+
+def stream_users(after=None, limit=None):
+    """
+    Lazily yields the users from a server-side cursor, such that walking every user never holds them all in memory.
+
+    The connection stays checked out of the pool for as long as the client is reading, since the named cursor lives
+    in its transaction.
+
+    :param after: id to start after, None to start at the first user.
+    :param limit: maximum number of users to yield, None for all remaining users.
+    :return: generator of (id, username) rows, ordered by id.
+    """
+    with pool.connection() as conn:
+        cursor = conn.cursor(name='users_export')
+        cursor.itersize = EXPORT_ITERSIZE
+        # LIMIT NULL is the same as no limit at all.
+        cursor.execute("SELECT id, username FROM users WHERE id > %s ORDER BY id LIMIT %s;",
+                       (after if after is not None else 0, limit))
+        for row in cursor:
+            yield row
+        cursor.close()
 
 
 class User(Resource):
@@ -49,13 +107,13 @@ class User(Resource):
 
     def get(self, username: str):
         # Check if the user exists.
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-        if user := cursor.fetchone():
+        with pool.transaction() as cursor:
+            pool.execute(cursor, 'user_by_username', (username,))
+            user = cursor.fetchone()
+        if user:
             return {
                 'id': user[0],
-                'username': user[1],
-                'password': user[2]
+                'username': user[1]
             }, 200
         # Return a 404 Not Found error.
         return {'message': 'The specified user could not be found in the system.'}, 404
@@ -63,26 +121,56 @@ class User(Resource):
 
 class Users(Resource):
     """
-    Resource for retrieving all users.
+    Resource for walking all users.
 
-    GET /users
-    Returns a list of all users.
+    GET /users?limit=<limit>&after=<id>&fields=<fields>&format=<format>
+    Retrieves the users ordered by id, starting after the given id.
+
+    Query parameters:
+    - limit: The maximum number of users to retrieve, default is 1000 (at most 5000 for 'json').
+    - after (optional): The id of the last user of the previous page.
+    - fields (optional): Comma separated fields to return of every user, out of 'id' and 'username' (default both).
+    - format: Either 'json' (a single page, default) or 'ndjson' (a stream of one user object per line, covering all
+      remaining users when no limit is given).
 
     Response:
-    - 200 OK: The list of all users was returned successfully.
+    - 200 OK: The users were retrieved successfully. For 'json' the body is {'users': [{'id': ..., 'username': ...},
+      ...], 'next': <id>}, where 'next' is null on the last page.
+    - 400 Bad Request: The limit, cursor, fields or format was invalid.
     """
 
     def get(self):
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users")
-        users = cursor.fetchall()
-        return jsonify([
-            {
-                'id': user[0],
-                'username': user[1],
-                'password': user[2]
-            } for user in users
-        ])
+        args = flask_request.args
+        fmt = args.get('format', 'json')
+        if fmt not in ['json', 'ndjson']:
+            return {'message': 'Invalid format, expected json or ndjson'}, 400
+
+        after = args.get('after', type=int)
+        if 'after' in args and after is None:
+            return {'message': 'after must be an integer'}, 400
+
+        limit = args.get('limit', type=int)
+        if 'limit' in args and (limit is None or limit < 1):
+            return {'message': 'limit must be a positive integer'}, 400
+
+        fields = args.get('fields', ','.join(USER_FIELDS)).split(',')
+        if any(field not in USER_FIELDS for field in fields):
+            return {'message': f'Invalid fields, expected a comma separated subset of {", ".join(USER_FIELDS)}'}, 400
+        # Indices of the selected fields in the (id, username) rows.
+        columns = [(field, USER_FIELDS.index(field)) for field in dict.fromkeys(fields)]
+
+        def project(row):
+            return {field: row[column] for field, column in columns}
+
+        if fmt == 'ndjson':
+            lines = (json.dumps(project(row)) + '\n' for row in stream_users(after, limit))
+            return Response(lines, mimetype='application/x-ndjson')
+
+        limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        users = users_page(after, limit)
+        # Only hand out a cursor if the page was full, otherwise this was the last page.
+        next_cursor = users[-1][0] if len(users) == limit else None
+        return {'users': [project(user) for user in users], 'next': next_cursor}, 200
 
 
 class UserExists(Resource):
@@ -108,6 +196,36 @@ class UserExists(Resource):
         )
 
 
+class UsersExistBatch(Resource):
+    """
+    Resource for checking if many users exist at once.
+
+    POST /users/exists/batch
+    Checks which of the specified usernames exist in the database, using a single query.
+
+    Request data:
+    - usernames: A list of at most 1000 usernames to check.
+
+    Response:
+    - 200 OK: The existence of the users was returned successfully, as {'exists': {username: true/false, ...}}.
+    - 400 Bad request: The usernames were missing, malformed or exceeded the batch size.
+    """
+
+    def post(self):
+        # Parse the request data.
+        data = flask_request.get_json(silent=True) or {}
+        usernames = data.get('usernames')
+        if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+            return {'message': 'Missing request data: usernames'}, 400
+        if len(usernames) > MAX_EXISTS_BATCH:
+            return {'message': f'At most {MAX_EXISTS_BATCH} usernames can be checked at once'}, 400
+
+        with pool.transaction() as cursor:
+            pool.execute(cursor, 'users_exist', (usernames,))
+            existing = {row[0] for row in cursor.fetchall()}
+        return {'exists': {username: username in existing for username in usernames}}, 200
+
+
 class UserRegistration(Resource):
     """
     Resource for user registration.
@@ -120,9 +238,10 @@ class UserRegistration(Resource):
     - password: The password of the user to be created.
 
     Response:
-    - 201 Created: The user account was created successfully.
+    - 201 Created: The user account was created successfully, returns a session token for the new user.
     - 400 Bad Request: The user account could not be created due to a missing or invalid username or password.
     - 409 Conflict: The user account could not be created because a user with the provided username already exists.
+    - 503 Service Unavailable: Too many passwords are being hashed at the moment, the request should be retried later.
     """
 
     def post(self):
@@ -136,11 +255,16 @@ class UserRegistration(Resource):
         if user_exists(args['username']):
             return {'message': 'User already exists'}, 409
 
+        # Only a salted hash of the password is stored.
+        try:
+            password_hash = hasher.hash(args['password'])
+        except HasherBusy:
+            return {'message': 'Too many requests, try again later'}, 503
+
         # Create a new user.
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (args['username'], args['password']))
-        conn.commit()
-        return {'message': 'User created successfully'}, 201
+        with pool.transaction() as cursor:
+            pool.execute(cursor, 'insert_user', (args['username'], password_hash))
+        return {'message': 'User created successfully', 'token': tokens.issue(args['username'])}, 201
 
 
 class UserLogin(Resource):
@@ -155,8 +279,10 @@ class UserLogin(Resource):
     - password: The password of the user to be logged in.
 
     Response:
-    - 200 OK: The user was logged in successfully.
+    - 200 OK: The user was logged in successfully, returns a signed session token that other microservices can verify
+      locally. It should be sent along as 'Authorization: Bearer <token>'.
     - 401 Unauthorized: The login attempt was rejected due to an invalid username or password.
+    - 503 Service Unavailable: Too many passwords are being verified at the moment, the request should be retried later.
     """
 
     def post(self):
@@ -166,22 +292,49 @@ class UserLogin(Resource):
         parser.add_argument('password', required=True)
         args = parser.parse_args()
 
-        # Retrieve the user from the database.
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = %s AND password = %s",
-                       (args['username'], args['password']))
-        if user := cursor.fetchone():
-            return {'message': 'User logged in successfully'}, 200
-        else:
-            return {'message': 'Invalid username or password'}, 401
+        # Retrieve the password hash of the user, by username only.
+        with pool.transaction() as cursor:
+            pool.execute(cursor, 'password_by_username', (args['username'],))
+            user = cursor.fetchone()
+
+        try:
+            if not user or not hasher.verify(args['password'], user[0]):
+                return {'message': 'Invalid username or password'}, 401
+        except HasherBusy:
+            return {'message': 'Too many requests, try again later'}, 503
+
+        # Upgrade passwords that were stored in plaintext, or hashed with an outdated work factor.
+        # If the hasher is busy, the password is simply upgraded on one of the next logins.
+        if hasher.needs_rehash(user[0]):
+            try:
+                password_hash = hasher.hash(args['password'])
+                with pool.transaction() as cursor:
+                    pool.execute(cursor, 'update_password', (args['username'], password_hash))
+            except HasherBusy:
+                pass
+
+        return {'message': 'User logged in successfully', 'token': tokens.issue(args['username'])}, 200
+
+
+class DatabaseMetrics(Resource):
+    """
+    GET /users/db/metrics
+    Retrieves the size and usage counters of the database connection pool, and the number of calls and latency of
+    every prepared statement (most total time first).
+    """
+
+    def get(self):
+        return {**pool.metrics(), 'statements': pool.statement_metrics()}, 200
 
 
 # Add the resources to the API.
 api.add_resource(Users, '/users')
 api.add_resource(User, '/users/<username>')
 api.add_resource(UserExists, '/users/exists')
+api.add_resource(UsersExistBatch, '/users/exists/batch')
 api.add_resource(UserRegistration, '/users/register')
 api.add_resource(UserLogin, '/users/login')
+api.add_resource(DatabaseMetrics, '/users/db/metrics')
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,45 @@
+"""
+Benchmark of the number of logins (password verifications) per second against the size of the hashing pool.
+
+Every login is verified from a separate request thread, like the Flask development server does, such that the
+benchmark includes the overhead of handing the work to the worker processes. No database is needed.
+
+Usage: python3 bench_passwords.py [--logins 200] [--threads 32] [--workers 1 2 4 8]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PasswordHasher
+
+
+def benchmark(workers: int, logins: int, threads: int):
+    # The queue is large enough that no login is rejected, we want to measure throughput.
+    hasher = PasswordHasher(workers=workers, queue_depth=threads)
+    stored = hasher.hash('benchmark-password')  # Also starts the worker processes.
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as requests:
+            results = list(requests.map(lambda _: hasher.verify('benchmark-password', stored), range(logins)))
+        elapsed = time.perf_counter() - start
+    finally:
+        hasher.shutdown()
+    assert all(results)
+    return logins / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=32)
+    cpus = os.cpu_count() or 1
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, cpus // 2 or 1, cpus, 2 * cpus}))
+    args = parser.parse_args()
+
+    hasher = PasswordHasher()
+    print(f'scrypt n={hasher.n} r={hasher.r} p={hasher.p}, {args.logins} logins from {args.threads} threads')
+    print(f'{"workers":>8} {"logins/s":>10}')
+    for workers in args.workers:
+        print(f'{workers:>8} {benchmark(workers, args.logins, args.threads):>10.1f}')
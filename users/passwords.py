@@ -0,0 +1,119 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Work factor of scrypt, the cost of a hash doubles with every doubling of n.
+SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+# Number of processes that hash passwords, and how many requests may wait for one before new ones are rejected.
+HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+HASH_QUEUE_DEPTH = int(os.environ.get('PASSWORD_HASH_QUEUE_DEPTH', 4 * HASH_WORKERS))
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+class HasherBusy(Exception):
+    """
+    Raised when too many passwords are already waiting to be hashed.
+    """
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int):
+    # Runs in a worker process. scrypt needs 128 * n * r bytes of memory, allow a bit more than that.
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=HASH_BYTES)
+
+
+def _encode(data: bytes):
+    return base64.b64encode(data).decode()
+
+
+def _parse(stored: str):
+    """
+    Parses a stored hash of the form 'scrypt$<n>$<r>$<p>$<salt>$<hash>'.
+
+    :return: tuple (n, r, p, salt, hash), or None if the stored password is not hashed (yet).
+    """
+    parts = stored.split('$')
+    if len(parts) != 6 or parts[0] != 'scrypt':
+        return None
+    try:
+        return int(parts[1]), int(parts[2]), int(parts[3]), base64.b64decode(parts[4]), base64.b64decode(parts[5])
+    except ValueError:
+        return None
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords with salted scrypt, in a bounded pool of worker processes.
+
+    Hashing is deliberately slow, running it on the request threads would hold the GIL and stall every other request of
+    the service. The number of requests waiting for a worker is bounded, once the queue is full new requests are
+    rejected immediately instead of piling up.
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, queue_depth: int = HASH_QUEUE_DEPTH,
+                 n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P):
+        self.workers = workers
+        self.n, self.r, self.p = n, r, p
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _run(self, password: str, salt: bytes, n: int, r: int, p: int):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy('Too many passwords are waiting to be hashed')
+        try:
+            with self._lock:
+                # Start the workers on first use. They are spawned rather than forked, such that they don't inherit
+                # the (database) connections of the service.
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor.submit(_scrypt, password, salt, n, r, p).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str):
+        """
+        Hashes a password with a new random salt.
+
+        :raises HasherBusy: if too many passwords are already waiting to be hashed.
+        :return: the hash to store, which includes the work factor and salt.
+        """
+        salt = os.urandom(SALT_BYTES)
+        digest = self._run(password, salt, self.n, self.r, self.p)
+        return f'scrypt${self.n}${self.r}${self.p}${_encode(salt)}${_encode(digest)}'
+
+    def verify(self, password: str, stored: str):
+        """
+        Verifies a password against a stored hash.
+
+        Passwords that were stored before they were hashed (e.g. the mock users) are compared as is, such that they can
+        be upgraded to a hash on the next successful login, see needs_rehash().
+
+        :raises HasherBusy: if too many passwords are already waiting to be hashed.
+        :return: True if the password matches, False otherwise.
+        """
+        parsed = _parse(stored)
+        if parsed is None:
+            return hmac.compare_digest(password.encode(), stored.encode())
+        n, r, p, salt, expected = parsed
+        return hmac.compare_digest(self._run(password, salt, n, r, p), expected)
+
+    def needs_rehash(self, stored: str):
+        """
+        :return: True if the stored password is not hashed, or hashed with another work factor than the current one.
+        """
+        parsed = _parse(stored)
+        return parsed is None or parsed[:3] != (self.n, self.r, self.p)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None